@@ -3,22 +3,22 @@
 ##################################
 ######## Import packages #########
 ##################################
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib.pyplot import MultipleLocator
-import datetime
-from datetime import datetime as dt
+# Altair and pandas are imported where results are rendered or exported,
+# so the page (and the simulation core) does not pay for them up front
+import os
+import shutil
+import tempfile
 import streamlit as st
-from PIL import Image
-import pandas as pd
-import numpy as np
 import random
 
 # import the model and global parameters
-import main
-import global_param
-GC = global_param.Global_Constant()
+import jobs
+import charts
+import sizing
+import surrogate
+import export
+import swap
+import global_param as GC
 
 ##################################
 ##### Function Declaration #######
@@ -54,6 +54,7 @@ def areaNumDivision(station_num, area_user_num):
 
 # convert the dataframe into csv format
 #@st.cache
+@st.cache_data
 def convert_df(df):
     # IMPORTANT: Cache the conversion to prevent computation on every rerun
     return df.to_csv().encode('utf-8')
@@ -71,8 +72,7 @@ st.title("BSS Interactive Tech-Platform (BIT)")
 st.markdown("This application is used to analyze the service ability of Battery Swap Station, and is used to assist clients in customizing services. \
              The current version is an initial beta version only. All simulation results are only virtual test data, and this software is not responsible for any results.")
 
-image = Image.open('image/image.png')
-st.image(image)
+st.image('image/image.png')
 st.write("")
 ###############################################################################
 ######################### Part 1: Set up App Layout ###########################
@@ -125,35 +125,43 @@ with col_l1: # BSS type
     tab3, tab4, tab5 = st.tabs(["BSS Type", "Swap Time", "Power Module"])
     with tab3: # BSS Type
         type_bss = st.selectbox("Select the Battery Swapping Station(BSS) type", bss_candidates, index=0)
+        # the catalog is read-only, take a copy that can be configured below
         if type_bss == "BSS Type-1 - 500kW":
-            station_type = GC.GEN2_530kW
+            station_type = dict(GC.GEN2_530kW)
             default_swap_time = 6.5
         elif type_bss == "BSS Type-2 V1 - 600kW":
-            station_type = GC.GEN3_600kW
+            station_type = dict(GC.GEN3_600kW)
             default_swap_time = 4.5
         elif type_bss == "BSS Type-2 V2 - 1200kW":
-            station_type = GC.GEN3_1200kW
+            station_type = dict(GC.GEN3_1200kW)
             default_swap_time = 4.5
 
         else:
-            station_type = GC.User_Defined
+            station_type = dict(GC.User_Defined)
             default_swap_time = 3.0
     with tab4: # Swap Time
         min_swap_time = 3.0
         max_swap_time = 10.0
         swap_time = st.slider("Set up the swap time of each swapping user [min]", min_value=min_swap_time, max_value=max_swap_time, value=default_swap_time, step=0.1)
+        swap_lanes = st.number_input("Number of swap lanes (platforms swapping at the same time)", min_value=1, max_value=4, value=1)
     with tab5: # Power Module
         if type_bss == "User Defined":
             pm_catalog = ["20kW", "30kW", "40kW", "60kW", "80kW"]
             power_module_type = st.selectbox("Select the power module type", options=pm_catalog, index=3)
             power_module_number = st.number_input("Give the power module number (max 100)", min_value=1, max_value=100, value=10)
             # power_module_config = {"Type":power_module_type, "Number":power_module_number}
-            power_module_type = GC.power_module_catalog[power_module_type] # UUxxkW dict
+            power_module_type = dict(GC.power_module_catalog[power_module_type]) # UUxxkW dict (editable copy)
             station_type["max_charger_number"] = power_module_number
             station_type["power_module_type"] = power_module_type
             station_type["max_power"] = int(station_type["power_module_type"]["max_power"] * power_module_number)
         else:
             st.write("Selected the BSS type doesn't support for power modules configuration.")    
+        cap_help = "Enforce a grid connection power below the station power on every simulation step, \
+            the power is shared by the batteries and the charge piles (preferred side first)."
+        if st.checkbox("Limit the station power", value=False, help=cap_help):
+            power_cap = st.number_input("Grid connection power [kW]", min_value=20, max_value=max(int(station_type["max_power"]), 20), value=max(int(station_type["max_power"]), 20))
+        else:
+            power_cap = None
     st.write("")
 
 with col_r1: # bsc num
@@ -190,6 +198,22 @@ with col_l2: # user preference
         user_preference = st.radio("Select the user preference mode",options=["full_swap"], help=help_descrip)
     else:
         user_preference = st.radio("Select the user preference mode",options=selection_candidates, help=help_descrip)
+    abandon_help = "Users do not join a queue of the given length (balk), leave the queue after the patience time \
+        without service (renege) and leave the charge pile after the charge time limit (0 = no limit)."
+    user_abandonment = st.checkbox("Users give up waiting", value=False, help=abandon_help)
+    if user_abandonment:
+        max_wait_number = st.number_input("Longest queue a user joins", min_value=1, max_value=100, value=20)
+        user_patience = st.number_input("User patience in the queue [min]", min_value=1, max_value=240, value=30)
+        max_charge_time = st.number_input("Charge time limit at the piles [min]", min_value=0, max_value=480, value=0)
+    else:
+        max_wait_number, user_patience, max_charge_time = 20, 30, 0
+    discipline_help = "Order of the users waiting for a charge pile: arrival order, BS users first, smallest SOC gap first, \
+        or arrival order with piles reserved for BS users."
+    charge_queue_discipline = st.selectbox("Charge queue discipline", options=["fifo", "bs_priority", "shortest_charge", "reservation"], help=discipline_help)
+    if charge_queue_discipline == "reservation":
+        reserved_piles = st.number_input("Charge piles reserved for BS users", min_value=1, max_value=8, value=1)
+    else:
+        reserved_piles = 1
     st.write("")
 
 with col_r2: # service ratio for "fixed value" preference option
@@ -317,12 +341,13 @@ with col_l6: # power distribution strategy
     st.write("")
     st.markdown("### Power Distribution")
     help_power_dist = "When select 'BSS prefered', the power modules will preferentially supply the battery in the station,\
-         and then the redundancy will be allocated to the BSC; otherwise the BSCs have the highest priority to use the power module."
+         and then the redundancy will be allocated to the BSC; otherwise the BSCs have the highest priority to use the power module. \
+         The other strategies are registered in swap.POWER_STRATEGIES, strategy_bench.py compares them."
     if type_bss == "BSS Type-1 - 500kW" or bsc_num == 0:
         st.write("This type of BSS is not equipped with BSC, only swap service avaiable.")
         power_dist_option = "BSS preferred"
     else:
-        power_dist_option = st.selectbox("Select the Power distribution Strategy", ["BSS preferred", "BSC preferred"], help=help_power_dist)
+        power_dist_option = st.selectbox("Select the Power distribution Strategy", list(swap.POWER_STRATEGIES), help=help_power_dist)
     st.write("")
 
 with col_r6: # non swapping user num
@@ -420,6 +445,16 @@ with col_lnew: ### Power modul self setting
             st.write("")
         else:
             st.write("This function only supports user random queue mode")
+with col_rnew: ### reproducibility and result recording
+    st.markdown("### Random seed and recording")
+    help_seed = "0 draws new random users for every run. With a fixed seed the run is reproducible, and changes that only act later in the day (grid interaction, simulation length) reuse the earlier part of previous runs with the same seed."
+    random_seed = st.number_input("Random seed of the simulation", min_value=0, value=0, step=1, help=help_seed)
+    help_record = "Record power, queue length and SOC traces and the outcome of every user for the download. Recorded runs are always simulated from the start."
+    record_results = st.checkbox("Record full results for download", value=True, help=help_record)
+    help_warm = "Start from the station state at the end of a simulated day of the same configuration (built once and then reused) instead of all batteries at the initial SOC."
+    warm_start = st.checkbox("Warm start from a steady station state", value=False, help=help_warm)
+    help_truncate = "Detect the initial transient (MSER-5 on queue lengths and mean SOC) and leave the users arriving during it out of the average service times and the 15 min swap ratio."
+    truncate_warmup = st.checkbox("Exclude the warm-up period from the averages", value=False, help=help_truncate)
 with col_m1:
     ######################################################################
     ########### Excute the simulation if the button is pressed ###########
@@ -428,78 +463,257 @@ with col_m1:
     button_flag_1 = st.button("Start Single Station Simulation")
     st.write("===========================")
 
-if button_flag_1 == True:
-    with st.spinner("simulation excuting..."):
-        # Perform Simulation
-        ####################################################################################################
-        # collect the setup congiuration into dict "param", prepare to transport into do_simulation(param) #
-        ####################################################################################################
-        sim_interval = 10
+# every session keeps the handles of its own simulations, the runs themselves execute in the shared pool of jobs.py
+if "sim_jobs" not in st.session_state:
+    st.session_state["sim_jobs"] = []
+    st.session_state["finished_jobs"] = set()
+    st.session_state["result_charts"] = {}
+    st.session_state["result_archives"] = {}
+
+# Queue Simulation
+####################################################################################################
+# collect the setup congiuration into dict "param", prepare to transport into do_simulation(param) #
+####################################################################################################
+sim_interval = 10
+
+# openning hour 24 h
+# if selection_time == "24/7":
+
+sim_days = 1
+sim_ticks = int(sim_days * 24 * 60 * 60 / sim_interval)
+
+# update random user queue param generation 11.11.2022 by Hao Liu
+if user_queue_mode == "random":
+    param = {
+        "station_type" : station_type,                                      # set up the BSS type GEN3_600kW, GEN3_1200kW
+        "psc_num" : bsc_num,                                                # set up the BSC number according to the type of BSS
+        "battery_config" : battery_config,                                  # set up the battery configuration in a swap rack module
+        "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
+        "target_soc" : target_soc,                                          # set up the charge target soc
+        "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
+        "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
+        "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
+        "sim_days" : sim_days,                                              # set up the simulation day loop
+        "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
+        "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
+        "swap_rack_temperature" : 25,                                       # set up the rack temperature
+        "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
+                                                                            # "statistical" generate user sequence based on real statistical data
+        "user_area" : user_area,                                            # set up the simulation area for statistical mode
+        "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
+        "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
+                                                                            # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
+        "enable_me_switch" : 1,                                             # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
+        "power_dist_option" : power_dist_option,                            # define which facility has higher power dist priority BSS or BSC
+        "service_ratio": user_selection_ratio,                              # when select fixed ratio of service, configure the specific value
+        "grid_interaction_idx" : grid_interaction_interval_idx,             # the time interval of execution of grid interaction, -1 -> service deactivated
+        "interaction_num" : interaction_num,                                # define the times that interaction will perform
+        "swap_time" : swap_time,                                             # configure the swap time
+        "swap_lanes" : int(swap_lanes),                                     # swap platforms working in parallel
+        "user_abandonment" : user_abandonment,                              # users balk at long queues, renege and leave the piles early
+        "max_wait_number" : int(max_wait_number),                           # longest queue a user joins
+        "user_patience" : user_patience,                                    # patience in the queues [min]
+        "max_charge_time" : max_charge_time if max_charge_time > 0 else -1, # charge time limit at the piles [min], -1 no limit
+        "charge_queue_discipline" : charge_queue_discipline,                # order of the charge queue
+        "reserved_piles" : int(reserved_piles),                             # piles kept for BS users in "reservation"
+        "power_cap" : power_cap,                                            # station power limit [kW], None no limit
+        "opening_hours":selection_time,
+        "seed" : int(random_seed) if random_seed > 0 else None,             # fixed seed for reproducible runs, None -> random
+        "warm_start" : warm_start,                                          # start from the warm station library of warmup.py
+        "truncate_warmup" : truncate_warmup                                 # averages only count users after the detected warm-up
+    }
 
-        # openning hour 24 h
-        # if selection_time == "24/7":
+else:
+    param = {
+        "station_type" : station_type,                                      # set up the BSS type GEN3_600kW, GEN3_1200kW
+        "psc_num" : bsc_num,                                                # set up the BSC number according to the type of BSS
+        "battery_config" : battery_config,                                  # set up the battery configuration in a swap rack module
+        "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
+        "target_soc" : target_soc,                                          # set up the charge target soc
+        "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
+        "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
+        "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
+        "sim_days" : sim_days,                                              # set up the simulation day loop
+        "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
+        "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
+        "swap_rack_temperature" : 25,                                       # set up the rack temperature
+        "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
+                                                                            # "statistical" generate user sequence based on real statistical data
+        "user_area" : user_area,                                            # set up the simulation area for statistical mode
+        "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
+        "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
+                                                                            # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
+        "enable_me_switch" : 1,                                             # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
+        "power_dist_option" : power_dist_option,                            # define which facility has higher power dist priority BSS or BSC
+        "service_ratio": user_selection_ratio,                              # when select fixed ratio of service, configure the specific value
+        "grid_interaction_idx" : grid_interaction_interval_idx,             # the time interval of execution of grid interaction, -1 -> service deactivated
+        "interaction_num" : interaction_num,                                # define the times that interaction will perform
+        "swap_time" : swap_time,                                             # configure the swap time
+        "swap_lanes" : int(swap_lanes),                                     # swap platforms working in parallel
+        "user_abandonment" : user_abandonment,                              # users balk at long queues, renege and leave the piles early
+        "max_wait_number" : int(max_wait_number),                           # longest queue a user joins
+        "user_patience" : user_patience,                                    # patience in the queues [min]
+        "max_charge_time" : max_charge_time if max_charge_time > 0 else -1, # charge time limit at the piles [min], -1 no limit
+        "charge_queue_discipline" : charge_queue_discipline,                # order of the charge queue
+        "reserved_piles" : int(reserved_piles),                             # piles kept for BS users in "reservation"
+        "power_cap" : power_cap,                                            # station power limit [kW], None no limit
+        "opening_hours":"24h",
+        "seed" : int(random_seed) if random_seed > 0 else None,             # fixed seed for reproducible runs, None -> random
+        "warm_start" : warm_start,                                          # start from the warm station library of warmup.py
+        "truncate_warmup" : truncate_warmup                                 # averages only count users after the detected warm-up
+    }
 
-        sim_days = 1
-        sim_ticks = int(sim_days * 24 * 60 * 60 / sim_interval)
+datalog_param = {
+    "station_type" : type_bss,                                          # set up the BSS type GEN3_600kW, GEN3_1200kW
+    "psc_num" : bsc_num,
+    "battery_type1" : list(battery_config.keys())[0],                   # set up the battery configuration in a swap rack module
+    "num_battery_type1" : list(battery_config.values())[0],
+    "battery_type2" : list(battery_config.keys())[1],  
+    "num_battery_type2" : list(battery_config.values())[1],
+    "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
+    "target_soc" : target_soc,                                          # set up the charge target soc
+    "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
+    "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
+    "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
+    "sim_days" : sim_days,                                              # set up the simulation day loop
+    "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
+    "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
+    "swap_rack_temperature" : 25,                                       # set up the rack temperature
+    "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
+                                                                        # "statistical" generate user sequence based on real statistical data
+    "user_area" : user_area,                                            # set up the simulation area for statistical mode
+    "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
+    "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
+                                                                        # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
+    "enable_me_switch" : 1                                              # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
+}
+
+# instant estimate of the results by the surrogate model of surrogate.py, trained on request around the current setup
+@st.cache_resource
+def load_surrogate(path, mtime):
+    return surrogate.Surrogate.load(path)
+
+def train_surrogate(base):
+    '''
+    task function of the surrogate training, runs in a thread of the server (see jobs.submit_task)
+    '''
+    def task(report):
+        def sweep_progress(done, total):
+            report(done / total, "%d of %d setups simulated" % (done, total))
+        surrogate.train(base, executor=jobs.pool(), progress_callback=sweep_progress).save()
+    return task
+
+def show_surrogate_job():
+    '''
+    progress of the surrogate training of this session, the page is rerun to load the model once it is saved
+    '''
+    job = st.session_state["surrogate_job"]
+    status = job.status
+    if status in ("queued", "running"):
+        st.progress(job.progress(), text=job.text or "training the estimator...")
+        if st.button("Cancel", key="cancel_surrogate_%d" % job.id):
+            job.cancel()
+        return
+    del st.session_state["surrogate_job"]
+    if status == "failed":
+        st.session_state["surrogate_error"] = str(job.error())
+    st.rerun()
 
-        # update random user queue param generation 11.11.2022 by Hao Liu
-        if user_queue_mode == "random":
-            param = {
-                "station_type" : station_type,                                      # set up the BSS type GEN3_600kW, GEN3_1200kW
-                "psc_num" : bsc_num,                                                # set up the BSC number according to the type of BSS
-                "battery_config" : battery_config,                                  # set up the battery configuration in a swap rack module
-                "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
-                "target_soc" : target_soc,                                          # set up the charge target soc
-                "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
-                "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
-                "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
-                "sim_days" : sim_days,                                              # set up the simulation day loop
-                "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
-                "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
-                "swap_rack_temperature" : 25,                                       # set up the rack temperature
-                "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
-                                                                                    # "statistical" generate user sequence based on real statistical data
-                "user_area" : user_area,                                            # set up the simulation area for statistical mode
-                "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
-                "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
-                                                                                    # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
-                "enable_me_switch" : 1,                                             # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
-                "power_dist_option" : power_dist_option,                            # define which facility has higher power dist priority BSS or BSC
-                "service_ratio": user_selection_ratio,                              # when select fixed ratio of service, configure the specific value
-                "grid_interaction_idx" : grid_interaction_interval_idx,             # the time interval of execution of grid interaction, -1 -> service deactivated
-                "interaction_num" : interaction_num,                                # define the times that interaction will perform
-                "swap_time" : swap_time,                                             # configure the swap time
-                "opening_hours":selection_time
-            }
+with col_m1:
+    st.markdown("### Instant estimate")
+    surrogate_model = None
+    domain_reason = "no estimator trained yet"
+    if os.path.exists(surrogate.MODEL_PATH):
+        try:
+            surrogate_model = load_surrogate(surrogate.MODEL_PATH, os.path.getmtime(surrogate.MODEL_PATH))
+        except OSError as e:
+            domain_reason = "estimator not loaded: %s" % e
+    in_domain, domain_reason = (False, domain_reason) if surrogate_model is None else surrogate_model.in_domain(param)
+    if in_domain:
+        estimate = surrogate_model.predict(param)
+        col_e1, col_e2, col_e3, col_e4 = st.columns(4)
+        col_e1.metric("Swap ratio in 15 min", "%.2f" % estimate["swap_ratio_in_15_min"][0], "± %.2f" % estimate["swap_ratio_in_15_min"][1], delta_color="off")
+        col_e2.metric("Average swap time [min]", "%.1f" % estimate["average_time_swap"][0], "± %.1f" % estimate["average_time_swap"][1], delta_color="off")
+        col_e3.metric("Overflow", "%.0f" % estimate["overflow"][0], "± %.0f" % estimate["overflow"][1], delta_color="off")
+        col_e4.metric("Energy [kWh]", "%.0f" % estimate["energy"][0], "± %.0f" % estimate["energy"][1], delta_color="off")
+        st.caption("Estimated by the surrogate model, confirm with the simulation.")
+    else:
+        st.caption("No instant estimate (%s), start the simulation for the results." % domain_reason)
+    help_train = "Simulate %d setups around the current one in the background pool and train the estimator on them (takes some minutes)." % surrogate.SWEEP_POINTS
+    if "surrogate_job" not in st.session_state:
+        if st.button("Train the instant estimator around this setup", help=help_train):
+            # the training runs in the background, the model is loaded once it is saved
+            st.session_state.pop("surrogate_error", None)
+            st.session_state["surrogate_job"] = jobs.submit_task(train_surrogate(param), label="surrogate training")
+            st.rerun()
+    else:
+        st.fragment(run_every = 1)(show_surrogate_job)()
+    if "surrogate_error" in st.session_state:
+        st.error("training failed: %s" % st.session_state["surrogate_error"])
 
-        else:
-            param = {
-                "station_type" : station_type,                                      # set up the BSS type GEN3_600kW, GEN3_1200kW
-                "psc_num" : bsc_num,                                                # set up the BSC number according to the type of BSS
-                "battery_config" : battery_config,                                  # set up the battery configuration in a swap rack module
-                "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
-                "target_soc" : target_soc,                                          # set up the charge target soc
-                "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
-                "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
-                "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
-                "sim_days" : sim_days,                                              # set up the simulation day loop
-                "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
-                "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
-                "swap_rack_temperature" : 25,                                       # set up the rack temperature
-                "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
-                                                                                    # "statistical" generate user sequence based on real statistical data
-                "user_area" : user_area,                                            # set up the simulation area for statistical mode
-                "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
-                "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
-                                                                                    # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
-                "enable_me_switch" : 1,                                             # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
-                "power_dist_option" : power_dist_option,                            # define which facility has higher power dist priority BSS or BSC
-                "service_ratio": user_selection_ratio,                              # when select fixed ratio of service, configure the specific value
-                "grid_interaction_idx" : grid_interaction_interval_idx,             # the time interval of execution of grid interaction, -1 -> service deactivated
-                "interaction_num" : interaction_num,                                # define the times that interaction will perform
-                "swap_time" : swap_time,                                             # configure the swap time
-                "opening_hours":"24h"
-            }
+if button_flag_1 == True:
+    with st.spinner("simulation submitting..."):
+        # perform simulation in the background, the script thread returns at once and the job panel below shows the progress
+        job = jobs.submit(param = param, label = "%s, %d BS / %d NBS users" % (type_bss, swapping_user_num, non_swapping_user_num),
+                          export_dir = tempfile.mkdtemp(prefix="bss_job_") if record_results else None,
+                          meta = {"select_module" : select_module if user_queue_mode == "random" else 1.0,
+                                  "user_queue_mode" : user_queue_mode,
+                                  "datalog_param" : datalog_param})
+        st.session_state["sim_jobs"].append(job)
+
+def job_title(job):
+    return "#%d %s" % (job.id, job.label)
+
+def release_export_dir(job):
+    '''
+    pack the recorded files of a finished job into the session and remove its temporary folder
+    '''
+    if job.export_dir is None or not os.path.isdir(job.export_dir):
+        return
+    if job.status == "done":
+        st.session_state["result_archives"][job.id] = export.archive(job.export_dir)
+    shutil.rmtree(job.export_dir, ignore_errors=True)
+
+def show_simulation_jobs():
+    '''
+    list the simulations of this session with their progress, running ones can be cancelled
+    '''
+    for job in reversed(st.session_state["sim_jobs"]):
+        status = job.status
+        if job.done():
+            release_export_dir(job)
+        col_job, col_cancel = st.columns([5,1])
+        col_job.progress(job.progress(), text="%s: %s" % (job_title(job), status))
+        if status in ("queued", "running"):
+            if col_cancel.button("Cancel", key="cancel_job_%d" % job.id):
+                job.cancel()
+        elif status == "failed":
+            col_job.error("simulation failed: %s" % job.error())
+        if status == "done" and job.id not in st.session_state["finished_jobs"]:
+            # a job finished since the last poll, rerun the whole page to show its results
+            st.session_state["finished_jobs"].add(job.id)
+            st.rerun()
+
+result_job = None
+with success_info_single_station:
+    # poll the job panel every second while simulations are running, without rerunning the whole page
+    active = any(not job.done() for job in st.session_state["sim_jobs"])
+    st.fragment(run_every = 1 if active else None)(show_simulation_jobs)()
+    finished = {job.id: job for job in reversed(st.session_state["sim_jobs"]) if job.status == "done"}
+    if len(finished) != 0:
+        # widgets copy their options, so the selection goes by job id
+        result_id = st.selectbox("Show the results of simulation", list(finished), index=0, format_func=lambda job_id: job_title(finished[job_id]))
+        result_job = finished[result_id]
+
+if result_job is not None:
+    with st.spinner("results preparing..."):
+        # settings the job was started with
+        param = result_job.param
+        sim_interval = param["sim_interval"]
+        sim_days = param["sim_days"]
+        sim_ticks = param["sim_ticks"]
+        select_module = result_job.meta["select_module"]
+        user_queue_mode = result_job.meta["user_queue_mode"]
 
         # container preparation
         user_dist_lst = []
@@ -508,7 +722,6 @@ if button_flag_1 == True:
         swap_list = []
         swap_charge_list = []
         non_swap_charge_list = []
-        power_mean_list = []
         max_power = 0
         BS_average_time_charge = 0       #BS - Battery swapping ability
         NBS_average_time_chagre = 0  #NBS - Non Battery swapping ability
@@ -519,20 +732,23 @@ if button_flag_1 == True:
         queue_overflow_number = []
         queue_overflow_ratio = 0
 
-        # perform simulation 
+        # collect the simulation result
         swap_user_wait_time, charge_user_wait_time, queue_length_swap, queue_length_charge, user_dist_lst, max_power, power_history, residual_power, swap_list, \
-        swap_charge_list, non_swap_charge_list, average_time_swap, BS_average_time_charge, non_BS_average_time_chagre, swap_ratio_in_15_min = main.do_simulation(param = param)
+        swap_charge_list, non_swap_charge_list, average_time_swap, BS_average_time_charge, non_BS_average_time_chagre, swap_ratio_in_15_min, abandonment = result_job.result()
 
         ### New fixed" add power module allocation factor"
 
 
-        # 1. calculate time step
-        day_step = sim_days + 1
-        date1 = datetime.date(2022,1,1)
-        date2 = datetime.date(2022,1,day_step)
-        delta = datetime.timedelta(seconds = sim_interval)
-        dates = mdates.drange(date1, date2, delta)
-        
+        import pandas as pd
+
+        # 1. chart data, reduced once per job (binned histograms, downsampled series)
+        if result_job.id not in st.session_state["result_charts"]:
+            chart_data = charts.prepare_chart_data(swap_user_wait_time, charge_user_wait_time, queue_length_swap, queue_length_charge,
+                                                   user_dist_lst, max_power, power_history, swap_list, swap_charge_list,
+                                                   non_swap_charge_list, sim_ticks, sim_interval)
+            st.session_state["result_charts"][result_job.id] = charts.build_result_charts(chart_data)
+        result_charts = st.session_state["result_charts"][result_job.id]
+
         # 2. success ratio within 15 min
         ratio_persentage = swap_ratio_in_15_min * 100
 
@@ -549,10 +765,6 @@ if button_flag_1 == True:
                 y_grid_func.append(pw[1])
             
         
-        power_mean = np.mean(y_func)
-        for i in range(len(dates)):
-            # collect the mean value of the power distribution
-            power_mean_list.append(power_mean)      
         total_energy = energy_calc(y_func, sim_interval)
         grid_interaction_energy = abs(energy_calc(y_grid_func, sim_interval))
 
@@ -624,6 +836,12 @@ if button_flag_1 == True:
                 "Average Charge Time for NBS Group [minutes]" : non_BS_average_time_chagre,
                 "Average Charge Time for NBS Group [1/hours]" : non_BS_charge_rate
             }
+        if param.get("user_abandonment"):
+            result_data["Swap Clients Balked"] = abandonment["balked_swap"]
+            result_data["Charge Clients Balked"] = abandonment["balked_charge"]
+            result_data["Swap Clients Reneged"] = abandonment["reneged_swap"]
+            result_data["Charge Clients Reneged"] = abandonment["reneged_charge"]
+            result_data["Charge Time Limit Reached"] = abandonment["pile_timeouts"]
 
         result_data = pd.DataFrame.from_dict(result_data, orient='index', columns=['Values'])
         result_data = result_data.reset_index().rename(columns={'index': 'Key Characteristics'})
@@ -647,7 +865,7 @@ st.write("")
 
 with single_station_result:
     # Set up the text and statistics results for single station
-    if button_flag_1 == False:
+    if result_job is None:
         # by default the subplot results don't show in the panel
         pass
     else:
@@ -662,228 +880,57 @@ with single_station_result:
         st.write("")
         st.write("")
 
-        # devide the plots into 2 columns
+        # devide the plots into 2 columns, the charts are rendered and redrawn by the browser
         col1, col2 = st.columns(2)
         col3, col4 = st.columns(2)
         col5, col6 = st.columns(2)
-        col7, col8 = st.columns(2) 
-        # Set the plot diagram into black background and white font
-        plt.style.use('dark_background')
-
-        with col1: # arrvie time dist
-            ################################################################
-            ############## 1. show the user distribution ###################
-            ################################################################
-            fig1, ax1 = plt.subplots(figsize=(7, 5))
-            ###fixed by Hao
-
-            time_dist = [dt.fromtimestamp(s) for s in user_dist_lst]
-            ax1.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-            ax1.tick_params(axis="both",direction = "out", labelsize= 10)
-            ax1.hist(x = time_dist, bins = 48, color = "#005293", edgecolor = "black")
-            #原 1969 12 31 23 和 1971 1 2 1
-            plt.xlim([dt(1969, 12, 31, 23),dt(1970, 1, 2, 0)]) # 日期上下限
-            plt.xlabel("Time ticks")
-            plt.ylabel("User number in half hour, user total number = " + '%d' %len(user_dist_lst))
-            plt.title("User vehicles reach time distribution")
-            plt.grid(True, linestyle=":")
-            # fig1.autofmt_xdate()
-            st.pyplot(fig1)
-
-        with col3: # charge service time dist
-            ################################################################
-            ############## 3. show the charge time in sim ticks ############
-            ################################################################
-            fig3, ax3 = plt.subplots(figsize=(7, 5))
-            BS_charge_dist = []
-            non_BS_charge_dist = []
-            for i in range(sim_ticks):
-                for user in swap_charge_list:
-                    if user.sequence == i:
-                        # mode = 1 wait time + charge time; mode = 0 only charge time
-                        BS_charge_dist.append(user.charge_service_time() * sim_interval / 60.0)
-                        break
-                for user in non_swap_charge_list:
-                    if user.sequence == i:
-                        non_BS_charge_dist.append(user.charge_service_time() * sim_interval / 60.0)
-            
-            ax3.hist([BS_charge_dist, non_BS_charge_dist], bins=15, color = ["#005293", "#98C6EA"],\
-                edgecolor = "black", label=['BS user', 'NBS user'])
-            plt.xlabel("Charge service time in [min]")
-            plt.ylabel("Counts")
-            plt.title("Charge service time (Charge + Wait) distribution in 24 hours")
-            plt.grid(True, linestyle=":")
-            plt.legend(loc='upper right')
-            st.pyplot(fig3)
-
-        with col5: # charge time (No wait time)
-            ################################################################
-            ############## 5. show the charge time in sim ticks ############
-            ################################################################
-            fig5, ax5 = plt.subplots(figsize=(7, 5))
-            BS_charge_dist = []
-            non_BS_charge_dist = []
-            for i in range(sim_ticks):
-                for user in swap_charge_list:
-                    if user.sequence == i:
-                        # mode = 1 wait time + charge time; mode = 0 only charge time
-                        BS_charge_dist.append(user.charge_service_time(mode=0) * sim_interval / 60.0)
-                        break
-                for user in non_swap_charge_list:
-                    if user.sequence == i:
-                        non_BS_charge_dist.append(user.charge_service_time(mode=0) * sim_interval / 60.0)
-            
-            ax5.hist([BS_charge_dist, non_BS_charge_dist], bins=15, color = ["#005293", "#98C6EA"],\
-                edgecolor = "black", label=['BS user', 'NBS user'])
-            plt.xlabel("Charge time distribution in [min]")
-            plt.ylabel("Counts")
-            plt.title("Charge time (without Wait) distribution in 24 hours")
-            plt.grid(True, linestyle=":")
-            plt.legend(loc='upper right')
-            st.pyplot(fig5)
-
-        with col7: # user num ratio
-            # ################################################################
-            # ############## 5. show the clients ratio #######################
-            # ################################################################
-            fig7, ax7 = plt.subplots(figsize=(7, 5), subplot_kw=dict(aspect="equal"))
-            label = ["swap", "charge(BS)", "charge(NBS)"]
-            data = [len(swap_list), len(swap_charge_list), len(non_swap_charge_list)]
-            colors = ["#005293", "#64A0C8", "#98C6EA"]
-            wedges, texts, persent = ax7.pie(data, wedgeprops=dict(width=0.7), startangle=45, colors=colors, autopct="%.2f%%")
-            bbox_props = dict(boxstyle="square,pad=0.3", fc="k", ec="k", lw=0.72) # fc=facecolor, ec=edgecolor
-            kw = dict(arrowprops=dict(arrowstyle="-"), bbox=bbox_props, zorder=0, va="center")
-
-            for i, p in enumerate(wedges):
-                ang = (p.theta2 - p.theta1)/2. + p.theta1
-                y = np.sin(np.deg2rad(ang))
-                x = np.cos(np.deg2rad(ang))
-                horizontalalignment = {-1: "right", 1: "left"}[int(np.sign(x))]
-                connectionstyle = "angle,angleA=0,angleB={}".format(ang)
-                kw["arrowprops"].update({"connectionstyle": connectionstyle})
-                ax7.annotate(label[i], xy=(x, y), xytext=(1.35*np.sign(x), 1.4*y),
-                            horizontalalignment=horizontalalignment, **kw)
-            ax7.set_title("Clients Ratio")
-            st.pyplot(fig7)
-
-        with col2: # power dist
-            ################################################################
-            ############## 2. show the max power distribution ##############
-            ################################################################
-            fig2, ax2 = plt.subplots(figsize=(7, 5))
-            y_plot1 = y_func
-            y_plot2 = y_grid_func
-            ax2.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-            ax2.tick_params(axis="both",direction = "out", labelsize= 10)
-            ax2.plot_date(dates, y_plot1, "#64A0C8", label="Power Distribution")
-            ax2.plot_date(dates, y_plot2, "red",":", alpha=0.5, label="Grid Interaction")
-            ax2.plot_date(dates, power_mean_list, '--', color="#98C6EA")
-            ax2.text(x=dates[0], y=power_mean+10, s="Mean %.2f [kW]"%round(power_mean,2))
-            plt.xlim([dt(2021, 12, 31, 23),dt(2022, 1, 2, 1)]) 
-            plt.xlabel("Time series")
-            plt.ylabel("BSS total power, max power = " + '%.0f kW' %max_power)
-            plt.title("BSS Power distribution")
-            plt.grid(True, linestyle=":")
-            plt.legend()
-            st.pyplot(fig2)
-
-        with col4: # swap time dist
-            ################################################################
-            ############## 4. show the swap time in sim ticks ##############
-            ################################################################
-            fig4, ax4 = plt.subplots(figsize=(7, 5))
-            y_plot = []
-            recorded = 0
-            for i in range(sim_ticks):
-                for user in swap_list:
-                    if user.sequence == i:
-                        y_plot.append(user.swap_service_time * sim_interval / 60.0)
-                        break
-            ax4.hist(y_plot, bins=30, color = "#005293", edgecolor = "black")
-            plt.xlabel("Swap service time in [min]")
-            plt.ylabel("Counts")
-            plt.title("Swap service time (Swap + Wait) distribution in 24 hours")
-            plt.grid(True, linestyle=":")
-            st.pyplot(fig4)
-
-        with col6: # wait time distribution
-
-            ################################################################
-            ############## 6. show the wait time distribution ##############
-            ################################################################
-            fig6, ax6 = plt.subplots(figsize=(7, 5))
-            ax6.hist([swap_user_wait_time, charge_user_wait_time], bins=15, color = ["#005293", "#64A0C8"],\
-                edgecolor = "black", label=["Swap Group Wait Time", "Charge Group Wait Time"])
-            plt.xlabel("Wait time distribution [min]")
-            # set the interval btw 2 ticks of y axis
-            x_major_locator = MultipleLocator(10)
-            y_major_locator = MultipleLocator(5)
-            ax6.yaxis.set_major_locator(y_major_locator)
-            ax6.xaxis.set_major_locator(x_major_locator)
-            plt.ylabel("Counts")
-            plt.title("Wait time distribution")
-            plt.grid(True, linestyle=":")
-            plt.legend()
-            st.pyplot(fig6)
-    
-        with col8: # queue length
-            ################################################################
-            ############## 8. show the Queue length distribution ###########
-            ################################################################
-            fig8, ax8 = plt.subplots(figsize=(7, 5))
-            ax8.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-            ax8.tick_params(axis="both",direction = "out", labelsize= 10)
-            ax8.plot_date(dates, queue_length_swap, "#005293", label="Swap Queue")
-            ax8.plot_date(dates, queue_length_charge, "#64A0C8", label="Charge Queue")
-            plt.xlim([dt(2021, 12, 31, 23),dt(2022, 1, 2, 1)]) # 日期上下限
-            # set the interval btw 2 ticks of y axis
-            y_major_locator = MultipleLocator(2)
-            ax8.yaxis.set_major_locator(y_major_locator)
-            plt.xlabel("Time series")
-            plt.ylabel("Queue length")
-            plt.title("Queue length distribution")
-            plt.grid(True, linestyle=":")
-            plt.legend()
-            st.pyplot(fig8)
+        col7, col8 = st.columns(2)
 
-
-            
+        ################################################################
+        ############## 1. show the user distribution ###################
+        ################################################################
+        col1.altair_chart(result_charts["arrival"], use_container_width=True)
+        ################################################################
+        ############## 2. show the max power distribution ##############
+        ################################################################
+        col2.altair_chart(result_charts["power"], use_container_width=True)
+        ################################################################
+        ############## 3. show the charge time in sim ticks ############
+        ################################################################
+        col3.altair_chart(result_charts["charge_service"], use_container_width=True)
+        ################################################################
+        ############## 4. show the swap time in sim ticks ##############
+        ################################################################
+        col4.altair_chart(result_charts["swap_service"], use_container_width=True)
+        ################################################################
+        ############## 5. show the charge time in sim ticks ############
+        ################################################################
+        col5.altair_chart(result_charts["charge_time"], use_container_width=True)
+        ################################################################
+        ############## 6. show the wait time distribution ##############
+        ################################################################
+        col6.altair_chart(result_charts["wait"], use_container_width=True)
+        ################################################################
+        ############## 7. show the clients ratio #######################
+        ################################################################
+        col7.altair_chart(result_charts["clients"], use_container_width=True)
+        ################################################################
+        ############## 8. show the Queue length distribution ###########
+        ################################################################
+        col8.altair_chart(result_charts["queue"], use_container_width=True)
 
     ################################################################
     #################### Download Config ###########################
     ################################################################
 
-    if button_flag_1 == False:
+    if result_job is None:
         st.empty()
     else:
         st.markdown("# Step 4: Results Download")
         st.write("Press the button to download the datalog")
         st.markdown("# ")
-        param = {
-        "station_type" : type_bss,                                          # set up the BSS type GEN3_600kW, GEN3_1200kW
-        "psc_num" : bsc_num,
-        "battery_type1" : list(battery_config.keys())[0],                   # set up the battery configuration in a swap rack module
-        "num_battery_type1" : list(battery_config.values())[0],
-        "battery_type2" : list(battery_config.keys())[1],  
-        "num_battery_type2" : list(battery_config.values())[1],
-        "init_battery_soc_in_BSS" : init_battery_soc,                       # set up the initial battery soc in BSS
-        "target_soc" : target_soc,                                          # set up the charge target soc
-        "select_soc" : select_soc,                                          # set up the which soc of battery in BSS will be selected to swap
-        "BS_user_num" : swapping_user_num,                                      # set up how many users in a day will use the BSS
-        "non_BS_user_num" : non_swapping_user_num,                              # set up the number of non BS user
-        "sim_days" : sim_days,                                              # set up the simulation day loop
-        "sim_interval" : sim_interval,                                      # set up the simulation interval, unit: sec
-        "sim_ticks" : sim_ticks,                                            # calculate how many simulation bins in a day loop
-        "swap_rack_temperature" : 25,                                       # set up the rack temperature
-        "user_sequence_mode" : user_queue_mode,                             # "random" for random sequence create based on distribution defined by user_sequence_random_file
-                                                                            # "statistical" generate user sequence based on real statistical data
-        "user_area" : user_area,                                            # set up the simulation area for statistical mode
-        "user_preference" : user_preference,                                # define the user selection preference in markov, full swap, or fixed value (70% swap, and 30% charge)
-        "charge_power_redist" : False,                                      # True: modules will be redistributed after every sim interval, if there exists charging pile, they will be disconnected
-                                                                            # False: modules once be connected to outer charging piles, they are not allowed be disconnected until vehicle leaves
-        "enable_me_switch" : 1                                              # define whether the transport btw the battery rack is allowed, 1 means allowable, 0 not allowable
-    }
-        param_df = pd.DataFrame.from_dict(param, orient='index', columns=['Values'])
+        import pandas as pd
+        param_df = pd.DataFrame.from_dict(result_job.meta["datalog_param"], orient='index', columns=['Values'])
         param_df = param_df.reset_index().rename(columns={'index': 'Parameters'})
         frames = [param_df, result_data]
         result = pd.concat(frames,axis=1)
@@ -899,6 +946,15 @@ with single_station_result:
                 file_name='datalog.csv',
                 mime='text/csv',
             )
+            # full traces and per-user outcomes of the run, packed when the job finished (see release_export_dir)
+            if result_job.id in st.session_state["result_archives"]:
+                st.download_button(
+                    label="Download Full Results",
+                    data=st.session_state["result_archives"][result_job.id],
+                    file_name='bss_results_%d.zip' % result_job.id,
+                    mime='application/zip',
+                    help="Traces (power, queue length, SOC per rack) and per user outcomes as %s tables" % export.default_format(),
+                )
             st.write("================")
 
 ###########################
@@ -911,107 +967,34 @@ with single_station_result:
 ################################################################
 #################### Sidebar Notation ##########################
 ################################################################
-# ========= Set up the BSS selection Recommendation (sidebar) =======
+# ========= Set up the BSS sizing recommendation (sidebar) =======
+# the recommendation is searched with simulations of the candidate designs, see sizing.py
 st.sidebar.markdown("# BSS Power Assistant")
 st.sidebar.write("")
-st.sidebar.markdown("## Set up your BSS proporties:")
-BSS_type = ["BSS Type-1 - 500kW", "BSS Type-2 V1 - 600kW", "BSS Type-2 V2 - 1200kW"]
-power_level = [100, 200, 300, 550, 630, 1250]
-BSS_select = None
-power_select = 0
-
-# Peak swap number
-help1 = "BSC not included"
-st.sidebar.write("")
-st.sidebar.markdown("### Peak Swapping Number (Morning)")
-ans1 = st.sidebar.slider("Select the expected peak swapping number (morning)/hour", min_value=0, max_value=20, help=help1)
-
-# Peak charge number
-st.sidebar.write("")
-st.sidebar.markdown("### Peak Charging Number")
-ans2 = st.sidebar.slider("Select the expected peak charging number/hour", min_value=0, max_value=18, help=help1)
+st.sidebar.markdown("## Set up your demand:")
 
-# Peak swap day time
+# daily swap and charge users
+help1 = "The number of daily swapping clients"
 st.sidebar.write("")
-st.sidebar.markdown("### Peak Swapping Number (Day time)")
-ans3 = st.sidebar.slider("Select the expected peak swapping number (day time)/hour", min_value=0, max_value=13, help=help1)
-
-# Swap service capacity
-help2 = "The number of daily swapping clients"
-st.sidebar.write("")
-st.sidebar.markdown("### Daily Swapping Capacity")
-ans4 = st.sidebar.number_input("Give the daily swapping number capacity", min_value=0, max_value=150, step=5, value=50, help=help2)
+st.sidebar.markdown("### Daily Swapping Clients")
+ans1 = st.sidebar.number_input("Give the daily swapping number", min_value=5, max_value=300, step=5, value=60, help=help1)
 
 # BSC required
 st.sidebar.write("")
 st.sidebar.markdown("### Is Battery Station Charger(BSC) Required?")
-ans5 = st.sidebar.checkbox("BSC required")
-
-##########################################
-############ Logic inference #############
-##########################################
-# first for BSS Type - 1
-if ans1 <= 13 and ans2 <= 8 and ans3 <= 8 and ans4 <= 93 and ans5 == False:
-    BSS_select = BSS_type[0]
-    if ans2 <= 2 and ans3 <=2 and ans4 <= 33:
-        power_select = power_level[0]
-    elif (ans2 == 3 or ans3 == 3 or ans4 > 33) and ans4 <= 43:
-        power_select = power_level[1]
-    elif (ans2 > 3 or ans3 > 3 or ans4 > 43) and ans2 <= 5 and ans3 <= 5 and ans4 <= 63:
-        power_select = power_level[2]
-    else:
-        power_select = power_level[3]
-# second for BSS Type - 2
+ans2 = st.sidebar.checkbox("BSC required")
+if ans2:
+    ans3 = st.sidebar.number_input("Give the daily charging number of non BS clients", min_value=1, max_value=100, step=1, value=20)
 else:
-    if ans2 <= 3 and ans3 <= 3 and ans4 <= 50 and ans5 == False:
-        BSS_select = BSS_type[1]
-        power_select = power_level[1]
-    elif (ans2 > 3 or ans3 > 3 or ans4 > 50) and ans2 <=5 and ans3 <= 5 and ans4 <= 70 and ans5 == False:
-        BSS_select = BSS_type[1]
-        power_select = power_level[2]
-    elif (ans2 > 5 or ans3 > 5 or ans4 > 70) and ans2 <=9 and ans3 <= 9 and ans4 <= 110:
-        BSS_select = BSS_type[1]
-        power_select = power_level[4]
-    else:
-        BSS_select = BSS_type[2]
-        power_select = power_level[5]
+    ans3 = 0
 
-##########################################
-############ Data Collection #############
-##########################################
-# Summary of BSS configurations
-BSS_data = {"station_type":         None, 
-            "num_battery":          0, 
-            "BSC":                  None, 
-            "num_charge_piles":     0, 
-            "transformer_power":    0       
-            }
-BSS_data["station_type"] = BSS_select
-BSS_data["transformer_power"] = power_select
-
-# BSS Type-1
-if BSS_data["station_type"] == "BSS Type-1 - 500kW": 
-    BSS_data["station_type"] = "BSS Type-1 or above"
-    BSS_data["num_battery"] = 13
-    BSS_data["bsc"] = "No BSC"
-    BSS_data["num_charge_piles"] = 0
-# BSS Type-2
-elif BSS_data["station_type"] == "BSS Type-2 V1 - 600kW": 
-    BSS_data["num_battery"] = 10
-    if ans5:
-        BSS_data["BSC"] = "BSC equipped"
-    else:
-        BSS_data["BSC"] = "No BSC"
-    
-    if BSS_data["transformer_power"] <= 300:
-        BSS_data["num_charge_piles"] = 0
-    else:
-        BSS_data["num_charge_piles"] = 4
-# BSS 3.0 PUS B
-else:
-    BSS_data["num_battery"] = 20
-    BSS_data["BSC"] = "BSC equipped"
-    BSS_data["num_charge_piles"] = 8
+# service targets
+help2 = "Share of swapping clients served within 15 min"
+st.sidebar.write("")
+st.sidebar.markdown("### Service Targets")
+ans4 = st.sidebar.slider("Minimal swap ratio within 15 min", min_value=0.5, max_value=1.0, value=sizing.TARGET_SWAP_RATIO, step=0.01, help=help2)
+help3 = "Swapping clients still waiting at the end of the day"
+ans5 = st.sidebar.number_input("Maximal overflow of swapping clients", min_value=0, max_value=50, value=sizing.MAX_OVERFLOW, step=1, help=help3)
 
 ##########################################
 ############ Suggestion ##################
@@ -1020,34 +1003,85 @@ else:
 st.sidebar.write("")
 st.sidebar.write("")
 st.sidebar.markdown("## Suggestion:")
-st.sidebar.write("Press the button to get advice")
+st.sidebar.write("Press the button to search the cheapest design with simulations (takes up to a few minutes)")
 _, col_m, _ = st.sidebar.columns([1,2,1])
 trigger_btn = col_m.button("Suggestion")
 
-col21, col22 = st.sidebar.columns([2,1])
-col23, col24 = st.sidebar.columns([2,1])
-col25, col26 = st.sidebar.columns([2,1])
-col27, col28 = st.sidebar.columns([2,1])
-col29, col30 = st.sidebar.columns([2,1])
-
-if trigger_btn == False:
-    st.empty()
-else:
-    col21.info("BSS Type: ")
-    col22.markdown("### %s" %BSS_data["station_type"])
-    st.write("")
-    col23.info("Maximal allowable number of Battery Racks: ")
-    col24.markdown("### %d" %BSS_data["num_battery"])
-    st.write("")
-    col25.info("Maximal allowable number of Charge Terminals: ")
-    col26.markdown("### %d" %BSS_data["num_charge_piles"])
-    st.write("")
-    col27.info("BSC state: ")
-    col28.markdown("### %s" %BSS_data["BSC"])
-    st.write("")
-    col29.info("Recommended transformer power: ")
-    col30.markdown("### %d" %BSS_data["transformer_power"] + " [kVA]")
-    st.write("")
+def run_sizing(demand, target_swap_ratio, max_overflow):
+    '''
+    task function of the sizing search, runs in a thread of the server (see jobs.submit_task)
+    '''
+    def task(report):
+        def sizing_progress(simulations, round_idx, rounds):
+            report((round_idx + 1) / rounds, "round %d of %d, %d days simulated" % (round_idx + 1, rounds, simulations))
+        return sizing.optimize(demand, target_swap_ratio=target_swap_ratio, max_overflow=max_overflow,
+                               executor=jobs.pool(), progress_callback=sizing_progress)
+    return task
+
+def show_sizing_job():
+    '''
+    progress of the sizing search of this session, its result is taken over once it has finished
+    '''
+    job = st.session_state.get("sizing_job")
+    if job is None:
+        return
+    status = job.status
+    if status in ("queued", "running"):
+        st.progress(job.progress(), text=job.text or "simulating candidate designs...")
+        if st.button("Cancel", key="cancel_sizing_%d" % job.id):
+            job.cancel()
+        return
+    del st.session_state["sizing_job"]
+    if status == "done":
+        st.session_state["sizing_result"] = job.result()
+    elif status == "failed":
+        st.session_state["sizing_error"] = str(job.error())
+    st.rerun()
+
+if trigger_btn:
+    # the search runs in the background, the sidebar polls it and the page stays usable
+    demand = {"BS_user_num": ans1, "non_BS_user_num": ans3}
+    old_job = st.session_state.get("sizing_job")
+    if old_job is not None:
+        old_job.cancel()
+    st.session_state.pop("sizing_error", None)
+    st.session_state["sizing_job"] = jobs.submit_task(run_sizing(demand, ans4, ans5), label="sizing")
+
+with st.sidebar:
+    sizing_active = "sizing_job" in st.session_state
+    st.fragment(run_every = 1 if sizing_active else None)(show_sizing_job)()
+if "sizing_error" in st.session_state:
+    st.sidebar.error("sizing failed: %s" % st.session_state["sizing_error"])
+
+if "sizing_result" in st.session_state:
+    sizing_result = st.session_state["sizing_result"]
+    design = sizing_result["design"]
+    col21, col22 = st.sidebar.columns([2,1])
+    col23, col24 = st.sidebar.columns([2,1])
+    col25, col26 = st.sidebar.columns([2,1])
+    col27, col28 = st.sidebar.columns([2,1])
+    col29, col30 = st.sidebar.columns([2,1])
+    if design is None:
+        st.sidebar.warning("No candidate design meets the targets, reduce the demand or the targets.")
+    else:
+        col21.info("BSS Type: ")
+        col22.markdown("### %s" %design["station_type"]["station_type"])
+        col23.info("Number of Batteries: ")
+        col24.markdown("### %d" %design["battery_num"])
+        col25.info("Number of Charge Terminals: ")
+        col26.markdown("### %d" %design["psc_num"])
+        col27.info("Recommended transformer power: ")
+        col28.markdown("### %d" %design["station_type"]["max_power"] + " [kW]")
+        col29.info("Simulated swap ratio within 15 min: ")
+        col30.markdown("### %.2f" %design["kpis"]["swap_ratio_in_15_min"])
+        if design["station_type"]["station_type"] == "User_Defined":
+            st.sidebar.write("Power modules: %s" % design["name"].split(", ")[-1])
+    st.sidebar.write("%d simulated days in %.0f s, %d candidates screened out analytically" %
+                     (sizing_result["simulations"], sizing_result["seconds"], sizing_result.get("screened", 0)))
+    with st.sidebar.expander("All candidate designs"):
+        st.dataframe([{"design": c["name"], "cost": c["cost"], "replications": c["replications"], "verdict": c["verdict"],
+                       "swap ratio 15 min": round(c["kpis"]["swap_ratio_in_15_min"], 3), "overflow": c["kpis"]["overflow"]}
+                      for c in sizing_result["candidates"]])
 
 # set up the Notation and contact information
 st.sidebar.write("")
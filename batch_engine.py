@@ -0,0 +1,731 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import random
+
+import numpy as np
+
+import global_param as GC
+import queueing
+import replication
+
+# Lockstep engine: K independent replications of one configuration advanced together, tick by tick.
+# The station state is held in arrays with a leading replication axis instead of objects:
+#   - rack places: battery SOC, battery kind, occupied, plugged in (swap.Battery_Rack.plug)
+#   - per power cabinet the connection map of swap.Swap_Rack (module -> 0, place + 1 or -(pile + 1))
+#   - charge piles: vehicle SOC and kind, connected user, charging (swap.Charge_Pile.state)
+#   - swap platform: status (free / in use / switch), timers, selected place
+# The rules of main.SimulationRun and swap.py are applied to all K replications at once with NumPy masks:
+# power distribution ("BSS preferred" and "BSC preferred"), module output and battery current limits, battery
+# switching inside a rack (enable_me_switch = 1), swap start and completion. Loops run over the places and
+# piles of a cabinet, never over the replications; only the arrivals (a few per tick over all replications) are
+# handled one by one, because the markov preference depends on the queue at the arrival.
+# Not modelled (a warning is logged): grid interaction, battery switching between racks (enable_me_switch > 1),
+# warm start, warm-up truncation, battery selection policies other than the first ready place and more than
+# one swap lane.
+# The users of a replication are the users main.do_simulation() draws for its seed (main_users(); the markov
+# preference is drawn at the arrival, with the queue of the engine), so a replication serves the same users as the
+# main.do_simulation() run of the same seed. validate() checks that per configuration: it runs main.do_simulation()
+# for every seed, replays the users it recorded (UserRecorder) in the engine and compares every KPI of
+# replication.KPI_NAMES replication by replication. The engine is not a replacement for replication.replicate(); use
+# its results only for configurations that pass validate(). kpis() returns the KPI dicts of replication.kpis() with
+# the control variate of replication.py. On one core a replication is about 4.5 times faster than a
+# main.do_simulation() run in a batch of 64 and about 9 times faster in a full batch of BATCH_SIZE, small batches gain
+# less.
+
+# set up logger
+logger = logging.getLogger('main.batch_engine')
+
+# replications per batch of replicate()
+BATCH_SIZE = 256
+# swap.Battery.limit_axis, test temperatures of the current limit tables, swap.Power_Module.line_resistance
+LIMIT_AXIS = np.array([0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95])
+TEST_TEMPERATURES = (-20, -10, 0, 10, 20, 25, 30, 40)
+LINE_RESISTANCE = 0.008
+RACK_CURRENT_LIMIT = 250
+PILE_CURRENT_LIMIT = 650
+SWITCH_SECONDS = 30
+# temperature of the users in users.User.markov_preference
+MARKOV_TEMPERATURE = 25
+# swap platform state, same codes as swap.SwapStation.state
+FREE, IN_USE, SWITCH = 0, 1, 2
+# preferences of the users, in the order of users.MARKOV_STATES
+PREFERENCES = ("swap", "charge", "leave")
+# validate(): replications and the largest relative difference of a KPI between the engines in one replication
+VALIDATION_REPLICATIONS = 32
+VALIDATION_TOLERANCE = 1e-6
+# settings the engine does not model
+UNSUPPORTED = {"grid_interaction_idx": lambda v: v is not None and v >= 0, "enable_me_switch": lambda v: v > 1,
+               "warm_start": bool, "truncate_warmup": bool, "battery_selection": lambda v: v != "first",
+               "battery_match_type": bool, "swap_lanes": lambda v: v != 1, "user_abandonment": bool,
+               "charge_queue_discipline": lambda v: v != "fifo", "power_cap": bool, "cabinet_power_cap": bool,
+               "power_dist_option": lambda v: v not in ("BSS preferred", "BSC preferred")}
+
+
+def _markov_probabilities() -> dict:
+    '''
+    (soc >= 0.4, queue > 12) -> rounded probabilities of swap, charge and leave (users.User.markov_preference)
+    '''
+    import users
+    probabilities = {}
+    for high_soc in (False, True):
+        for long_queue in (False, True):
+            band = users.markov_band(MARKOV_TEMPERATURE, 0.5 if high_soc else 0.3, 13 if long_queue else 0)
+            probabilities[(high_soc, long_queue)] = users.MARKOV_PROBABILITIES[band]
+    return probabilities
+
+
+def main_users(param : dict, seed : int) -> list:
+    '''
+    the users main.do_simulation() draws for seed, in their order of arrival: (arrival tick, BS user, SOC, battery
+    type, preference, uniform of the preference draw); the draws of main.add_users() do not depend on the station,
+    only the markov preference does (None, drawn at the arrival with the queue)
+    '''
+    import main
+    import users
+    random.seed(seed)
+    np.random.seed(seed)
+    users.set_sampling(0)
+    timestamps, labels = main.create_user_sequence(param)
+    interval = param["sim_interval"]
+    arrivals = sorted((t, i) for i, t in enumerate(timestamps) if t < param["sim_ticks"] * interval)   # users.check_seq
+    result = []
+    for t, i in arrivals:
+        user = users.User(user_label=labels[i])
+        u = 0.0
+        if user.user_type == "non_BS":
+            user.create_battery(battery_config=param["battery_config"], soc_low_limit = 0.05, soc_up_limit = 0.9, random_soc = 1)
+            preference = "charge"
+        else:
+            user.create_battery(battery_config=param["battery_config"], soc_low_limit = 0.05, soc_up_limit = 0.9, random_soc = 0)
+            if param["user_preference"] == "full_swap":
+                preference = "swap"
+            elif param["user_preference"] == "fixed_value":
+                preference = user.fixed_preference(param["service_ratio"])
+            else:
+                preference, u = None, random.random()           # the draw of User.markov_preference
+        result.append((t // interval, user.user_type == "BS", user.battery.soc, user.battery.batterytype, preference, u))
+    return result
+
+
+class UserRecorder:
+    '''
+    recorder of main.do_simulation() (as export.SimulationRecorder) that keeps the arriving users in the form of
+    main_users()
+    '''
+    def __init__(self):
+        self.users = []
+
+    def start(self, station, param):
+        pass
+
+    def record_user(self, user):
+        self.users.append((user.sequence, user.user_type == "BS", user.battery.soc, user.battery.batterytype,
+                           user.charge_preference, 0.0))
+
+    def record_tick(self, tick, station, swap_queue_length, charge_queue_length):
+        pass
+
+    def finish(self):
+        pass
+
+
+class BatchSimulation:
+    '''
+    K replications of param in lockstep, one per seed, see the comment at the top of this module
+    users:  optional list of the users of every replication (UserRecorder.users) instead of the own draws
+    '''
+    def __init__(self, param : dict, seeds : list, users = None):
+        for key, unsupported in UNSUPPORTED.items():
+            if key in param and unsupported(param[key]):
+                logger.warning('batch engine ignores %s = %s', key, param[key])
+        self.param = param
+        self.seeds = list(seeds)
+        K = self.K = len(self.seeds)
+        self.interval = param["sim_interval"]
+        self.sim_ticks = param["sim_ticks"]
+        self.select_soc = param["select_soc"]
+        self.target_soc = param["target_soc"]
+        self.swap_period = int(param["swap_time"] * 60)
+        self.bsc_preferred = param["power_dist_option"] != "BSS preferred"
+        self.redistribute = bool(param.get("charge_power_redist"))
+        self.switching = param.get("enable_me_switch", 0) > 0
+        self.tick = 0
+
+        # battery kinds: the types of battery_config at 25 degrees (batteries loaded at the start, main.SimulationRun
+        # resets the station temperature) followed by the same types at swap_rack_temperature (user batteries)
+        self.types = list(param["battery_config"])
+        user_temperature = min(TEST_TEMPERATURES, key=lambda t: abs(t - param.get("swap_rack_temperature", 25)))
+        rows, capacity, ocv = [], [], []
+        for temperature in (25, user_temperature):
+            for t in self.types:
+                table = GC.battery_charge_limit.get(t, GC.battery_charge_limit["100kWh"])
+                rows.append(np.asarray(table[temperature], dtype=np.float64))
+                capacity.append(GC.battery_capacity.get(t, GC.battery_capacity["100kWh"]))
+                ocv.append(np.asarray(GC.ocv_70 if t == "70kWh" else GC.ocv_100, dtype=np.float64))
+        rows = np.array(rows)
+        self.limit_base = rows[:, :-1]
+        self.limit_slope = np.diff(rows, axis=1) / np.diff(LIMIT_AXIS)
+        self.capacity = np.array(capacity, dtype=np.float64)
+        # the OCV tables differ in length (ocv_70 is shorter), pad them with their last voltage
+        width = max(len(v) for v in ocv)
+        self.ocv = np.array([np.pad(v, (0, width - len(v)), mode="edge") for v in ocv])
+
+        # station layout as in swap.SwapStation: cabinets (first place, places = modules, global pile indices)
+        station_type = param["station_type"]
+        name = station_type["station_type"]
+        psc = int(param["psc_num"]) if station_type["max_charge_terminal"] > 0 else 0
+        if name == "GEN2_530":
+            module, layout, places = GC.UU40kW, [(0, 13, 0)], 13
+        elif name == "GEN3_600":
+            module, layout, places = GC.UU60kW, [(0, 10, psc)], 20         # second rack without power cabinet
+        elif name == "GEN3_1200":
+            module, layout, places = GC.UU60kW, [(0, 10, psc // 2), (10, 10, psc - psc // 2)], 20
+        else:
+            n = int(station_type["max_charger_number"])
+            module, layout, places = station_type["power_module_type"], [(0, n, psc)], n
+        self.module_current = module["max_current"]
+        self.module_power = module["max_power"]
+        self.cabinets = []
+        pile = 0
+        for first, modules, piles in layout:
+            self.cabinets.append((first, modules, list(range(pile, pile + piles))))
+            pile += piles
+        self.piles = pile
+        self.cmap = [np.zeros((K, modules), dtype=np.int64) for _, modules, _ in layout]
+
+        # rack places, loaded in battery_config order from place 0 on (SwapStation.load_battery_auto)
+        self.present = np.zeros((K, places), dtype=bool)
+        self.plug = np.zeros((K, places), dtype=bool)
+        self.soc = np.zeros((K, places))
+        self.kind = np.zeros((K, places), dtype=np.int64)
+        p = 0
+        for i, count in enumerate(param["battery_config"].values()):
+            for _ in range(count):
+                if p < places:
+                    self.present[:, p] = True
+                    self.kind[:, p] = i
+                    self.soc[:, p] = param["init_battery_soc_in_BSS"]
+                    p += 1
+
+        # charge piles
+        L = max(1, pile)
+        self.pile_active = np.zeros((K, L), dtype=bool)
+        self.pile_charging = np.zeros((K, L), dtype=bool)
+        self.pile_soc = np.zeros((K, L))
+        self.pile_kind = np.zeros((K, L), dtype=np.int64)
+        self.pile_user = np.zeros((K, L), dtype=np.int64)
+
+        # swap platform
+        self.status = np.zeros(K, dtype=np.int64)
+        self.swap_timer = np.zeros(K, dtype=np.int64)
+        self.switch_timer = np.zeros(K, dtype=np.int64)
+        self.buff = np.zeros(K, dtype=np.int64)
+        self.swap_user = np.full(K, -1, dtype=np.int64)
+        self.charge_user = np.full(K, -1, dtype=np.int64)
+
+        self._create_users(users)
+        self.swap_queue = [[] for _ in range(K)]
+        self.swap_taken = np.zeros(K, dtype=np.int64)
+        self.charge_queue = [[] for _ in range(K)]
+        self.charge_taken = np.zeros(K, dtype=np.int64)
+        self.markov = _markov_probabilities()
+
+        # results
+        n_users = len(self.users["k"])
+        self.user_charge_start = np.full(n_users, -1, dtype=np.int64)
+        self.user_charge_ticks = np.zeros(n_users, dtype=np.int64)
+        self.charge_users = []                                      # connected users in connection order
+        self.swap_wait = np.zeros(K)
+        self.swap_started = np.zeros(K, dtype=np.int64)
+        self.charge_wait = np.zeros(K)
+        self.swap_served = np.zeros(K, dtype=np.int64)
+        self.swap_service = np.zeros(K)
+        self.ratio_ticks = np.zeros(K, dtype=np.int64)             # arrival ticks counted by the 15 min ratio
+        self.ratio_hits = np.zeros(K, dtype=np.int64)
+        self.last_served_tick = np.full(K, -1, dtype=np.int64)
+        self.energy = np.zeros(K)
+        self.queue_swap = np.zeros(K, dtype=np.int64)
+        self.queue_charge = np.zeros(K, dtype=np.int64)
+
+        # current limits and voltages of the last distribution per cabinet, used by _charge() in the same tick
+        self._limits = [None] * len(self.cabinets)
+        self._pile_limits = [None] * len(self.cabinets)
+
+        # SwapStation.init_charge: plug in every battery and distribute the modules
+        for first, modules, _ in self.cabinets:
+            self.plug[:, first:first + modules] = self.present[:, first:first + modules]
+        for c in range(len(self.cabinets)):
+            self._distribute(c)
+
+    ######################################################################
+    def _create_users(self, recorded = None):
+        '''
+        users of every replication: recorded (UserRecorder.users) or main_users() of its seed
+        '''
+        if recorded is None:
+            recorded = [main_users(self.param, seed) for seed in self.seeds]
+        columns = {"k": [], "tick": [], "bs": [], "soc": [], "kind": [], "choice": [], "u": []}
+        for k, users in enumerate(recorded):
+            columns["k"] += [k] * len(users)
+            for tick, bs, soc, battery_type, preference, u in users:
+                columns["tick"].append(tick)
+                columns["bs"].append(bs)
+                columns["soc"].append(soc)
+                columns["kind"].append(self.types.index(battery_type) + len(self.types))
+                columns["choice"].append(-1 if preference is None else PREFERENCES.index(preference))
+                columns["u"].append(u)
+        dtypes = {"k": np.int64, "tick": np.int64, "bs": bool, "soc": np.float64, "kind": np.int64, "choice": np.int64,
+                  "u": np.float64}
+        self._index_users({name: np.array(v, dtype=dtypes[name]) for name, v in columns.items()})
+
+    def _index_users(self, users):
+        '''
+        sort the users of all replications by arrival tick, count the arrivals in the peak slots (control variate)
+        '''
+        param = self.param
+        interval = self.interval
+        order = np.argsort(users["tick"], kind="stable")
+        self.users = {name: v[order] for name, v in users.items()}
+        self.arrivals = np.searchsorted(self.users["tick"], np.arange(self.sim_ticks + 1))
+        slots = np.zeros(48, dtype=bool)
+        slots[list(replication.peak_slots(param))] = True
+        arrived = self.users["tick"] < self.sim_ticks
+        in_peak = slots[np.minimum(self.users["tick"] * interval // queueing.SLOT_SECONDS, 47)]
+        self.peak_arrivals = np.bincount(self.users["k"][in_peak & arrived], minlength=self.K)
+
+    ######################################################################
+    def _current_limit(self, soc, kind):
+        '''
+        swap.Battery.calc_current_limit
+        '''
+        check = np.clip(soc, 0.05, 0.95)
+        j = np.minimum(np.searchsorted(LIMIT_AXIS, check, side="right"), len(LIMIT_AXIS) - 1) - 1
+        return self.limit_base[kind, j] + (check - LIMIT_AXIS[j]) * self.limit_slope[kind, j]
+
+    def _voltage(self, soc, kind):
+        '''
+        swap.Battery.set_battery_voltage
+        '''
+        index = (np.clip(soc, 0.05, 1.0) * 100).astype(np.int64) - 5
+        return self.ocv[kind, np.minimum(index, self.ocv.shape[1] - 1)]
+
+    def _module_number(self, table, voltage, needs):
+        '''
+        swap.Swap_Rack.module_number_check from the current limit table and the voltage, 0 where needs is False
+        '''
+        current = np.minimum(table, RACK_CURRENT_LIMIT)
+        power = current * voltage / 1000.0
+        n = np.minimum(np.ceil(power / self.module_power - 1e-9), np.ceil(current / self.module_current - 1e-9))
+        return np.where(needs, np.clip(n, 1, 10), 0).astype(np.int64)
+
+    def _module_output(self, command, voltage):
+        '''
+        output current and power of one power module (swap.Power_Module.output_power)
+        '''
+        current = np.minimum(command, self.module_current)
+        power = (voltage + current * LINE_RESISTANCE) * current / 1000.0
+        over = power > self.module_power
+        if over.any():
+            limit = (-voltage + np.sqrt(voltage ** 2 + 4 * LINE_RESISTANCE * self.module_power * 1000)) / 2 / LINE_RESISTANCE
+            current = np.where(over, limit, current)
+            power = np.where(over, self.module_power, power)
+        return current, power
+
+    ######################################################################
+    def _add_users(self, t):
+        users = self.users
+        for e in range(self.arrivals[t], self.arrivals[t + 1]):
+            k = users["k"][e]
+            choice = users["choice"][e]
+            if choice < 0:
+                # markov preference, drawn with the queue at the arrival
+                queue_length = len(self.swap_queue[k]) - self.swap_taken[k] + len(self.charge_queue[k]) - self.charge_taken[k]
+                probabilities = self.markov[(users["soc"][e] >= 0.4, queue_length > 12)]
+                u = users["u"][e]
+                choice = 0
+                if probabilities[0] <= u < probabilities[0] + probabilities[1]:
+                    choice = 1
+                elif probabilities[0] + probabilities[1] <= u < sum(probabilities):
+                    choice = 2
+            if choice == 0:
+                self.swap_queue[k].append(e)
+            elif choice == 1:
+                self.charge_queue[k].append(e)
+
+    def step(self):
+        '''
+        execute one simulation tick for all replications (main.SimulationRun.step)
+        '''
+        t = self.tick
+        users = self.users
+        self._add_users(t)
+        swap_len = np.array([len(q) for q in self.swap_queue]) - self.swap_taken
+        charge_len = np.array([len(q) for q in self.charge_queue]) - self.charge_taken
+        self.queue_swap = swap_len
+        self.queue_charge = charge_len
+
+        # take the next users out of the queues
+        for k in np.nonzero((self.swap_user < 0) & (swap_len > 0))[0]:
+            self.swap_user[k] = self.swap_queue[k][self.swap_taken[k]]
+            self.swap_taken[k] += 1
+        for k in np.nonzero((self.charge_user < 0) & (charge_len > 0))[0]:
+            self.charge_user[k] = self.charge_queue[k][self.charge_taken[k]]
+            self.charge_taken[k] += 1
+
+        # SwapStation.start_swap: first place with a battery at select_soc
+        waiting = (self.swap_user >= 0) & (self.status == FREE)
+        if waiting.any():
+            ready = self.present & (self.soc >= self.select_soc)
+            start = waiting & ready.any(axis=1)
+            if start.any():
+                ks = np.nonzero(start)[0]
+                self.buff[ks] = np.argmax(ready[ks], axis=1)
+                self.status[ks] = IN_USE
+                self.swap_timer[ks] = 0
+                self.swap_wait[ks] += t - users["tick"][self.swap_user[ks]]
+                self.swap_started[ks] += 1
+
+        # SwapStation.vehicle_charge: first free pile
+        if self.piles > 0:
+            connect = (self.charge_user >= 0) & ~self.pile_active[:, :self.piles].all(axis=1)
+            for k in np.nonzero(connect)[0]:
+                j = int(np.argmin(self.pile_active[k, :self.piles]))
+                e = self.charge_user[k]
+                self.pile_active[k, j] = True
+                self.pile_charging[k, j] = False
+                self.pile_soc[k, j] = users["soc"][e]
+                self.pile_kind[k, j] = users["kind"][e]
+                self.pile_user[k, j] = e
+                self.charge_wait[k] += t - users["tick"][e]
+                self.charge_users.append(e)
+                self.charge_user[k] = -1
+
+        self._do_swap(t)
+        power = np.zeros(self.K)
+        for c in range(len(self.cabinets)):
+            self._distribute(c)
+            power += self._charge(c, t)
+        self.energy += np.maximum(power, 0.0) * self.interval / 3600.0
+        self.tick = t + 1
+
+    def _do_swap(self, t):
+        '''
+        SwapStation.do_swap: switch and swap timers, battery exchange, battery switching in the racks
+        '''
+        switching = self.status == SWITCH
+        self.switch_timer[switching] += 1
+        self.status[switching & (self.switch_timer * self.interval >= SWITCH_SECONDS)] = FREE
+
+        in_use = self.status == IN_USE
+        self.swap_timer[in_use] += 1
+        done = in_use & (self.swap_timer * self.interval >= self.swap_period)
+        if done.any():
+            ks = np.nonzero(done)[0]
+            e = self.swap_user[ks]
+            place = self.buff[ks]
+            self.soc[ks, place] = self.users["soc"][e]
+            self.kind[ks, place] = self.users["kind"][e]
+            self.plug[ks, place] = True
+            arrival = self.users["tick"][e]
+            service = t - arrival
+            self.swap_served[ks] += 1
+            self.swap_service[ks] += service
+            first = arrival != self.last_served_tick[ks]        # one user per arrival tick, as SimulationRun.results
+            self.ratio_ticks[ks] += first
+            self.ratio_hits[ks] += first & (service * self.interval / 60.0 <= 15)
+            self.last_served_tick[ks] = arrival
+            self.status[ks] = FREE
+            self.swap_user[ks] = -1
+
+        if self.switching:
+            idle = ~in_use & (self.status == FREE)
+            if idle.any():
+                for first, modules, _ in self.cabinets:
+                    self._switch_in_rack(idle, first, modules)
+
+    def _switch_in_rack(self, idle, first, n):
+        '''
+        SwapStation.switch_in_rack: the battery of a pair of charging places moves to the first pair without charging
+        '''
+        plug = self.plug[:, first:first + n]
+        evens = np.arange(0, n, 2)
+        paired = evens < n - 1
+        for i in range(0, n - 1, 2):
+            rows = idle & plug[:, i] & plug[:, i + 1]
+            if not rows.any():
+                continue
+            free = ~plug[:, evens]
+            free[:, paired] &= ~plug[:, evens[paired] + 1]
+            j = evens[np.argmax(free, axis=1)]
+            rows &= free.any(axis=1) & self.present[np.arange(self.K), first + j]
+            if not rows.any():
+                continue
+            ks = np.nonzero(rows)[0]
+            a, b = first + i, first + j[ks]
+            self.soc[ks, a], self.soc[ks, b] = self.soc[ks, b], self.soc[ks, a]
+            self.kind[ks, a], self.kind[ks, b] = self.kind[ks, b], self.kind[ks, a]
+            self.plug[ks, a] = True
+            self.plug[ks, b] = True
+            self.status[ks] = SWITCH
+            self.switch_timer[ks] = 0
+
+    ######################################################################
+    def _place_modules(self, cmap, n):
+        '''
+        number of modules connected to every place: its own module and the module of its neighbour place
+        '''
+        places = np.arange(1, n + 1)
+        partner = (places - 1) ^ 1
+        paired = partner < n
+        count = (cmap == places).astype(np.int64)
+        count[:, paired] += cmap[:, partner[paired]] == places[paired]
+        return count
+
+    def _distribute(self, c):
+        '''
+        Swap_Rack.power_distribution_pss_preferred / power_distribution_psc_preferred of cabinet c
+        '''
+        first, n, piles = self.cabinets[c]
+        cmap = self.cmap[c]
+        rows = np.arange(self.K)[:, None]
+        sl = slice(first, first + n)
+        present, soc, kind, plug = self.present[:, sl], self.soc[:, sl], self.kind[:, sl], self.plug[:, sl]
+        table, voltage = self._current_limit(soc, kind), self._voltage(soc, kind)
+        self._limits[c] = (table, voltage)
+
+        # release the modules of missing, charged or unplugged batteries and of finished or stopped piles
+        release = ~present | (soc >= self.select_soc) | ~plug
+        cmap[(cmap > 0) & release[rows, np.maximum(cmap - 1, 0)]] = 0
+        if piles:
+            p_soc, p_kind = self.pile_soc[:, piles], self.pile_kind[:, piles]
+            p_table, p_voltage = self._current_limit(p_soc, p_kind), self._voltage(p_soc, p_kind)
+            self._pile_limits[c] = (p_table, p_voltage, self._module_number(p_table, p_voltage, p_soc < self.target_soc))
+            p_release = ~self.pile_active[:, piles] | (p_soc >= self.target_soc) | ~self.pile_charging[:, piles]
+            cmap[(cmap < 0) & p_release[rows, np.maximum(-cmap - 1, 0)]] = 0
+            self.pile_charging[:, piles] &= ~p_release
+
+        # a battery that needs a single module gives the module of its neighbour place back
+        needed = self._module_number(table, voltage, present & (soc < 1.0))
+        ks, i = np.nonzero((self._place_modules(cmap, n) > 1) & (needed < 2))
+        cmap[ks, i ^ 1] = 0
+
+        if piles and self.bsc_preferred:
+            self._connect_piles(c, steal=True)
+        self._connect_racks(cmap, present & (soc < self.select_soc) & plug, needed, n)
+        if piles and not self.bsc_preferred:
+            self._connect_piles(c, steal=False)
+
+        # stop_charge_all / start_charge: only the connected places and piles stay plugged in and charging
+        self.plug[:, sl] = present & (self._place_modules(cmap, n) > 0)
+        if piles:
+            ids = -np.arange(1, len(piles) + 1)
+            self.pile_charging[:, piles] = self.pile_active[:, piles] & (cmap[:, :, None] == ids).any(axis=1)
+
+    def _connect_racks(self, cmap, wants, needed, n):
+        '''
+        own module of every place that needs charging, the neighbour module if it is free and needed
+        The places of a pair only touch the two modules of the pair, so all even places are handled at once,
+        then all odd places.
+        '''
+        for parity in (0, 1):
+            index = np.arange(parity, n, 2)
+            want = wants[:, index]
+            if not want.any():
+                continue
+            own = want.copy()
+            v = cmap[:, index]
+            if not self.redistribute:
+                # a module shared by a pile with others stays with the pile
+                own &= ~((v < 0) & ((cmap[:, None, :] == v[:, :, None]).sum(axis=2) > 1))
+            cmap[:, index] = np.where(own, index + 1, v)
+            partner = index ^ 1
+            paired = partner < n
+            index, partner, want = index[paired], partner[paired], want[:, paired]
+            take = want & ((needed[:, index] > 1) | (cmap[:, index] != index + 1)) & (cmap[:, partner] == 0)
+            cmap[:, partner] = np.where(take, index + 1, cmap[:, partner])
+
+    def _connect_piles(self, c, steal):
+        '''
+        vehicles at target_soc leave, charging and newly connected piles get modules (Swap_Rack.connect_charge_pile)
+        steal: "BSC preferred", modules still missing are taken from the rack batteries with the lowest SOC
+        '''
+        first, n, piles = self.cabinets[c]
+        cmap = self.cmap[c]
+        needed = self._pile_limits[c][2]
+        for second_pass in ((False,) if steal else (False, True)):
+            for l, pile in enumerate(piles):
+                active = self.pile_active[:, pile]
+                if not active.any():
+                    continue
+                if not second_pass:
+                    leave = active & (self.pile_soc[:, pile] >= self.target_soc)
+                    self.pile_active[leave, pile] = False
+                    self.pile_charging[leave, pile] = False
+                    active = self.pile_active[:, pile]
+                pid = -(l + 1)
+                linked = cmap == pid
+                if steal:
+                    connect = active & (self.pile_charging[:, pile] | ~linked.any(axis=1))
+                elif second_pass:
+                    connect = active & ~self.pile_charging[:, pile] & ~linked.any(axis=1)
+                else:
+                    connect = active & self.pile_charging[:, pile]
+                if not connect.any():
+                    continue
+                missing = np.where(connect, needed[:, l] - linked.sum(axis=1), 0)
+                free = cmap == 0
+                take = free & (np.cumsum(free, axis=1) <= np.maximum(missing, 0)[:, None])
+                cmap[take] = pid
+                if not steal:
+                    cmap[linked & (np.cumsum(linked, axis=1) <= np.maximum(-missing, 0)[:, None])] = 0
+                    continue
+                missing -= take.sum(axis=1)
+                for k in np.nonzero(missing > 0)[0]:
+                    # as connect_charge_pile: the index in the SOC list of the present batteries is taken as place
+                    soc_list = [s for s, p in zip(self.soc[k, first:first + n], self.present[k, first:first + n]) if p]
+                    for _ in range(min(missing[k], len(soc_list))):
+                        index = soc_list.index(min(soc_list))
+                        cmap[k, cmap[k] == index + 1] = pid
+                        self.plug[k, first + index] = False
+                        soc_list.remove(min(soc_list))
+
+    def _charge(self, c, t):
+        '''
+        Swap_Rack.do_charge of cabinet c with the limits of _distribute(), return the power of its modules
+        '''
+        first, n, piles = self.cabinets[c]
+        cmap = self.cmap[c]
+        sl = slice(first, first + n)
+        power = np.zeros(self.K)
+        modules = self._place_modules(cmap, n)
+        charging = modules > 0
+        if charging.any():
+            soc, kind = self.soc[:, sl], self.kind[:, sl]
+            table, voltage = self._limits[c]
+            m = np.maximum(modules, 1)
+            current, module_power = self._module_output(np.minimum(table, RACK_CURRENT_LIMIT) / m, voltage)
+            current = np.minimum(current * m, table)
+            self.soc[:, sl] = np.where(charging, np.minimum(soc + self.interval * current / 3600 / self.capacity[kind], 1.0), soc)
+            power += np.sum(np.where(charging, module_power * m, 0.0), axis=1)
+        if piles:
+            modules = (cmap[:, :, None] == -np.arange(1, len(piles) + 1)).sum(axis=1)
+            charging = modules > 0
+            if charging.any():
+                soc, kind = self.pile_soc[:, piles], self.pile_kind[:, piles]
+                table, voltage, _ = self._pile_limits[c]
+                m = np.maximum(modules, 1)
+                current, module_power = self._module_output(np.minimum(table, PILE_CURRENT_LIMIT) / m, voltage)
+                current = np.minimum(current * m, table)
+                self.pile_soc[:, piles] = np.where(charging, np.minimum(soc + self.interval * current / 3600 / self.capacity[kind],
+                                                                        self.target_soc), soc)
+                power += np.sum(np.where(charging, module_power * m, 0.0), axis=1)
+                e = self.pile_user[:, piles][charging]
+                self.user_charge_start[e] = np.where(self.user_charge_start[e] < 0, t, self.user_charge_start[e])
+                self.user_charge_ticks[e] += 1
+        return power
+
+    def run(self):
+        while self.tick < self.sim_ticks:
+            self.step()
+        return self
+
+    ######################################################################
+    def kpis(self) -> list:
+        '''
+        KPI dicts of the replications, see replication.kpis()
+        '''
+        interval = self.interval
+        users = self.users
+        e = np.array(self.charge_users, dtype=np.int64)
+        k, bs = users["k"][e], users["bs"][e]
+        service = np.abs(self.user_charge_start[e] + self.user_charge_ticks[e] - users["tick"][e]).astype(np.float64)
+        charge_time = {flag: np.bincount(k[bs == flag], service[bs == flag], minlength=self.K) for flag in (True, False)}
+        charge_count = {flag: np.bincount(k[bs == flag], minlength=self.K) for flag in (True, False)}
+        connected = charge_count[True] + charge_count[False]
+        results = []
+        for k in range(self.K):
+            results.append({
+                "swap_ratio_in_15_min": self.ratio_hits[k] / (self.ratio_ticks[k] + self.queue_swap[k]) if self.ratio_ticks[k] > 0 else 0,
+                "average_time_swap": self.swap_service[k] / self.swap_served[k] * interval / 60.0 if self.swap_served[k] > 0 else 0,
+                "BS_average_time_charge": charge_time[True][k] / charge_count[True][k] * interval / 60.0 if charge_count[True][k] > 0 else 0,
+                "non_BS_average_time_charge": charge_time[False][k] / charge_count[False][k] * interval / 60.0 if charge_count[False][k] > 0 else 0,
+                "overflow": int(self.queue_swap[k]),
+                "swap_users": int(self.swap_served[k]),
+                "charge_users": int(connected[k]),
+                "swap_wait": self.swap_wait[k] / self.swap_started[k] * interval / 60.0 if self.swap_started[k] > 0 else 0.0,
+                "charge_wait": self.charge_wait[k] / connected[k] * interval / 60.0 if connected[k] > 0 else 0.0,
+                "energy": float(self.energy[k]),
+                "charge_overflow": int(self.queue_charge[k]),
+                "balked": 0,
+                "reneged": 0,
+                replication.CONTROL: int(self.peak_arrivals[k]),
+            })
+        return results
+
+
+def run_batch(param : dict, seeds : list) -> list:
+    '''
+    worker side: simulate one batch of replications, return their KPI dicts in seed order
+    '''
+    return BatchSimulation(param, seeds).run().kpis()
+
+
+def replicate(param : dict, n, executor = None, base_seed = replication.BASE_SEED, batch = BATCH_SIZE) -> list:
+    '''
+    n replications of param in batches of up to batch replications, the batches in parallel if an executor
+    (e.g. jobs.pool()) is given; return the list of KPI dicts in seed order
+    the results are only a substitute for replication.replicate() if param passes validate()
+    '''
+    seeds = replication.replication_seeds(0, n, base_seed)
+    chunks = [seeds[i:i + batch] for i in range(0, n, batch)]
+    if executor is None:
+        results = [run_batch(param, chunk) for chunk in chunks]
+    else:
+        results = executor.map(run_batch, [param] * len(chunks), chunks)
+    return [kpis for chunk in results for kpis in chunk]
+
+
+def validate_replication(param : dict, seed : int) -> tuple:
+    '''
+    worker side: main.do_simulation() of one seed and the batch engine on its users, return both KPI dicts
+    '''
+    import main
+    recorder = UserRecorder()
+    result = main.do_simulation(dict(param, seed=seed), recorder=recorder)
+    reference = replication.kpis(result, param["sim_interval"])
+    return reference, BatchSimulation(param, [seed], users=[recorder.users]).run().kpis()[0]
+
+
+def validate(param : dict, n = VALIDATION_REPLICATIONS, executor = None, base_seed = replication.BASE_SEED,
+             tolerance = VALIDATION_TOLERANCE) -> dict:
+    '''
+    seeded comparison with main.do_simulation(): n replications of param, the batch engine replays the users of
+    main.do_simulation() in every replication
+    return {KPI: (mean of main.do_simulation(), mean of the batch engine, largest relative difference of a
+    replication)} for the KPIs of replication.KPI_NAMES, a warning is logged for every KPI that differs by more than
+    tolerance in a replication
+    '''
+    seeds = replication.replication_seeds(0, n, base_seed)
+    if executor is None:
+        pairs = [validate_replication(param, seed) for seed in seeds]
+    else:
+        pairs = list(executor.map(validate_replication, [param] * n, seeds))
+    comparison = {}
+    for name in replication.KPI_NAMES:
+        differences = [abs(batch[name] - reference[name]) / max(1.0, abs(reference[name])) for reference, batch in pairs]
+        worst = max(range(n), key=differences.__getitem__)
+        if differences[worst] > tolerance:
+            logger.warning('batch engine disagrees on %s in %d of %d replications, seed %d: %.3f against %.3f', name,
+                           sum(d > tolerance for d in differences), n, seeds[worst], pairs[worst][1][name],
+                           pairs[worst][0][name])
+        comparison[name] = (sum(reference[name] for reference, _ in pairs) / n,
+                            sum(batch[name] for _, batch in pairs) / n, differences[worst])
+    return comparison
+
+
+def validated(comparison : dict, tolerance = VALIDATION_TOLERANCE) -> bool:
+    '''
+    True if all KPIs of a validate() comparison agree within tolerance in every replication
+    '''
+    return all(difference <= tolerance for _, _, difference in comparison.values())
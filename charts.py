@@ -0,0 +1,224 @@
+# -*- coding: UTF-8 -*-
+
+import datetime
+
+import numpy as np
+
+# Chart layer of the results display.
+# The raw simulation output is reduced once per finished job: histograms are binned here,
+# the power and queue series are downsampled with LTTB (Largest-Triangle-Three-Buckets),
+# so the browser only receives a few thousand points per chart, independent of the number
+# of simulated days. The charts are rendered client side by Altair (Vega-Lite), which is
+# imported lazily, so the simulation workers never pay for it.
+
+# max. number of points per plotted time series
+MAX_POINTS = 2000
+# time axis origin, the simulation time is given in seconds from midnight of the first day
+TIME_ORIGIN = datetime.datetime(2022, 1, 1)
+
+# colors of the former matplotlib figures
+BLUE = "#005293"
+BLUE_MID = "#64A0C8"
+BLUE_LIGHT = "#98C6EA"
+
+
+######################################################################
+########################## data reduction ############################
+######################################################################
+
+def lttb(x, y, n_out = MAX_POINTS):
+    '''
+    downsample the series (x, y) to n_out points with Largest-Triangle-Three-Buckets,
+    peaks and valleys survive, the first and the last point are always kept
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # n_out-2 buckets between the fixed first and last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0                                   # point selected in the previous bucket
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        # average point of the next bucket (the last point for the last bucket)
+        next_lo = edges[b + 1]
+        next_hi = edges[b + 2] if b + 2 < n_out - 1 else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        # twice the triangle area spanned by a, the candidate and the next average
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[b + 1] = a
+    return x[idx], y[idx]
+
+
+def histogram(datasets : dict, bins):
+    '''
+    bin several datasets on common bin edges (as matplotlib hist does for a list of datasets)
+    return a list of rows (group, bin_start, bin_end, count)
+    '''
+    values = [np.asarray(v, dtype=np.float64) for v in datasets.values()]
+    combined = np.concatenate(values) if len(values) != 0 else np.empty(0)
+    edges = np.histogram_bin_edges(combined, bins=bins)
+    rows = []
+    for group, v in zip(datasets, values):
+        counts, _ = np.histogram(v, bins=edges)
+        for i, c in enumerate(counts):
+            rows.append((group, edges[i], edges[i + 1], int(c)))
+    return rows
+
+
+def first_user_per_tick(user_list, sim_ticks):
+    '''
+    the first user (in list order) arrived at every tick of the simulation,
+    same selection as the former "for i in range(sim_ticks): for user ...: break" loops
+    '''
+    seen = set()
+    first = []
+    for user in user_list:
+        if 0 <= user.sequence < sim_ticks and user.sequence not in seen:
+            seen.add(user.sequence)
+            first.append(user)
+    return first
+
+
+def users_in_ticks(user_list, sim_ticks):
+    '''
+    all users arrived within the simulated ticks
+    '''
+    return [user for user in user_list if 0 <= user.sequence < sim_ticks]
+
+
+def prepare_chart_data(swap_user_wait_time, charge_user_wait_time, queue_length_swap, queue_length_charge, user_dist_lst,
+                       max_power, power_history, swap_list, BS_charge_list, non_BS_charge_list, sim_ticks, sim_interval,
+                       max_points = MAX_POINTS):
+    '''
+    reduce one simulation result to the plain data of the result charts, run once per job
+    '''
+    to_min = sim_interval / 60.0
+
+    # power of the station and grid interaction, downsampled
+    power = np.array([pw[1] for pw in power_history], dtype=np.float64)
+    t = np.arange(len(power)) * sim_interval
+    t_power, y_power = lttb(t, np.maximum(power, 0), max_points)
+    t_grid, y_grid = lttb(t, np.minimum(power, 0), max_points)
+    power_mean = float(np.mean(np.maximum(power, 0))) if len(power) != 0 else 0.0
+
+    # queue length, downsampled
+    t = np.arange(len(queue_length_swap)) * sim_interval
+    t_swap_queue, y_swap_queue = lttb(t, queue_length_swap, max_points)
+    t = np.arange(len(queue_length_charge)) * sim_interval
+    t_charge_queue, y_charge_queue = lttb(t, queue_length_charge, max_points)
+
+    # service times of the charge and swap users
+    BS_charge_users = first_user_per_tick(BS_charge_list, sim_ticks)
+    non_BS_charge_users = users_in_ticks(non_BS_charge_list, sim_ticks)
+    swap_users = first_user_per_tick(swap_list, sim_ticks)
+
+    return {
+        "power" : [("Power Distribution", t_power, y_power), ("Grid Interaction", t_grid, y_grid)],
+        "power_mean" : power_mean,
+        "max_power" : max_power,
+        "queue" : [("Swap Queue", t_swap_queue, y_swap_queue), ("Charge Queue", t_charge_queue, y_charge_queue)],
+        "user_num" : len(user_dist_lst),
+        "arrival_hist" : histogram({"User": user_dist_lst}, bins=48),
+        "charge_service_hist" : histogram({
+            "BS user": [u.charge_service_time() * to_min for u in BS_charge_users],
+            "NBS user": [u.charge_service_time() * to_min for u in non_BS_charge_users]}, bins=15),
+        "charge_time_hist" : histogram({
+            "BS user": [u.charge_service_time(mode=0) * to_min for u in BS_charge_users],
+            "NBS user": [u.charge_service_time(mode=0) * to_min for u in non_BS_charge_users]}, bins=15),
+        "swap_service_hist" : histogram({"Swap user": [u.swap_service_time * to_min for u in swap_users]}, bins=30),
+        "wait_hist" : histogram({
+            "Swap Group Wait Time": swap_user_wait_time,
+            "Charge Group Wait Time": charge_user_wait_time}, bins=15),
+        "clients" : [("swap", len(swap_list)), ("charge(BS)", len(BS_charge_list)), ("charge(NBS)", len(non_BS_charge_list))],
+    }
+
+
+######################################################################
+############################ chart building ##########################
+######################################################################
+
+def _time_frame(series):
+    '''
+    long format DataFrame (time, value, series) of a list of (name, t in sec, y)
+    '''
+    import pandas as pd
+    frames = [pd.DataFrame({"time": pd.Timestamp(TIME_ORIGIN) + pd.to_timedelta(t, unit="s"), "value": y, "series": name})
+              for name, t, y in series]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _line_chart(series, colors, title, y_title):
+    import altair as alt
+    return alt.Chart(_time_frame(series), title=title).mark_line().encode(
+        x=alt.X("time:T", title="Time series", axis=alt.Axis(format="%H:%M")),
+        y=alt.Y("value:Q", title=y_title),
+        color=alt.Color("series:N", title=None, scale=alt.Scale(domain=[s[0] for s in series], range=colors)),
+        tooltip=[alt.Tooltip("time:T", format="%d.%m %H:%M:%S"), "series:N", alt.Tooltip("value:Q", format=".2f")]
+    ).interactive(bind_y=False)
+
+
+def _hist_chart(rows, colors, title, x_title, y_title = "Counts", temporal = False):
+    import altair as alt
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=["group", "bin_start", "bin_end", "count"])
+    if temporal:
+        df["bin_start"] = pd.Timestamp(TIME_ORIGIN) + pd.to_timedelta(df["bin_start"], unit="s")
+        df["bin_end"] = pd.Timestamp(TIME_ORIGIN) + pd.to_timedelta(df["bin_end"], unit="s")
+        x = alt.X("bin_start:T", title=x_title, axis=alt.Axis(format="%H:%M"))
+        x2 = "bin_end:T"
+    else:
+        x = alt.X("bin_start:Q", title=x_title)
+        x2 = "bin_end:Q"
+    groups = list(dict.fromkeys(df["group"]))
+    return alt.Chart(df, title=title).mark_bar(opacity=0.75, stroke="black", strokeWidth=0.5).encode(
+        x=x, x2=x2,
+        y=alt.Y("count:Q", title=y_title, stack=None),
+        color=alt.Color("group:N", title=None, scale=alt.Scale(domain=groups, range=colors[:len(groups)])),
+        tooltip=["group:N", "count:Q"]
+    )
+
+
+def build_result_charts(data : dict):
+    '''
+    build the eight result charts from prepare_chart_data(), return a dict name -> Altair chart
+    '''
+    import altair as alt
+    import pandas as pd
+
+    power = _line_chart(data["power"], [BLUE_MID, "red"], "BSS Power distribution",
+                        "BSS total power, max power = %.0f kW" % data["max_power"])
+    power_mean = alt.Chart(pd.DataFrame({"mean": [data["power_mean"]],
+                                         "text": ["Mean %.2f [kW]" % round(data["power_mean"], 2)]})).encode(y="mean:Q")
+    power = alt.layer(power,
+                      power_mean.mark_rule(strokeDash=[6, 4], color=BLUE_LIGHT),
+                      power_mean.mark_text(align="left", dy=-8, x=5, color=BLUE_LIGHT).encode(text="text:N"))
+
+    clients = pd.DataFrame(data["clients"], columns=["client", "number"])
+    clients = alt.Chart(clients, title="Clients Ratio").mark_arc(innerRadius=40).encode(
+        theta=alt.Theta("number:Q"),
+        color=alt.Color("client:N", title=None, scale=alt.Scale(domain=list(clients["client"]), range=[BLUE, BLUE_MID, BLUE_LIGHT])),
+        tooltip=["client:N", "number:Q"]
+    )
+
+    return {
+        "arrival" : _hist_chart(data["arrival_hist"], [BLUE], "User vehicles reach time distribution", "Time ticks",
+                                "User number in half hour, user total number = %d" % data["user_num"], temporal=True),
+        "power" : power,
+        "charge_service" : _hist_chart(data["charge_service_hist"], [BLUE, BLUE_LIGHT],
+                                       "Charge service time (Charge + Wait) distribution in 24 hours", "Charge service time in [min]"),
+        "swap_service" : _hist_chart(data["swap_service_hist"], [BLUE],
+                                     "Swap service time (Swap + Wait) distribution in 24 hours", "Swap service time in [min]"),
+        "charge_time" : _hist_chart(data["charge_time_hist"], [BLUE, BLUE_LIGHT],
+                                    "Charge time (without Wait) distribution in 24 hours", "Charge time distribution in [min]"),
+        "wait" : _hist_chart(data["wait_hist"], [BLUE, BLUE_MID], "Wait time distribution", "Wait time distribution [min]"),
+        "clients" : clients,
+        "queue" : _line_chart(data["queue"], [BLUE, BLUE_MID], "Queue length distribution", "Queue length"),
+    }
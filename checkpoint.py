@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import os
+import pickle
+import random
+import zlib
+
+import numpy as np
+
+import main
+
+# Checkpoint and restore of a running simulation.
+# A checkpoint holds the complete main.SimulationRun (station, racks, batteries, piles, queues, users,
+# results so far) together with the states of random and np.random, pickled and zlib compressed.
+# A restored run continues bit-identically to the uninterrupted one. Callbacks are not saved:
+# a recorder handed to resume only records the ticks after the checkpoint.
+# Loading a checkpoint unpickles it and so runs code of whoever wrote the file. The caches of snapshots and
+# models (prefix_cache.py, warmup.py, surrogate.py) therefore live in private_dir() folders of the current user
+# below CACHE_ROOT, never in the shared temp folder.
+
+# set up logger
+logger = logging.getLogger('main.checkpoint')
+
+CHECKPOINT_VERSION = 10
+# by default save every simulated day (10 s interval)
+CHECKPOINT_INTERVAL = 8640
+# root of the cache folders, ~/.cache/bss by default
+CACHE_ROOT = os.environ.get("BSS_CACHE_DIR", os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "bss"))
+
+
+def private_dir(path):
+    '''
+    create the folder path (mode 0o700) if needed and return it,
+    raise OSError if it is not owned by the current user or others can write to it
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):       # POSIX, on Windows the profile folders are private
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise OSError('%s is not a private folder of the current user' % path)
+    return path
+
+
+def dumps(run : main.SimulationRun, level = 6) -> bytes:
+    '''
+    serialize a run and the global RNG states into a compact byte string
+    '''
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "run": run,
+        "random": random.getstate(),
+        "np_random": np.random.get_state(),
+    }
+    return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), level)
+
+
+def loads(data : bytes, progress_callback = None, recorder = None) -> main.SimulationRun:
+    '''
+    restore a run from dumps(), the global RNG states are set to the saved ones
+    '''
+    state = pickle.loads(zlib.decompress(data))
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError('unsupported checkpoint version %s' % state.get("version"))
+    random.setstate(state["random"])
+    np.random.set_state(state["np_random"])
+    run = state["run"]
+    run.progress_callback = progress_callback
+    run.recorder = recorder
+    if recorder is not None:
+        recorder.start(run.station, run.param)
+    return run
+
+
+def save_checkpoint(run : main.SimulationRun, path, sync = True, level = 6):
+    '''
+    write a checkpoint file, the old file is replaced only once the new one is complete
+    sync: force the file to disk before replacing (off for disposable cache files)
+    '''
+    data = dumps(run, level=level)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    logger.info('checkpoint at tick %d saved to %s (%d bytes)', run.tick, path, len(data))
+
+
+def load_checkpoint(path, progress_callback = None, recorder = None) -> main.SimulationRun:
+    with open(path, "rb") as f:
+        run = loads(f.read(), progress_callback=progress_callback, recorder=recorder)
+    logger.info('checkpoint at tick %d loaded from %s', run.tick, path)
+    return run
+
+
+def run_with_checkpoints(param, path, interval = CHECKPOINT_INTERVAL, resume = True, progress_callback = None, recorder = None):
+    '''
+    execute a simulation and save a checkpoint to "path" every "interval" ticks
+    if resume is True and the checkpoint file exists, the run continues from it instead of starting anew
+    return the result tuple of main.do_simulation()
+    '''
+    if resume and os.path.exists(path):
+        run = load_checkpoint(path, progress_callback=progress_callback, recorder=recorder)
+    else:
+        run = main.SimulationRun(param, progress_callback=progress_callback, recorder=recorder)
+
+    while not run.done:
+        run.step()
+        if run.tick % interval == 0 and not run.done:
+            save_checkpoint(run, path)
+    run.finish()
+    return run.results()
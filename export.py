@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+# Export of full simulation results.
+# A SimulationRecorder is handed to main.do_simulation() and writes, while the simulation runs,
+#   trace.<ext>   one row per tick: time, station power, queue lengths and the SOC of every rack slot
+#   users.<ext>   one row per arrived user: arrival, service times, waiting times and outcome
+#   param.json    the simulation parameters
+# Tables are written in chunks by TraceWriter, so multi-day traces never have to fit into memory.
+# Format "parquet" needs the optional package pyarrow (one row group per chunk, zstd compressed),
+# format "npz" needs only NumPy (one compressed .npy member per chunk, readable with np.load).
+
+# set up logger
+logger = logging.getLogger('main.export')
+
+# rows per chunk (Parquet row group / .npy member), one chunk covers a simulated day at 10 s
+CHUNK_ROWS = 8640
+
+# fixed width of the text columns of the user table
+_TEXT = "U16"
+
+
+def _pyarrow():
+    '''
+    return (pyarrow, pyarrow.parquet) or None if pyarrow is not installed
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    return pa, pq
+
+
+def default_format():
+    return "parquet" if _pyarrow() is not None else "npz"
+
+
+class TraceWriter:
+    '''
+    streaming writer of one table with fixed columns
+    columns: list of (name, NumPy dtype), fmt: "parquet" or "npz"
+    '''
+    def __init__(self, path, columns, fmt = "parquet", chunk_rows = CHUNK_ROWS, compression = "zstd"):
+        self.path = path
+        self.fmt = fmt
+        self.dtype = np.dtype(list(columns))
+        self.chunk_rows = chunk_rows
+        self.rows = 0                                   # number of rows written so far
+        self._buffer = np.zeros(chunk_rows, dtype=self.dtype)
+        self._fill = 0
+        self._chunk = 0
+        self._closed = False
+        if fmt == "parquet":
+            arrow = _pyarrow()
+            if arrow is None:
+                raise ImportError('the parquet format needs pyarrow, install it or use fmt="npz"')
+            self._pa, pq = arrow
+            schema = self._pa.schema([(name, self._pa.from_numpy_dtype(self.dtype[name])) for name in self.dtype.names])
+            self._writer = pq.ParquetWriter(path, schema, compression=compression)
+        elif fmt == "npz":
+            self._writer = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            raise ValueError('unknown export format %s' % fmt)
+
+    def append(self, row):
+        '''
+        append one row given as a tuple in column order
+        '''
+        self._buffer[self._fill] = row
+        self._fill += 1
+        if self._fill == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self._fill == 0:
+            return
+        chunk = self._buffer[:self._fill]
+        if self.fmt == "parquet":
+            arrays = [self._pa.array(chunk[name]) for name in self.dtype.names]
+            self._writer.write_table(self._pa.Table.from_arrays(arrays, names=list(self.dtype.names)))
+        else:
+            with self._writer.open("chunk_%05d.npy" % self._chunk, "w") as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(chunk))
+        self.rows += self._fill
+        self._chunk += 1
+        self._fill = 0
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        if self.fmt == "npz" and self._chunk == 0:
+            # keep the columns of an empty table
+            with self._writer.open("chunk_00000.npy", "w") as f:
+                np.lib.format.write_array(f, self._buffer[:0])
+        self._writer.close()
+        self._closed = True
+
+
+def read_table(path, as_frame = True):
+    '''
+    read a table written by TraceWriter, return a pandas DataFrame (or a dict of NumPy arrays)
+    '''
+    if path.endswith(".parquet"):
+        arrow = _pyarrow()
+        if arrow is None:
+            raise ImportError('reading parquet files needs pyarrow')
+        table = arrow[1].read_table(path)
+        if as_frame:
+            return table.to_pandas()
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+
+    with np.load(path) as npz:
+        data = np.concatenate([npz[name] for name in sorted(npz.files)])
+    if as_frame:
+        import pandas as pd
+        return pd.DataFrame({name: data[name] for name in data.dtype.names})
+    return {name: data[name] for name in data.dtype.names}
+
+
+class SimulationRecorder:
+    '''
+    records the traces and user outcomes of one simulation run into the folder "directory"
+    usage: main.do_simulation(param, recorder=SimulationRecorder(path)), the files are complete after the run
+    '''
+    def __init__(self, directory, fmt = None, chunk_rows = CHUNK_ROWS, record_soc = True):
+        self.directory = directory
+        self.fmt = fmt if fmt is not None else default_format()
+        self.chunk_rows = chunk_rows
+        self.record_soc = record_soc
+        self.ext = "parquet" if self.fmt == "parquet" else "npz"
+        self.sim_interval = 10
+        self.users = []
+        self._racks = []
+        self._trace = None
+
+    def start(self, station, param):
+        '''
+        called once before the simulation loop, defines the trace columns from the station layout
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        self.sim_interval = param["sim_interval"]
+        with open(os.path.join(self.directory, "param.json"), "w") as f:
+            json.dump(param, f, indent=1, default=str)
+
+        columns = [("tick", np.int32), ("time", np.int64), ("power", np.float64),
+                   ("swap_queue", np.int32), ("charge_queue", np.int32)]
+        self._racks = []
+        if self.record_soc:
+            for sr in station.swap_rack_list:
+                for br in sr.battery_rack_list:
+                    self._racks.append(br)
+                    columns.append(("soc_%d_%d" % (sr.id, br.id), np.float32))
+        self._trace = TraceWriter(os.path.join(self.directory, "trace." + self.ext), columns, fmt=self.fmt, chunk_rows=self.chunk_rows)
+
+    def record_tick(self, tick, station, swap_queue_length, charge_queue_length):
+        '''
+        called at the end of every simulation tick
+        '''
+        row = [tick, tick * self.sim_interval, station.power, swap_queue_length, charge_queue_length]
+        for br in self._racks:
+            row.append(br.battery.soc if br.battery is not None else np.nan)
+        self._trace.append(tuple(row))
+
+    def record_user(self, user):
+        '''
+        called for every arriving user, the outcome is written when the run finishes
+        '''
+        self.users.append((user, user.battery.soc))
+
+    def _user_rows(self):
+        for user, arrival_soc in self.users:
+            if user.swap_complete_time != -1:
+                outcome = "swapped"
+            elif user.swap_start_time != -1:
+                outcome = "swapping"
+            elif user.charge_connect_time != -1:
+                outcome = "charged"
+            elif user.charge_preference == "leave":
+                outcome = "left"
+            elif user.status in ("balked", "reneged"):
+                outcome = user.status
+            else:
+                outcome = "waiting"
+            charged = user.charge_connect_time != -1
+            yield (user.user_id, user.sequence, user.user_type, user.charge_preference, outcome,
+                   user.battery.batterytype, arrival_soc,
+                   user.battery.soc,
+                   user.swap_start_time, user.swap_complete_time, user.swap_service_time,
+                   user.charge_connect_time, user.connect_pile if user.connect_pile is not None else -1,
+                   user.charge_service_time(mode=0) if charged else -1,
+                   user.charge_service_time(mode=1) if charged else -1)
+
+    def finish(self):
+        '''
+        write the user table and close all files
+        '''
+        columns = [("user_id", np.int64), ("arrival_tick", np.int32), ("user_type", _TEXT), ("preference", _TEXT),
+                   ("outcome", _TEXT), ("battery_type", _TEXT), ("arrival_soc", np.float64), ("final_soc", np.float64),
+                   ("swap_start_tick", np.int32), ("swap_complete_tick", np.int32), ("swap_service_ticks", np.int32),
+                   ("charge_connect_tick", np.int32), ("charge_pile", np.int32),
+                   ("charge_ticks", np.int32), ("charge_service_ticks", np.int32)]
+        writer = TraceWriter(os.path.join(self.directory, "users." + self.ext), columns, fmt=self.fmt, chunk_rows=self.chunk_rows)
+        for row in self._user_rows():
+            writer.append(row)
+        writer.close()
+        self.close()
+        logger.info('exported %d ticks and %d users to %s', self._trace.rows, writer.rows, self.directory)
+
+    def close(self):
+        '''
+        close the trace file, also used when a run is aborted
+        '''
+        if self._trace is not None:
+            self._trace.close()
+
+
+def archive(directory):
+    '''
+    pack the files of a recorded run into one zip archive, return its bytes
+    the tables are compressed already, so they are stored as they are
+    '''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name in sorted(os.listdir(directory)):
+            zf.write(os.path.join(directory, name), arcname=name,
+                     compress_type=zipfile.ZIP_DEFLATED if name.endswith(".json") else zipfile.ZIP_STORED)
+    return buffer.getvalue()
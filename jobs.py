@@ -0,0 +1,286 @@
+# -*- coding: UTF-8 -*-
+
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import export
+import main
+import prefix_cache
+
+# Background execution of simulations.
+# All Streamlit sessions of one GUI server share a single process pool, so a long run of one
+# planner neither freezes the script thread nor blocks the sessions of the other planners.
+# Progress and cancel flags are exchanged with the workers through a multiprocessing manager,
+# the entries of a job are removed from it as soon as the job has finished, failed or was cancelled.
+# Searches that distribute many simulations themselves (sizing, surrogate training) run as tasks:
+# a thread of the GUI server coordinates them and feeds their simulations to the shared pool, so the
+# script thread stays free and a rerun of the page does not lose the search.
+
+# set up logger
+logger = logging.getLogger('main.jobs')
+
+# number of worker processes shared by all sessions
+MAX_WORKERS = int(os.environ.get("BSS_MAX_WORKERS", os.cpu_count() or 1))
+# how many progress updates a worker reports per run (every update is one round trip to the manager)
+PROGRESS_STEPS = 100
+# number of tasks coordinated at the same time, further tasks are queued
+MAX_TASKS = 4
+
+_lock = threading.Lock()
+_executor = None
+_manager = None
+_progress = None            # shared dict job_id -> progress in [0, 1]
+_cancelled = None           # shared dict job_id -> True once cancel is requested
+_job_counter = itertools.count(1)
+_task_executor = None       # threads of the GUI server that coordinate the tasks
+
+
+class JobCancelled(Exception):
+    '''
+    raised inside a worker when the user cancelled the running job
+    '''
+
+
+def _get_pool():
+    '''
+    create the process pool and the manager on first use, they live as long as the GUI server
+    '''
+    global _executor, _manager, _progress, _cancelled
+    with _lock:
+        if _executor is None:
+            # spawn instead of fork: the Streamlit server is multi-threaded, and the simulation
+            # core imports only NumPy and the standard library, so fresh workers start quickly
+            ctx = multiprocessing.get_context("spawn")
+            _manager = ctx.Manager()
+            _progress = _manager.dict()
+            _cancelled = _manager.dict()
+            _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=ctx)
+            logger.info('simulation pool started with %d workers', MAX_WORKERS)
+        return _executor
+
+
+def pool():
+    '''
+    the shared process pool, for callers that distribute their own work on it (e.g. sizing.py)
+    '''
+    return _get_pool()
+
+
+def _run_job(job_id, param, progress, cancelled, export_dir = None):
+    '''
+    worker side: execute one simulation and report its progress,
+    if export_dir is given the full traces and user outcomes are written there (see export.py),
+    otherwise seeded runs reuse the common prefix of earlier runs (see prefix_cache.py)
+    '''
+    step = max(1, int(param["sim_ticks"] / PROGRESS_STEPS))
+
+    def report(tick, sim_ticks):
+        if tick % step == 0:
+            if cancelled.get(job_id, False):
+                raise JobCancelled('job %d cancelled at tick %d' % (job_id, tick))
+            progress[job_id] = tick / sim_ticks
+
+    if export_dir is None:
+        result = prefix_cache.cached_simulation(param, progress_callback=report)
+    else:
+        recorder = export.SimulationRecorder(export_dir)
+        try:
+            result = main.do_simulation(param, progress_callback=report, recorder=recorder)
+        finally:
+            recorder.close()
+    progress[job_id] = 1.0
+    return result
+
+
+class SimulationJob:
+    '''
+    handle of one submitted simulation, safe to keep in st.session_state
+    status: "queued", "running", "done", "cancelled" or "failed"
+    '''
+    def __init__(self, job_id, param, future, label = "", meta = None, export_dir = None):
+        self.id = job_id
+        self.param = param
+        self.export_dir = export_dir                    # folder of the exported traces, None if not recorded
+        self.label = label
+        self.meta = meta if meta is not None else {}    # free data of the submitter, e.g. GUI settings
+        self.submit_time = time.time()
+        self._final_progress = None                     # progress at the end of the job, once released
+        self._future = future
+        future.add_done_callback(self._release)
+
+    def _release(self, future):
+        '''
+        drop the shared progress and cancel entries of a finished job, they are kept in the handle
+        '''
+        try:
+            self._final_progress = _progress.pop(self.id, 0.0)
+            _cancelled.pop(self.id, None)
+        except (OSError, EOFError):
+            # manager already shut down at exit
+            self._final_progress = 0.0
+
+    @property
+    def status(self):
+        if self._future.cancelled():
+            return "cancelled"
+        if self._future.done():
+            exc = self._future.exception()
+            if exc is None:
+                return "done"
+            if isinstance(exc, JobCancelled):
+                return "cancelled"
+            return "failed"
+        if _cancelled is not None and _cancelled.get(self.id, False):
+            return "cancelled"
+        if self._future.running():
+            return "running"
+        return "queued"
+
+    def done(self):
+        return self._future.done()
+
+    def progress(self):
+        if self._future.done() and not self._future.cancelled() and self._future.exception() is None:
+            return 1.0
+        if self._final_progress is not None:
+            return self._final_progress
+        if _progress is None:
+            return 0.0
+        return _progress.get(self.id, 0.0)
+
+    def cancel(self):
+        '''
+        cancel a queued job at once, a running job stops at its next progress report
+        '''
+        if self._future.cancel():
+            return True
+        if not self._future.done():
+            _cancelled[self.id] = True
+            if self._future.done():
+                # finished in the meantime, the flag was set after _release
+                _cancelled.pop(self.id, None)
+            return True
+        return False
+
+    def error(self):
+        if self.status != "failed":
+            return None
+        return self._future.exception()
+
+    def result(self, timeout = None):
+        '''
+        return the tuple of main.do_simulation, blocks until the job has finished
+        '''
+        return self._future.result(timeout)
+
+
+def submit(param : dict, label = "", meta = None, export_dir = None) -> SimulationJob:
+    '''
+    queue a simulation on the shared pool and return its handle immediately
+    export_dir: optional folder, the worker records the full results of the run there
+    '''
+    executor = _get_pool()
+    job_id = next(_job_counter)
+    _progress[job_id] = 0.0
+    future = executor.submit(_run_job, job_id, param, _progress, _cancelled, export_dir)
+    logger.info('job %d submitted: %s', job_id, label)
+    return SimulationJob(job_id, param, future, label=label, meta=meta, export_dir=export_dir)
+
+
+def _run_task(task, fn):
+    '''
+    thread side: execute a task function, it reports through task.report
+    '''
+    result = fn(task.report)
+    task._progress = 1.0
+    return result
+
+
+class TaskJob:
+    '''
+    handle of one submitted task, safe to keep in st.session_state, same status values as SimulationJob
+    '''
+    def __init__(self, job_id, label = "", meta = None):
+        self.id = job_id
+        self.label = label
+        self.meta = meta if meta is not None else {}
+        self.submit_time = time.time()
+        self.text = ""                  # last progress text of the task
+        self._progress = 0.0
+        self._cancel_requested = False
+        self._future = None
+
+    def report(self, progress, text = ""):
+        '''
+        called by the task: progress in [0, 1], raises JobCancelled once cancel is requested
+        '''
+        if self._cancel_requested:
+            raise JobCancelled('task %d cancelled' % self.id)
+        self._progress = progress
+        self.text = text
+
+    @property
+    def status(self):
+        if self._future.cancelled():
+            return "cancelled"
+        if self._future.done():
+            exc = self._future.exception()
+            if exc is None:
+                return "done"
+            if isinstance(exc, JobCancelled):
+                return "cancelled"
+            return "failed"
+        if self._cancel_requested:
+            return "cancelled"
+        if self._future.running():
+            return "running"
+        return "queued"
+
+    def done(self):
+        return self._future.done()
+
+    def progress(self):
+        return self._progress
+
+    def cancel(self):
+        '''
+        cancel a queued task at once, a running task stops at its next progress report
+        (the simulations it has queued on the pool and not started yet are dropped with it)
+        '''
+        if self._future.cancel():
+            return True
+        if not self._future.done():
+            self._cancel_requested = True
+            return True
+        return False
+
+    def error(self):
+        if self.status != "failed":
+            return None
+        return self._future.exception()
+
+    def result(self, timeout = None):
+        '''
+        return the value of the task function, blocks until the task has finished
+        '''
+        return self._future.result(timeout)
+
+
+def submit_task(fn, label = "", meta = None) -> TaskJob:
+    '''
+    run fn(report) in a thread of the GUI server and return its handle immediately,
+    fn distributes its simulations on pool() and calls report(progress, text) regularly
+    '''
+    global _task_executor
+    with _lock:
+        if _task_executor is None:
+            _task_executor = ThreadPoolExecutor(max_workers=MAX_TASKS, thread_name_prefix="bss_task")
+    task = TaskJob(next(_job_counter), label=label, meta=meta)
+    task._future = _task_executor.submit(_run_task, task, fn)
+    logger.info('task %d submitted: %s', task.id, label)
+    return task
@@ -4,23 +4,29 @@ import logging
 import logging.config
 import swap
 import users
-import queue
+import collections
+import heapq
+import math
+import random
 from swap import Battery, SwapStation
-import global_param
 import numpy as np
-import pandas as pd
-
-# GP = global_param.Global_Parameter()
-GC = global_param.Global_Constant()
 
 logger = logging.getLogger('main')
 data_logger=logging.getLogger('data')
 
+# user abandonment (param["user_abandonment"]): default patience in the queues and default charge time limit [min],
+# -1 = no limit; slots of the timer wheel that holds the deadlines [ticks]
+USER_PATIENCE = 30
+MAX_CHARGE_TIME = -1
+WHEEL_SLOTS = 512
+
 
 def log_data(station : swap.SwapStation, t_timer : int):
     '''
     log the simulation data in form of [time, power]
     '''
+    if not data_logger.isEnabledFor(logging.DEBUG):                                     # the data logger is off by default
+        return
     data = ""
     data = data + 'timer<%d>, ' %t_timer
     for sr in station.swap_rack_list:
@@ -30,7 +36,7 @@ def log_data(station : swap.SwapStation, t_timer : int):
 
         if sr.power_cabinet is not None:
             for module in sr.power_cabinet.module_list:
-                if module.status == "in_use":
+                if module.state == swap.IN_USE:
                     pass
 
     data = data + '%d' %station.power
@@ -40,25 +46,54 @@ def log_data(station : swap.SwapStation, t_timer : int):
         data_logger.debug(data)    
         pass
 
-def simulation_action_callback(station : swap.SwapStation, t_timer : int, interval : int, current_user : users.User):
+def mean_rack_soc(station : swap.SwapStation) -> float:
+    '''
+    mean SOC of the batteries stored in the swap racks
+    '''
+    soc = [br.battery.soc for sr in station.swap_rack_list for br in sr.battery_rack_list if br.battery is not None]
+    return sum(soc) / len(soc) if len(soc) > 0 else 0.0
+
+def simulation_action_callback(station : swap.SwapStation, t_timer : int, interval : int, current_users : list):
     '''
     参数说明：
     station:        SwapStatin Class, representing the battery swap station entity used for simulation
     t_timer:        int, which is the current simulation cycle block, usually counter i                               -> from range(sim_ticks)
     interval:       int，is the current simulation period, in seconds, interval = 10 indicates a simulation step of 10 seconds      -> sim_interval
-    current_user:   current user object in the BSS
+    current_users:  current user object (or None) of every swap lane of the BSS
     '''
-    swap_result = station.do_swap(current_user, t_timer, interval)               # operate the swap behaviour, return True or False
+    swap_result = station.do_swap(current_users, t_timer, interval)              # operate the swap behaviour, return True or False per swap lane
     if station.trigger[-1] == 0:                                                                  # if grid interaction not activated -> do normal charge
         station.do_charge(t_timer, interval)
     else:                                                                                 # if grid interaction activated -> do discharge
         station.do_grid_interaction_discharge(t_timer, interval)
     
     log_data(station, t_timer)                                                            # logging the data
+    if swap.CHECK_STATES:                                                                 # debug mode: check the states of the racks and piles
+        station.check_states()
     
     return swap_result
 
-def add_users(param: dict, station : swap.SwapStation, user_dist_list : list, user_label : list, swap_queue, charge_queue, BS_charge_list : list, non_BS_charge_list : list, t_timer : int, interval : int):
+def create_user_sequence(param : dict):
+    '''
+    arrival timestamps and labels of the users of a run, in the queue generation mode of param
+    '''
+    if param["user_sequence_mode"] == "random" and param["opening_hours"] == "24 hours":
+        # queue generation mode "random"
+        BS_user_num = param["BS_user_num"]                    # define the number of daily BS clients
+        non_BS_user_num = param["non_BS_user_num"]            # define the number of daily non BS clients
+        return users.create_user_queue_random(BS_user_num, non_BS_user_num)        # 根据user_distribtion.dat定义的分布规律，生成一个用户列表，user_dist_lst 记录用户到达的timestamp
+    elif param["user_sequence_mode"] == "random" and param["opening_hours"] == "9:00 to 19:30":
+        # queue generation mode "random"
+        BS_user_num = param["BS_user_num"]                    # define the number of daily BS clients
+        non_BS_user_num = param["non_BS_user_num"]            # define the number of daily non BS clients
+        return users.create_user_queue_random_opening(BS_user_num, non_BS_user_num)
+    else:
+        # queue generation mode "statistical"
+        area = param["user_area"]
+        non_BS_user_num = param["non_BS_user_num"]
+        return users.create_user_queue_statistical(area=area, non_BS_user_num = non_BS_user_num) # 根据GC中的user_dist_file_list列表中的文件(data文件夹下)，随机选取一个定义的一天内到达时间生成用户序列
+
+def add_users(param: dict, station : swap.SwapStation, user_dist_list : list, user_label : list, swap_queue, charge_queue, BS_charge_list : list, non_BS_charge_list : list, t_timer : int, interval : int, recorder = None):
     '''
     This function is used in a simulation cycle. The function checks the preset user arrival sequence. 
     If a user arrives during the current simulation period, a user will be generated and added to the battery swap station queue sequence.
@@ -72,13 +107,17 @@ def add_users(param: dict, station : swap.SwapStation, user_dist_list : list, us
     non_BS_charge_list:    Charging queue list (non-BS users), list form, main program definition, passed in as a parameter
     t_timer:               int, which is the current simulation cycle time point, usually counter i (= user arrival time)
     interval:              int, which is the simulation cycle step size, the unit is seconds, interval=10 indicates a simulation step size of 10 seconds
+    recorder:              optional export.SimulationRecorder, every arriving user is handed to it
+    With param["user_abandonment"] a user balks (does not join) a queue of max_wait_number users or more.
+    Return value: the users arriving in this cycle
     '''
-
+    arrivals = []
     # Check whether there are users who need service in the current time interval. service_n returns the timestamp list of user arrivals in the current iteration. label_n returns the category of the user.
     # Indicates how many users arrive in a simulation cycle. Note that more than one user may arrive in a simulation cycle.
     service_n, label_n = users.check_seq(t_timer, interval, user_dist_list, user_label)
     
     if len(service_n) > 0: #If more than one user arrives
+        users.set_sampling(param.get("antithetic", 0))                                   # runs stepped in turns share the module state
         for i in range(len(service_n)):
             user_id = service_n[i]
             user_label = label_n[i]
@@ -107,203 +146,512 @@ def add_users(param: dict, station : swap.SwapStation, user_dist_list : list, us
             # set up the temperature
             user.battery.temperature = param["swap_rack_temperature"]
 
+            # balking: the user does not join a queue that is too long
+            if param.get("user_abandonment") and user.charge_preference in ("swap", "charge"):
+                user.max_wait_number = param.get("max_wait_number", user.max_wait_number)
+                if len(swap_queue if user.charge_preference == "swap" else charge_queue) >= user.max_wait_number:
+                    user.status = "balked"
+                    logger.debug("timer<%d>: User %d balks at the %s queue", t_timer, user.user_id, user.charge_preference)
+
             # put user into different queue according to their selection preference
-            if user.charge_preference == "swap":
+            if user.charge_preference == "swap" and user.status != "balked":
                 swap_queue.put(user)
                 logger.debug('timer<%d>: push user %d into swap queue', t_timer , user_id)
 
-            if user.charge_preference == "charge":
+            if user.charge_preference == "charge" and user.status != "balked":
                 charge_queue.put(user)
 
             if user.charge_preference == "leave":
                 logger.info("timer<%d>: User %d abandons the service and chooses to leave" ,t_timer, user.user_id)
 
+            if recorder is not None:
+                recorder.record_user(user)
+            arrivals.append(user)
+    return arrivals
+
+class UserQueue:
+    '''
+    FIFO queue of waiting users with the put / get / qsize interface of queue.Queue, without its thread lock
+    (the simulation runs in one thread), picklable as it is
+    A user that leaves the queue (cancel) stays in the deque until get() reaches it, the sizes count only the others.
+    '''
+    def __init__(self):
+        self.queue = collections.deque()
+        self.cancelled = 0
+
+    def put(self, user):
+        self.queue.append(user)
+
+    def get(self):
+        user = self.queue.popleft()
+        while user.status == "reneged":
+            self.cancelled -= 1
+            user = self.queue.popleft()
+        return user
+
+    def cancel(self, user):
+        '''
+        take a waiting user out of the queue, the caller marks it "reneged"
+        '''
+        self.cancelled += 1
+
+    def qsize(self) -> int:
+        return len(self.queue) - self.cancelled
+
+    def __len__(self):
+        return len(self.queue) - self.cancelled
+
+
+class ChargeQueue:
+    '''
+    queue of the users waiting for a charge pile with a queue discipline (param["charge_queue_discipline"]):
+        "bs_priority":      BS users before non BS users, arrival order within the groups
+        "shortest_charge":  smallest SOC gap to target_soc (times the battery capacity) first
+        "reservation":      arrival order, but reserved_piles piles are kept for BS users: a non BS user only gets a pile
+                            while more piles are free, BS users behind it go first
+    The "fifo" discipline is a plain UserQueue. get(free_piles) returns the next user allowed to take one of
+    free_piles free piles, None if there is none. Cancelled users are skipped lazily as in UserQueue.
+    '''
+    DISCIPLINES = ("fifo", "bs_priority", "shortest_charge", "reservation")
+
+    def __init__(self, discipline, target_soc = 1.0, reserved_piles = 1):
+        if discipline not in self.DISCIPLINES[1:]:
+            raise ValueError('unknown charge queue discipline %s' % discipline)
+        self.discipline = discipline
+        self.target_soc = target_soc
+        self.reserved_piles = reserved_piles
+        self.groups = {"BS": collections.deque(), "non_BS": collections.deque()}    # entries (arrival number, user)
+        self.heap = []                                                              # entries (SOC gap, arrival number, user)
+        self.arrivals = 0
+        self.cancelled = 0
+
+    def put(self, user):
+        self.arrivals += 1
+        if self.discipline == "shortest_charge":
+            gap = (self.target_soc - user.battery.soc) * user.battery.capacity
+            heapq.heappush(self.heap, (gap, self.arrivals, user))
+        else:
+            self.groups["BS" if user.user_type == "BS" else "non_BS"].append((self.arrivals, user))
+
+    def _head(self, group):
+        queue = self.groups[group]
+        while len(queue) > 0 and queue[0][1].status == "reneged":
+            queue.popleft()
+            self.cancelled -= 1
+        return queue[0] if len(queue) > 0 else None
+
+    def get(self, free_piles = 1):
+        if self.discipline == "shortest_charge":
+            while len(self.heap) > 0:
+                user = heapq.heappop(self.heap)[2]
+                if user.status != "reneged":
+                    return user
+                self.cancelled -= 1
+            return None
+        bs, non_bs = self._head("BS"), self._head("non_BS")
+        if self.discipline == "reservation" and free_piles <= self.reserved_piles:
+            non_bs = None
+        if bs is not None and (non_bs is None or self.discipline == "bs_priority" or bs[0] < non_bs[0]):
+            return self.groups["BS"].popleft()[1]
+        if non_bs is not None:
+            return self.groups["non_BS"].popleft()[1]
+        return None
+
+    def cancel(self, user):
+        '''
+        take a waiting user out of the queue, the caller marks it "reneged"
+        '''
+        self.cancelled += 1
+
+    def qsize(self) -> int:
+        return len(self)
+
+    def __len__(self):
+        return len(self.heap) + len(self.groups["BS"]) + len(self.groups["non_BS"]) - self.cancelled
+
+
+class TimerWheel:
+    '''
+    deadlines in simulation ticks on a hashed timing wheel: slot tick % slots holds the timers of all rounds,
+    expire(tick) looks at one slot only, so a tick costs the timers of that slot and not a scan of all timers
+    '''
+    def __init__(self, slots = WHEEL_SLOTS):
+        self.slots = [[] for _ in range(slots)]
+
+    def schedule(self, tick, item):
+        self.slots[tick % len(self.slots)].append((tick, item))
+
+    def expire(self, tick) -> list:
+        '''
+        remove and return the items due at tick
+        '''
+        slot = self.slots[tick % len(self.slots)]
+        if len(slot) == 0:
+            return []
+        due = [item for t, item in slot if t <= tick]
+        if len(due) > 0:
+            slot[:] = [(t, item) for t, item in slot if t > tick]
+        return due
+
+
     ###################################################################################
     ############################## Simulation Loop ####################################
     ###################################################################################
-def do_simulation(param):
+class SimulationRun:
     '''
-    excute the simulation loop of the BSS
+    one simulation of the BSS, advanced tick by tick with step() or at once with run()
+    The run holds the complete simulation state (station, queues, users and the results collected so far),
+    checkpoint.py saves and restores it together with the RNG states.
+    param:              simulation parameters, optional key "seed" seeds random and np.random before the setup,
+                        optional key "antithetic" (+1 / -1) selects the sampling of users.set_sampling()
+    progress_callback:  optional callable(tick, sim_ticks), called at the start of every simulation tick.
+                        It may raise an exception to abort the run (used by jobs.py for cancellation)
+    recorder:           optional export.SimulationRecorder, streams the traces and user outcomes of the run to disk
+    station:            optional SwapStation to start with instead of a new one with all batteries at init_battery_soc_in_BSS,
+                        with param["warm_start"] it is taken from the warm station library of warmup.py
+    With param["truncate_warmup"] the average times and the 15 min swap ratio of results() skip the warm-up (see warmup.py)
+    param["charge_queue_discipline"] orders the charge queue (ChargeQueue), default "fifo".
+    With param["user_abandonment"] users give up: they balk at long queues (add_users), renege after
+    param["user_patience"] minutes without service and leave a charge pile after param["max_charge_time"] minutes.
+    The deadlines are kept in a TimerWheel.
     '''
+    def __init__(self, param, progress_callback=None, recorder=None, station=None):
+        ###################################################################################
+        ##################### Part 1: Simualtion parameters setting #######################
+        ###################################################################################
+        self.param = param
+        self.progress_callback = progress_callback
+        self.recorder = recorder
+        if station is None and param.get("warm_start"):
+            import warmup
+            station = warmup.warm_station(param)
+        if param.get("seed") is not None:
+            random.seed(param["seed"])
+            np.random.seed(param["seed"])
+        users.set_sampling(param.get("antithetic", 0))
+
+        self.sim_days = param["sim_days"]                           # define simulation days in int (by dafult 1)
+        self.sim_interval = param["sim_interval"]                   # define the simulation step in int, unit 1 sec
+        self.sim_ticks = param["sim_ticks"]                         # define the total simulation bins
+        if station is not None:
+            self.station = station                                  # warm station, batteries loaded and charging already
+        else:
+            self.station = SwapStation(param)                       # setup Swap station instance
+
+            # battery_actual_num = sum(list(param["battery_config"].values()))
+            # if battery_actual_num != station1.max_battery_number:       # check the battery num configuration
+            #     logger.error("battery num not identical, check battery_config")
+            #     return
+
+            # load the batteries into the swap rack
+            for i in param["battery_config"].items():
+                for num in range(i[1]):                             # i[1] = num of each battery type
+                    self.station.load_battery_auto(Battery(soc=param["init_battery_soc_in_BSS"], batterytype=i[0])) # i[0] = battery type
+
+            self.station.init_charge()                              # init the BSS charge modules, set select soc
+            self.station.set_temperature(rack_temperature=25, env_temperature=25)
+
+        self.user_dist_lst, self.user_label = create_user_sequence(param)
+
+        # change and modify the charge list into queue object
+        self.swap_queue = UserQueue()                               # define a FIFO queue object used for manage waiting clients, command: ".put()", ".get()"
+        self.charge_discipline = param.get("charge_queue_discipline", "fifo")
+        if self.charge_discipline == "fifo":
+            self.charge_queue = UserQueue()                         # define a FIFO queue for charging service
+        else:
+            self.charge_queue = ChargeQueue(self.charge_discipline, param["target_soc"], param.get("reserved_piles", 1))
+        self.BS_charge_list = []                                    # save for BS charged clients (BSC)
+        self.non_BS_charge_list = []                                # save for non_BS charged clients (BSC)
+        self.swap_list = []                                         # save for swap serviced clients (BSS)
+        self.swap_users = [None] * len(self.station.lanes)          # save for swap user object on every swap lane
+        self.abandonment = bool(param.get("user_abandonment"))      # users balk, renege and leave the piles early
+        self.deadlines = TimerWheel()                               # patience and charge time deadlines, items (kind, user)
+        self.balked_users = []
+        self.reneged_users = []
+        self.pile_timeouts = 0
+        self.charge_user = None                                     # save for charge user object
+        self.queue_length_swap = []                                 # save for queue length notation of swap
+        self.queue_length_charge = []                               # save for queue length notation of charge
+        self.swap_user_wait_time = []
+        self.charge_user_wait_time = []
+        self.soc_history = [] if param.get("truncate_warmup") else None  # mean rack SOC per tick, for the warm-up detection
+        self.warmup_tick = 0                                        # first tick counted in the averages of results()
+        self.tick = 0                                               # next simulation tick to execute
+        self.finished = False
+
+        if recorder is not None:
+            recorder.start(self.station, param)
+
     ###################################################################################
-    ##################### Part 1: Simualtion parameters setting #######################
     ###################################################################################
-    sim_days = param["sim_days"]                                # define simulation days in int (by dafult 1)
-    sim_interval = param["sim_interval"]                        # define the simulation step in int, unit 1 sec
-    sim_ticks = param["sim_ticks"]                              # define the total simulation bins    
-    station1 = SwapStation(param)                               # setup Swap station instance 
-
-    # battery_actual_num = sum(list(param["battery_config"].values()))
-    # if battery_actual_num != station1.max_battery_number:       # check the battery num configuration
-    #     logger.error("battery num not identical, check battery_config")
-    #     return
-    
-    # load the batteries into the swap rack
-    for i in param["battery_config"].items():
-        for num in range(i[1]):                                 # i[1] = num of each battery type
-            station1.load_battery_auto(Battery(soc=param["init_battery_soc_in_BSS"], batterytype=i[0])) # i[0] = battery type
+    def __getstate__(self):
+        '''
+        state for pickling: callbacks are not part of the state
+        '''
+        state = self.__dict__.copy()
+        state["progress_callback"] = None
+        state["recorder"] = None
+        return state
+
+    @property
+    def done(self):
+        return self.tick >= self.sim_ticks
 
-    station1.init_charge()                                      # init the BSS charge modules, set select soc
-    station1.set_temperature(rack_temperature=25, env_temperature=25)
-    
-    if param["user_sequence_mode"] == "random" and param["opening_hours"] == "24 hours":
-        # queue generation mode "random"
-        BS_user_num = param["BS_user_num"]                    # define the number of daily BS clients
-        non_BS_user_num = param["non_BS_user_num"]            # define the number of daily non BS clients
-        user_dist_lst, user_label = users.create_user_queue_random(BS_user_num, non_BS_user_num)        # 根据user_distribtion.dat定义的分布规律，生成一个用户列表，user_dist_lst 记录用户到达的timestamp
-    elif param["user_sequence_mode"] == "random" and param["opening_hours"] == "9:00 to 19:30":
-        # queue generation mode "random"
-        BS_user_num = param["BS_user_num"]                    # define the number of daily BS clients
-        non_BS_user_num = param["non_BS_user_num"]            # define the number of daily non BS clients
-        user_dist_lst, user_label = users.create_user_queue_random_opening(BS_user_num, non_BS_user_num)
-    else:
-        # queue generation mode "statistical"
-        area = param["user_area"]
-        non_BS_user_num = param["non_BS_user_num"] 
-        user_dist_lst, user_label = users.create_user_queue_statistical(area=area, non_BS_user_num = non_BS_user_num) # 根据GC中的user_dist_file_list列表中的文件(data文件夹下)，随机选取一个定义的一天内到达时间生成用户序列
-
-    # change and modify the charge list into queue object
-    swap_queue = queue.Queue()                                  # define a FIFO queue object used for manage waiting clients, command: ".put()", ".get()"
-    charge_queue = queue.Queue()                                # define a FIFO queue for charging service
-    BS_charge_list = []                                        # save for BS charged clients (BSC)
-    non_BS_charge_list = []                                    # save for non_BS charged clients (BSC)
-    swap_list = []                                              # save for swap serviced clients (BSS)
-    swap_user = None                                            # save for swap user object in the queue
-    charge_user = None                                          # save for charge user object
-    queue_length_swap = []                                      # save for queue length notation of swap
-    queue_length_charge = []                                    # save for queue length notation of charge
-    swap_user_wait_time = []
-    charge_user_wait_time = []
-    
     ###################################################################################
     ########################### Part 2: Simualtion Loop ###############################
     ###################################################################################
-    logger.info('start_simulatin')
-    
-    # interation every 10 sec for 24hrs (8640 interation steps)
-    for i in range(sim_ticks):
-        
+    def step(self):
+        '''
+        execute one simulation tick (10 sec by default)
+        '''
+        i = self.tick
+        param = self.param
+        station1 = self.station
+        swap_queue = self.swap_queue
+        charge_queue = self.charge_queue
+        sim_interval = self.sim_interval
+
+        if self.progress_callback is not None:
+            self.progress_callback(i, self.sim_ticks)
+
         #Check whether any user has arrived during the current simulation cycle. If so, add the user to service_queue.
-        add_users(param, station1, user_dist_lst, user_label, swap_queue, charge_queue, BS_charge_list, non_BS_charge_list, i, sim_interval) 
+        arrivals = add_users(param, station1, self.user_dist_lst, self.user_label, swap_queue, charge_queue, self.BS_charge_list, self.non_BS_charge_list, i, sim_interval, self.recorder)
+        if self.abandonment:
+            self.abandon(i, arrivals)
         # calculate the queue length for two group
-        queue_length_swap.append(swap_queue.qsize())
-        queue_length_charge.append(charge_queue.qsize())     
-
-        # process 1: No current servicing client, but there exists clients in the waiting queue
-        if swap_user is None and swap_queue.qsize() > 0: 
-            swap_user = swap_queue.get()
-            logger.debug('timer<%d>: Set Swap User No. (%d), total %d users remains in waitlist', i, swap_user.user_id, swap_queue.qsize())
-        
-        if charge_user is None and charge_queue.qsize()> 0:
-            charge_user = charge_queue.get()
-        
+        self.queue_length_swap.append(len(swap_queue))
+        self.queue_length_charge.append(len(charge_queue))
+        if self.soc_history is not None:
+            self.soc_history.append(mean_rack_soc(station1))
+
+        # process 1: No current servicing client on a swap lane, but there exists clients in the waiting queue
+        swap_users = self.swap_users
+        for lane, swap_user in enumerate(swap_users):
+            if swap_user is None and len(swap_queue) > 0:
+                swap_users[lane] = swap_queue.get()
+                logger.debug('timer<%d>: Set Swap User No. (%d), total %d users remains in waitlist', i, swap_users[lane].user_id, len(swap_queue))
+
+        # FIFO takes the next charge user at once, it waits for a pile at the head of the line; the other disciplines
+        # pick a user only when a pile is free, so a later arrival with a higher priority is not blocked
+        if self.charge_user is None and len(charge_queue) > 0:
+            if self.charge_discipline == "fifo":
+                self.charge_user = charge_queue.get()
+            elif station1.free_pile_count() > 0:
+                self.charge_user = charge_queue.get(station1.free_pile_count())
+
+        charge_user = self.charge_user
+
         # process 2: there exists client in the service
-        if swap_user is not None:
-            if station1.start_swap(swap_user.battery, swap_targetsoc = param["select_soc"]):
-                logger.debug('timer<%d>: User #%d start swap',i, swap_user.user_id)
-                swap_user.swap_start_time = i
-                swap_user_wait_time.append(swap_user.swap_waiting_time())
-        
+        for lane, swap_user in enumerate(swap_users):
+            if swap_user is not None:
+                if station1.start_swap(swap_user.battery, swap_targetsoc = param["select_soc"], lane = lane):
+                    logger.debug('timer<%d>: User #%d start swap',i, swap_user.user_id)
+                    swap_user.status = "swaping"
+                    swap_user.swap_start_time = i
+                    self.swap_user_wait_time.append(swap_user.swap_waiting_time())
+
         if charge_user is not None:
             charge_user.battery.target_max_soc = param["target_soc"]   #Defines the maximum SOC the user wishes to achieve
-            pile_id = station1.vehicle_charge(charge_user.battery)      #Try to connect the user to a charging station  
+            pile_id = station1.vehicle_charge(charge_user.battery)      #Try to connect the user to a charging station
             # case 1: successful connect to a charge pile
-            if pile_id >= 0: 
+            if pile_id >= 0:
+                charge_user.status = "charging"
                 charge_user.charge_connect_time = i
                 charge_user.connect_pile = pile_id
-                charge_user_wait_time.append(charge_user.charge_waiting_time())
+                if self.abandonment and charge_user.max_charge_time > 0:
+                    self.deadlines.schedule(i + max(1, math.ceil(charge_user.max_charge_time / sim_interval)), ("pile", charge_user))
+                self.charge_user_wait_time.append(charge_user.charge_waiting_time())
                 # devide the charge list into BS and non_BS user list
                 if charge_user.user_type == "BS":
-                    BS_charge_list.append(charge_user)
+                    self.BS_charge_list.append(charge_user)
                 else:
-                    non_BS_charge_list.append(charge_user)
+                    self.non_BS_charge_list.append(charge_user)
                 logger.debug('timer<%d>: Connect user %d to charge pile %d', i , charge_user.user_id, pile_id)
-                charge_user = None
+                self.charge_user = None
             # case 2: failed to connect to a charge pile
             else:
                 # charge user waiting for a place
                 pass
                 # logger.info('timer<%d>: User %d can not find free charger,user left', i , user.id)
-        
+
         # process 3: clients who select swap
-        swaptrigger = simulation_action_callback(station1, i, sim_interval, swap_user) # user -> do_swap & batteries in hotel charge
-        if swaptrigger == True: #执行仿真周期内需要完成的动作 do_swap, do_charge
-            logger.debug('timer<%d>: User #%d complete swap', i, swap_user.user_id)
-            swap_user.swap_complete_time = i
-            swap_user.swap_service_time = i - swap_user.sequence
-            swap_list.append(swap_user)
-            swap_user = None
-        
-
-        
+        swaptrigger = simulation_action_callback(station1, i, sim_interval, swap_users) # user -> do_swap & batteries in hotel charge
+        for lane, completed in enumerate(swaptrigger):
+            if completed: #执行仿真周期内需要完成的动作 do_swap, do_charge
+                swap_user = swap_users[lane]
+                logger.debug('timer<%d>: User #%d complete swap', i, swap_user.user_id)
+                swap_user.swap_complete_time = i
+                swap_user.swap_service_time = i - swap_user.sequence
+                self.swap_list.append(swap_user)
+                swap_users[lane] = None
+
+        if self.recorder is not None:
+            self.recorder.record_tick(i, station1, self.queue_length_swap[-1], self.queue_length_charge[-1])
+
+        self.tick = i + 1
+
+    def abandon(self, i, arrivals : list):
+        '''
+        set the deadlines of the users arriving in tick i, let the users whose deadline is tick i give up:
+        a waiting user reneges (leaves its queue, swap lane or the charge connection), a charging user leaves the pile
+        '''
+        param = self.param
+        patience = param.get("user_patience", USER_PATIENCE)
+        max_charge_time = param.get("max_charge_time", MAX_CHARGE_TIME)
+        for user in arrivals:
+            if user.status == "balked":
+                self.balked_users.append(user)
+                continue
+            if user.charge_preference not in ("swap", "charge"):
+                continue
+            user.max_wait_time = patience * 60 if patience > 0 else -1
+            user.max_charge_time = max_charge_time * 60 if max_charge_time > 0 else -1
+            if user.max_wait_time > 0:
+                self.deadlines.schedule(i + max(1, math.ceil(user.max_wait_time / self.sim_interval)), ("renege", user))
+        for kind, user in self.deadlines.expire(i):
+            if kind == "renege" and user.status == "waiting":
+                if user in self.swap_users:
+                    self.swap_users[self.swap_users.index(user)] = None
+                elif user is self.charge_user:
+                    self.charge_user = None
+                else:
+                    (self.swap_queue if user.charge_preference == "swap" else self.charge_queue).cancel(user)
+                user.status = "reneged"
+                self.reneged_users.append(user)
+                logger.debug('timer<%d>: User %d reneges after %d ticks', i, user.user_id, i - user.sequence)
+            elif kind == "pile" and user.status == "charging":
+                if self.station.vehicle_stop_charge(user.battery) >= 0:
+                    self.pile_timeouts += 1
+                    logger.debug('timer<%d>: User %d leaves the charge pile at the charge time limit', i, user.user_id)
+                user.status = "charged"
+
+    def run(self):
+        '''
+        execute the remaining simulation ticks and finish the run
+        '''
+        if self.tick == 0:
+            logger.info('start_simulatin')
+        # interation every 10 sec for 24hrs (8640 interation steps)
+        while self.tick < self.sim_ticks:
+            self.step()
+        self.finish()
+        return self
+
+    def finish(self):
+        '''
+        close the recorder once all ticks are executed
+        '''
+        if not self.finished and self.done:
+            self.finished = True
+            if self.recorder is not None:
+                self.recorder.finish()
+
     ###################################################################################
     ##################### Part 3: Data Analysis & Plot ################################
     ###################################################################################
+    def results(self):
+        '''
+        return the result tuple of do_simulation()
+        '''
+        sim_ticks = self.sim_ticks
+        sim_interval = self.sim_interval
+        station1 = self.station
+        swap_list = self.swap_list
+        BS_charge_list = self.BS_charge_list
+        non_BS_charge_list = self.non_BS_charge_list
+        queue_length_swap = self.queue_length_swap
 
-    # Here calculate the total number of swap/charge clients
-    logger.info('Total swap user %d', len(swap_list))
-    logger.info('Total charge user %d', len(BS_charge_list) + len(non_BS_charge_list))
-    
-    # calculate the average charge service time for BS user
-    if len(BS_charge_list) > 0:
-        c_average_time = 0
-        for charge_user in BS_charge_list:
-            c_average_time += abs(charge_user.charge_service_time())
-        logger.info('Average charge service time (BS user) = %.2f', (c_average_time / len(BS_charge_list)) * sim_interval / 60.0)    
-        BS_average_time_charge = (c_average_time / len(BS_charge_list)) * sim_interval / 60.0
-    else:
-        c_average_time = 0
-        BS_average_time_charge = 0
-    
-    # Here calculate the average charge service time for Non BS user
-    if len(non_BS_charge_list) > 0:
-        c_average_time_non_BS = 0
-        for charge_user in non_BS_charge_list:
-            c_average_time_non_BS += abs(charge_user.charge_service_time())
-        logger.info('Average charge service time (Non BS user) = %.2f', (c_average_time_non_BS / len(non_BS_charge_list)) * sim_interval / 60.0)    
-        non_BS_average_time_charge = (c_average_time_non_BS / len(non_BS_charge_list)) * sim_interval / 60.0
-    else:
-        c_average_time_non_BS = 0
-        non_BS_average_time_charge = 0
-
-    # Here calculate the average swap service time
-    if len(swap_list) > 0:
-        s_average_time = 0
-        for swap_user in swap_list:
-            s_average_time += swap_user.swap_service_time
-        logger.info('Average swap service time = %.2f', (s_average_time / len(swap_list)) * sim_interval / 60.0)
-        average_time_swap = (s_average_time / len(swap_list)) * sim_interval / 60.0
-    else:
-        average_time_swap = 0
-    
-    # Here calculate the residual power distribution
-    residual_power = []
-    for pw in station1.power_history:
-        residual_temp = station1.max_power - pw[1]
-        residual_power.append(residual_temp)
-    
-    # Here calculate the success ratio within 15 min for swap
-    swap_time_list = []
-    count = 0
-    for i in range(sim_ticks):
-        for user in swap_list:
-            if user.sequence == i:
-                swap_time_list.append(user.swap_service_time * sim_interval / 60.0)
-                break
-    for num in swap_time_list:
-        if num <= 15:
-            count += 1
-    
-    if len(swap_time_list) > 0:
-        # ratio = successful count / (serviced number of user + unserviced overflow number of user)
-        swap_ratio_in_15_min = count / (len(swap_time_list) + queue_length_swap[-1])
-    else:
-        swap_ratio_in_15_min = 0
-    
-    # Here calculate the wait time into [minutes]
-    swap_user_wait_time = [s * sim_interval/60 for s in swap_user_wait_time]
-    charge_user_wait_time = [s * sim_interval/60 for s in charge_user_wait_time]
+        # Here calculate the total number of swap/charge clients
+        logger.info('Total swap user %d', len(swap_list))
+        logger.info('Total charge user %d', len(BS_charge_list) + len(non_BS_charge_list))
+        if self.abandonment:
+            logger.info('Users balked %d, reneged %d, charge time limit reached %d', len(self.balked_users), len(self.reneged_users), self.pile_timeouts)
+
+        # the lists of all users are returned, the averages below only count users after the warm-up
+        all_swap_list, all_BS_charge_list, all_non_BS_charge_list = swap_list, BS_charge_list, non_BS_charge_list
+        balked_users, reneged_users = self.balked_users, self.reneged_users
+        if self.param.get("truncate_warmup"):
+            import warmup
+            self.warmup_tick = warmup.detect_warmup(self)
+            logger.info('Warm-up truncated at tick %d', self.warmup_tick)
+            swap_list = [user for user in swap_list if user.sequence >= self.warmup_tick]
+            BS_charge_list = [user for user in BS_charge_list if user.sequence >= self.warmup_tick]
+            non_BS_charge_list = [user for user in non_BS_charge_list if user.sequence >= self.warmup_tick]
+            balked_users = [user for user in balked_users if user.sequence >= self.warmup_tick]
+            reneged_users = [user for user in reneged_users if user.sequence >= self.warmup_tick]
+
+        # users who gave up (user_abandonment), the swap users among them count as misses of the 15 min swap ratio
+        abandonment = {"balked_swap": 0, "balked_charge": 0, "reneged_swap": 0, "reneged_charge": 0, "pile_timeouts": self.pile_timeouts}
+        for kind, abandoned in (("balked", balked_users), ("reneged", reneged_users)):
+            for user in abandoned:
+                abandonment["%s_%s" % (kind, user.charge_preference)] += 1
+
+        # calculate the average charge service time for BS user
+        if len(BS_charge_list) > 0:
+            c_average_time = 0
+            for charge_user in BS_charge_list:
+                c_average_time += abs(charge_user.charge_service_time())
+            logger.info('Average charge service time (BS user) = %.2f', (c_average_time / len(BS_charge_list)) * sim_interval / 60.0)
+            BS_average_time_charge = (c_average_time / len(BS_charge_list)) * sim_interval / 60.0
+        else:
+            c_average_time = 0
+            BS_average_time_charge = 0
+
+        # Here calculate the average charge service time for Non BS user
+        if len(non_BS_charge_list) > 0:
+            c_average_time_non_BS = 0
+            for charge_user in non_BS_charge_list:
+                c_average_time_non_BS += abs(charge_user.charge_service_time())
+            logger.info('Average charge service time (Non BS user) = %.2f', (c_average_time_non_BS / len(non_BS_charge_list)) * sim_interval / 60.0)
+            non_BS_average_time_charge = (c_average_time_non_BS / len(non_BS_charge_list)) * sim_interval / 60.0
+        else:
+            c_average_time_non_BS = 0
+            non_BS_average_time_charge = 0
+
+        # Here calculate the average swap service time
+        if len(swap_list) > 0:
+            s_average_time = 0
+            for swap_user in swap_list:
+                s_average_time += swap_user.swap_service_time
+            logger.info('Average swap service time = %.2f', (s_average_time / len(swap_list)) * sim_interval / 60.0)
+            average_time_swap = (s_average_time / len(swap_list)) * sim_interval / 60.0
+        else:
+            average_time_swap = 0
+
+        # Here calculate the residual power distribution
+        residual_power = []
+        for pw in station1.power_history:
+            residual_temp = station1.max_power - pw[1]
+            residual_power.append(residual_temp)
 
-    return swap_user_wait_time, charge_user_wait_time, queue_length_swap, queue_length_charge, user_dist_lst, station1.max_power, station1.power_history, residual_power, swap_list, BS_charge_list, \
-        non_BS_charge_list, average_time_swap, BS_average_time_charge, non_BS_average_time_charge, swap_ratio_in_15_min
+        # Here calculate the success ratio within 15 min for swap
+        swap_time_list = []
+        count = 0
+        for i in range(sim_ticks):
+            for user in swap_list:
+                if user.sequence == i:
+                    swap_time_list.append(user.swap_service_time * sim_interval / 60.0)
+                    break
+        for num in swap_time_list:
+            if num <= 15:
+                count += 1
 
+        if len(swap_time_list) > 0:
+            # ratio = successful count / (serviced number of user + unserviced overflow number of user + swap users who gave up)
+            swap_ratio_in_15_min = count / (len(swap_time_list) + queue_length_swap[-1] + abandonment["balked_swap"] + abandonment["reneged_swap"])
+        else:
+            swap_ratio_in_15_min = 0
+
+        # Here calculate the wait time into [minutes]
+        swap_user_wait_time = [s * sim_interval/60 for s in self.swap_user_wait_time]
+        charge_user_wait_time = [s * sim_interval/60 for s in self.charge_user_wait_time]
+
+        return swap_user_wait_time, charge_user_wait_time, queue_length_swap, self.queue_length_charge, self.user_dist_lst, station1.max_power, station1.power_history, residual_power, all_swap_list, all_BS_charge_list, \
+            all_non_BS_charge_list, average_time_swap, BS_average_time_charge, non_BS_average_time_charge, swap_ratio_in_15_min, abandonment
+
+
+def do_simulation(param, progress_callback=None, recorder=None):
+    '''
+    excute the simulation loop of the BSS, see SimulationRun for the arguments
+    '''
+    return SimulationRun(param, progress_callback=progress_callback, recorder=recorder).run().results()
@@ -0,0 +1,357 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+import global_param as GC
+import replication
+import sizing
+
+# Multi-objective exploration of station designs.
+# NSGA-II (non-dominated sorting genetic algorithm): a population of designs is evolved by binary
+# tournament selection, uniform crossover and mutation, parents and children are merged and the best
+# fronts (ties broken by crowding distance) survive. All new designs of a generation are evaluated in one
+# batch on the executor, so a generation keeps every worker busy.
+# A design is encoded as a genome of integers (see GENES), decode() maps it to a sizing.py design, so
+# different genomes of the same station share one evaluation. Evaluations (mean KPIs over the
+# replications, replication.py) are cached in memory and optionally in a JSON lines file, a later
+# exploration of the same demand starts with them.
+# All objectives are minimized, see OBJECTIVES for the available ones.
+
+# set up logger
+logger = logging.getLogger('main.pareto')
+
+# station families of the genome
+FAMILIES = (GC.GEN2_530kW, GC.GEN3_600kW, GC.GEN3_1200kW, GC.User_Defined)
+MODULE_TYPES = ("20kW", "30kW", "40kW", "60kW", "80kW")
+# genes: name -> (lowest, highest value)
+GENES = {
+    "family": (0, len(FAMILIES) - 1),
+    "battery_level": (1, 10),                   # batteries in tenths of the rack places (rounded up)
+    "psc_num": (0, 8),                          # limited to the charge terminals of the family
+    "module_type": (0, len(MODULE_TYPES) - 1),  # user defined stations only
+    "module_number": (2, 20),                   # x 2 modules, user defined stations only
+}
+# waiting time [min] of a charge user still waiting at the end of the day in the charge_wait objective
+UNSERVED_CHARGE_WAIT = 24 * 60
+
+
+def charge_wait(design : dict, kpis : dict) -> float:
+    '''
+    mean charge wait [min] of the charge users, the ones still waiting at the end of the day count with UNSERVED_CHARGE_WAIT
+    '''
+    served, unserved = kpis["charge_users"], kpis["charge_overflow"]
+    if served + unserved == 0:
+        return 0.0
+    return (kpis["charge_wait"] * served + UNSERVED_CHARGE_WAIT * unserved) / (served + unserved)
+
+
+# objective name -> function(design, mean KPIs), all minimized
+OBJECTIVES = {
+    "max_power": lambda design, kpis: design["station_type"]["max_power"],
+    "battery_num": lambda design, kpis: design["battery_num"],
+    "psc_num": lambda design, kpis: design["psc_num"],
+    "cost": lambda design, kpis: sizing.design_cost(design),
+    "energy": lambda design, kpis: kpis["energy"],
+    "swap_wait": lambda design, kpis: kpis["swap_wait"],
+    "charge_wait": charge_wait,
+    "overflow": lambda design, kpis: kpis["overflow"],
+    "charge_overflow": lambda design, kpis: kpis["charge_overflow"],
+    "swap_ratio_miss": lambda design, kpis: 1.0 - kpis["swap_ratio_in_15_min"],
+}
+DEFAULT_OBJECTIVES = ("max_power", "battery_num", "psc_num", "energy", "swap_wait", "charge_wait", "overflow")
+# default search settings
+POPULATION = 40
+GENERATIONS = 25
+REPLICATIONS = 2
+CROSSOVER_RATE = 0.9
+# user defined stations can have up to this many charge piles
+MAX_USER_DEFINED_PSC = 8
+
+
+######################################################################
+############################ encoding ################################
+######################################################################
+
+def has_terminals(family : dict) -> bool:
+    return family["station_type"] == "User_Defined" or family["max_charge_terminal"] > 0
+
+
+def decode(genome : tuple, needs_bsc = False) -> dict:
+    '''
+    sizing.py design of a genome, genes outside the limits of the family are clipped
+    needs_bsc: at least one charge pile (there are non BS users), a family without charge terminals is no
+               candidate then (as in sizing.candidate_designs), its genomes map to the next family with terminals
+    '''
+    index = genome[0]
+    while needs_bsc and not has_terminals(FAMILIES[index]):
+        index = (index + 1) % len(FAMILIES)
+    station_type = dict(FAMILIES[index])
+    if station_type["station_type"] == "User_Defined":
+        module_number = 2 * genome[4]
+        station_type["power_module_type"] = dict(GC.power_module_catalog[MODULE_TYPES[genome[3]]])
+        station_type["max_charger_number"] = module_number
+        station_type["max_battery_number"] = module_number
+        station_type["max_power"] = int(station_type["power_module_type"]["max_power"] * module_number)
+        max_psc = MAX_USER_DEFINED_PSC
+    else:
+        max_psc = station_type["max_charge_terminal"]
+    places = station_type["max_battery_number"]
+    battery_num = max(1, -(-places * genome[1] // GENES["battery_level"][1]))
+    psc_num = min(genome[2], max_psc)
+    if needs_bsc:
+        psc_num = max(psc_num, 1)
+    return sizing.make_design(station_type, psc_num, battery_num)
+
+
+def random_genome(rng : random.Random) -> tuple:
+    return tuple(rng.randint(lo, hi) for lo, hi in GENES.values())
+
+
+def crossover(a : tuple, b : tuple, rng : random.Random) -> tuple:
+    '''
+    uniform crossover
+    '''
+    return tuple(x if rng.random() < 0.5 else y for x, y in zip(a, b))
+
+
+def mutate(genome : tuple, rng : random.Random, rate = None) -> tuple:
+    '''
+    every gene is changed with probability rate (default 1 / number of genes),
+    by a step of +-1 or, with probability 1/2, to a random value
+    '''
+    rate = 1.0 / len(genome) if rate is None else rate
+    genes = list(genome)
+    for i, (lo, hi) in enumerate(GENES.values()):
+        if rng.random() < rate:
+            if rng.random() < 0.5:
+                genes[i] = rng.randint(lo, hi)
+            else:
+                genes[i] = min(hi, max(lo, genes[i] + rng.choice((-1, 1))))
+    return tuple(genes)
+
+
+######################################################################
+############################ NSGA-II #################################
+######################################################################
+
+def dominates(a, b) -> bool:
+    return all(x <= y for x, y in zip(a, b)) and any(x < y for x, y in zip(a, b))
+
+
+def non_dominated_sort(points : list) -> list:
+    '''
+    fast non-dominated sorting, return the fronts as lists of indices into points (best front first)
+    '''
+    n = len(points)
+    dominated = [[] for _ in range(n)]       # indices that i dominates
+    count = [0] * n                          # number of points dominating i
+    for i in range(n):
+        for j in range(i + 1, n):
+            if dominates(points[i], points[j]):
+                dominated[i].append(j)
+                count[j] += 1
+            elif dominates(points[j], points[i]):
+                dominated[j].append(i)
+                count[i] += 1
+    fronts = [[i for i in range(n) if count[i] == 0]]
+    while len(fronts[-1]) > 0:
+        front = []
+        for i in fronts[-1]:
+            for j in dominated[i]:
+                count[j] -= 1
+                if count[j] == 0:
+                    front.append(j)
+        fronts.append(front)
+    return fronts[:-1]
+
+
+def first_front(points : list) -> list:
+    '''
+    indices of the non-dominated points, for many points cheaper than non_dominated_sort():
+    in lexicographic order a point can only be dominated by an earlier one, so each point
+    is compared with the front found so far only
+    '''
+    front = []
+    for i in sorted(range(len(points)), key=lambda i: points[i]):
+        if not any(dominates(points[j], points[i]) for j in front):
+            front.append(i)
+    return front
+
+
+def crowding_distance(points : list, front : list) -> dict:
+    '''
+    crowding distance of the points of one front, index -> distance
+    '''
+    distance = {i: 0.0 for i in front}
+    if len(front) <= 2:
+        return {i: float("inf") for i in front}
+    for m in range(len(points[front[0]])):
+        ordered = sorted(front, key=lambda i: points[i][m])
+        lo, hi = points[ordered[0]][m], points[ordered[-1]][m]
+        distance[ordered[0]] = distance[ordered[-1]] = float("inf")
+        if hi == lo:
+            continue
+        for k in range(1, len(ordered) - 1):
+            distance[ordered[k]] += (points[ordered[k + 1]][m] - points[ordered[k - 1]][m]) / (hi - lo)
+    return distance
+
+
+def _rank(points : list) -> tuple:
+    '''
+    return rank and crowding distance per index
+    '''
+    rank, crowding = {}, {}
+    for r, front in enumerate(non_dominated_sort(points)):
+        crowding.update(crowding_distance(points, front))
+        for i in front:
+            rank[i] = r
+    return rank, crowding
+
+
+######################################################################
+########################## exploration ###############################
+######################################################################
+
+class EvaluationCache:
+    '''
+    mean KPIs per (demand, design, replications), in memory and optionally in a JSON lines file
+    '''
+    def __init__(self, path = None):
+        self.path = path
+        self._data = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue        # incomplete last line of an interrupted exploration
+                    self._data[entry["key"]] = entry["kpis"]
+
+    @staticmethod
+    def key(base : dict, design : dict, replications, base_seed) -> str:
+        data = {"base": base, "design": design["name"], "station": design["station_type"],
+                "replications": replications, "base_seed": base_seed, "kpis": replication.KPI_NAMES}
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def put(self, key, kpis):
+        self._data[key] = kpis
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "kpis": kpis}) + "\n")
+
+    def __len__(self):
+        return len(self._data)
+
+
+def explore(demand : dict, objectives = DEFAULT_OBJECTIVES, population = POPULATION, generations = GENERATIONS,
+            replications = REPLICATIONS, executor = None, cache = None, seed = 0, base_seed = replication.BASE_SEED,
+            progress_callback = None) -> dict:
+    '''
+    search the Pareto set of station designs for a demand (see sizing.base_param for the demand keys)
+    objectives:         names of OBJECTIVES to minimize
+    executor:           optional concurrent.futures executor for the simulations (e.g. jobs.pool())
+    cache:              optional EvaluationCache, shared between explorations
+    seed:               seed of the evolutionary search (the simulations use base_seed, see replication.py)
+    progress_callback:  optional callable(generation, generations, simulations)
+    return dict with
+        "pareto":       non-dominated designs, each a design dict with "objectives" and mean "kpis"
+        "simulations":  number of simulated days, "evaluations": number of distinct designs, "seconds": wall time
+    '''
+    start = time.time()
+    rng = random.Random(seed)
+    base = sizing.base_param(demand)
+    needs_bsc = demand.get("non_BS_user_num", 0) > 0
+    cache = cache if cache is not None else EvaluationCache()
+    evaluated = {}              # design name -> design with kpis and objectives
+    simulations = 0
+
+    def evaluate(genomes):
+        '''
+        evaluate all new designs of a generation in one batch, return their design dicts
+        '''
+        nonlocal simulations
+        designs = [decode(g, needs_bsc) for g in genomes]
+        todo = {}
+        for design in designs:
+            if design["name"] in evaluated or design["name"] in todo:
+                continue
+            key = EvaluationCache.key(base, design, replications, base_seed)
+            kpis = cache.get(key)
+            if kpis is not None:
+                evaluated[design["name"]] = dict(design, kpis=kpis, objectives=tuple(OBJECTIVES[o](design, kpis) for o in objectives))
+            else:
+                todo[design["name"]] = (design, key)
+        work = [(name, sizing.design_param(base, design), seed)
+                for name, (design, key) in todo.items()
+                for seed in replication.replication_seeds(0, replications, base_seed)]
+        if executor is None:
+            results = [replication.run_replication(param, s) for _, param, s in work]
+        else:
+            chunksize = max(1, len(work) // (4 * (os.cpu_count() or 1)))
+            results = list(executor.map(replication.run_replication, [w[1] for w in work], [w[2] for w in work], chunksize=chunksize))
+        simulations += len(work)
+        samples = {name: [] for name in todo}
+        for (name, _, _), kpis in zip(work, results):
+            samples[name].append(kpis)
+        for name, (design, key) in todo.items():
+            kpis = {k: replication.summarize(samples[name], k)[0] for k in replication.KPI_NAMES}
+            cache.put(key, kpis)
+            evaluated[name] = dict(design, kpis=kpis, objectives=tuple(OBJECTIVES[o](design, kpis) for o in objectives))
+        return [evaluated[d["name"]] for d in designs]
+
+    def tournament(genomes, rank, crowding):
+        a, b = rng.randrange(len(genomes)), rng.randrange(len(genomes))
+        if (rank[a], -crowding[a]) <= (rank[b], -crowding[b]):
+            return genomes[a]
+        return genomes[b]
+
+    genomes = [random_genome(rng) for _ in range(population)]
+    members = evaluate(genomes)
+    for generation in range(generations):
+        rank, crowding = _rank([m["objectives"] for m in members])
+        children = []
+        while len(children) < population:
+            a, b = tournament(genomes, rank, crowding), tournament(genomes, rank, crowding)
+            child = crossover(a, b, rng) if rng.random() < CROSSOVER_RATE else a
+            children.append(mutate(child, rng))
+        child_members = evaluate(children)
+
+        # elitist survival of parents and children, one genome per distinct design
+        merged_genomes, merged_members, names = [], [], set()
+        for g, m in zip(genomes + children, members + child_members):
+            if m["name"] not in names:
+                names.add(m["name"])
+                merged_genomes.append(g)
+                merged_members.append(m)
+        fronts = non_dominated_sort([m["objectives"] for m in merged_members])
+        survivors = []
+        for front in fronts:
+            if len(survivors) + len(front) <= population:
+                survivors.extend(front)
+            else:
+                crowding = crowding_distance([m["objectives"] for m in merged_members], front)
+                survivors.extend(sorted(front, key=lambda i: -crowding[i])[:population - len(survivors)])
+                break
+        genomes = [merged_genomes[i] for i in survivors]
+        members = [merged_members[i] for i in survivors]
+        logger.info('generation %d: %d designs evaluated, %d in the first front', generation, len(evaluated), len(fronts[0]))
+        if progress_callback is not None:
+            progress_callback(generation + 1, generations, simulations)
+
+    # Pareto set over all evaluated designs, not only the last population
+    all_members = list(evaluated.values())
+    pareto = [all_members[i] for i in first_front([m["objectives"] for m in all_members])]
+    pareto.sort(key=lambda m: m["objectives"])
+    seconds = time.time() - start
+    logger.info('pareto: %d designs in the Pareto set, %d simulations in %.1f s', len(pareto), simulations, seconds)
+    return {"pareto": pareto, "objectives": tuple(objectives), "simulations": simulations,
+            "evaluations": len(evaluated), "seconds": seconds}
@@ -0,0 +1,286 @@
+# -*- coding: UTF-8 -*-
+
+import functools
+import logging
+import math
+import os
+
+import global_param as GC
+
+# Analytic pre-screen of a configuration, a fraction of a millisecond instead of a simulated day.
+# The day is split into the 48 half-hour slots of the arrival profiles (users arrive uniformly within a slot,
+# see users.get_user_distribution). Per slot:
+#   - arrivals: expected swap users of the slot (profile share x swap users per day)
+#   - swap platform: deterministic service, swap_period rounded up to full simulation ticks, one user at a time per
+#     swap lane (swap_lanes lanes are taken as one server that is swap_lanes times faster)
+#   - battery supply: batteries that are ready (SOC >= select_soc) plus the batteries the power cabinets can
+#     charge within the slot (charge time from the current limit tables and one power module per rack battery,
+#     limited by the station power); charge users at the piles take their module hours and energy first
+#   - capacity: min(platform capacity, battery supply), users that can not be served are carried to the next slot
+# Waiting time of a slot = wait for the carried backlog (fluid) + M/D/1 wait of the slot (Pollaczek-Khinchine),
+# the latter capped by the diffusion scale sqrt(arrivals) x service time that an initially empty queue reaches
+# within half an hour. The waiting time distribution is taken exponential for the 15 min ratio.
+# The estimates are approximations for ranking and pruning, not a replacement of the simulation: they ignore
+# the rack switching, paired modules and the SOC spread of users, and they tend to be optimistic.
+
+# set up logger
+logger = logging.getLogger('main.queueing')
+
+SLOT_SECONDS = 1800
+DAY_SECONDS = 86400
+# mean SOC of arriving BS users (gamma distribution of users.create_battery, shape 3, scale 12 %)
+ARRIVAL_SOC = 0.36
+# current limit of a battery in a swap rack and at a charge pile [A] (Swap_Rack.module_number_check, Charge_Pile)
+RACK_CURRENT_LIMIT = 250
+PILE_CURRENT_LIMIT = 650
+# battery places that are connected to a power cabinet, User_Defined: one per power module
+CHARGED_PLACES = {"GEN2_530": 13, "GEN3_600": 10, "GEN3_1200": 20}
+# share of BS users that choose the swap with user_preference "markov", see markov_swap_share()
+LOW_SOC_SHARE = 1.0 - math.exp(-40.0 / 12.0) * (1.0 + 40.0 / 12.0 + (40.0 / 12.0) ** 2 / 2.0)   # P(gamma(3, 12) < 40)
+# pruning margins of screen(): only clearly infeasible configurations are pruned
+RATIO_MARGIN = 0.15
+OVERFLOW_MARGIN = 5
+
+
+######################################################################
+########################## demand model ##############################
+######################################################################
+
+@functools.lru_cache(maxsize=None)
+def arrival_profile(user_sequence_mode = "random", opening_hours = "24 hours", user_area = None) -> tuple:
+    '''
+    share of the daily users per half-hour slot, for "statistical" the mean absolute count per slot
+    '''
+    data_dir = GC.data_dir
+    if user_sequence_mode == "random":
+        name = "user_random_dist_opening.dat" if opening_hours == "9:00 to 19:30" else "user_random_dist.dat"
+        with open(os.path.join(data_dir, name)) as f:
+            values = [float(v) for v in f.read().split()]
+        total = sum(values)
+        return tuple(v / total for v in values)
+
+    # statistical: recorded arrival times, the first 18 entries are skipped as in users.create_user_queue_statistical
+    files = GC.user_dist_urban_file_list if user_area == "urban" else GC.user_dist_highway_file_list
+    counts = [0.0] * 48
+    for name in files:
+        with open(os.path.join(data_dir, name)) as f:
+            lines = f.read().splitlines()[18:]
+        for line in lines:
+            h, m, s = (int(v) for v in line.split(" ")[1].split(":"))
+            counts[min(47, (h * 3600 + m * 60 + s) // SLOT_SECONDS)] += 1.0
+    return tuple(c / max(1, len(files)) for c in counts)
+
+
+def markov_swap_share(temperature = 25) -> tuple:
+    '''
+    share of BS users choosing the swap with the markov preference, for a short and a long queue (> 12)
+    (users.User.markov_preference, mixed over the share of users arriving below 40 % SOC)
+    '''
+    import users
+    shares = []
+    for queue_length in (0, 13):
+        share = 0.0
+        for soc, weight in ((0.3, LOW_SOC_SHARE), (0.5, 1.0 - LOW_SOC_SHARE)):
+            share += weight * users.MARKOV_POSTERIOR[users.markov_band(temperature, soc, queue_length)][0]
+        shares.append(share)
+    return tuple(shares)
+
+
+######################################################################
+########################## supply model ##############################
+######################################################################
+
+@functools.lru_cache(maxsize=None)
+def charge_time(battery_type, soc_from, soc_to, module = (40, 134), max_modules = 1, current_limit = RACK_CURRENT_LIMIT,
+                temperature = 25) -> tuple:
+    '''
+    (hours, kWh, module hours) to charge one battery from soc_from to soc_to at the current limit of the tables,
+    fed by up to max_modules power modules (max_power [kW], max_current [A]) and capped at current_limit
+    '''
+    table = GC.battery_charge_limit.get(battery_type, GC.battery_charge_limit["100kWh"])
+    row = table[min(table, key=lambda t: abs(t - temperature))]
+    axis = (0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95)
+    ocv = GC.ocv_70 if battery_type == "70kWh" else GC.ocv_100
+    capacity = GC.battery_capacity.get(battery_type, GC.battery_capacity["100kWh"])
+    hours = energy = module_hours = 0.0
+    soc = soc_from
+    while soc < soc_to - 1e-9:
+        check = min(0.95, max(0.05, soc))
+        k = next(i for i in range(1, len(axis)) if axis[i] >= check)
+        current = row[k - 1] + (check - axis[k - 1]) * (row[k] - row[k - 1]) / (axis[k] - axis[k - 1])
+        voltage = int(ocv[min(len(ocv) - 1, int(soc * 100))])
+        per_module = min(module[1], module[0] * 1000.0 / voltage)
+        modules = min(max_modules, max(1, math.ceil(min(current, current_limit) / per_module)))
+        current = max(1.0, min(current, current_limit, modules * per_module))
+        step = min(0.01, soc_to - soc)
+        hours += capacity * step / current
+        module_hours += modules * capacity * step / current
+        energy += capacity * step * voltage / 1000.0
+        soc += step
+    return hours, energy, module_hours
+
+
+def charged_places(station_type : dict) -> int:
+    if station_type["station_type"] == "User_Defined":
+        return int(station_type["max_charger_number"])
+    return CHARGED_PLACES.get(station_type["station_type"], station_type["max_battery_number"])
+
+
+def power_module(station_type : dict) -> tuple:
+    '''
+    (max_power, max_current) of the power modules of a station type (swap.Power_Cabinet)
+    '''
+    if station_type["station_type"] == "User_Defined":
+        module = station_type["power_module_type"]
+    elif station_type["station_type"] == "GEN2_530":
+        module = GC.UU40kW
+    else:
+        module = GC.UU60kW
+    return module["max_power"], module["max_current"]
+
+
+######################################################################
+############################ estimate ################################
+######################################################################
+
+def estimate(param : dict) -> dict:
+    '''
+    approximate swap KPIs of a configuration (same param dict as main.do_simulation)
+    return dict with
+        utilization:            swap platform busy share of the day (demand x service time / day / swap lanes)
+        peak_utilization:       highest half-hour demand / platform capacity
+        swap_wait:              mean waiting time of swap users [min], including the users left waiting at the end
+        swap_ratio_in_15_min:   share of swap users served (wait + swap) within 15 min
+        overflow:               swap users still waiting at the end of the day
+        battery_supply_rate:    swaps per hour the power cabinets can supply once the initial stock is used (best slot)
+        starvation:             share of swap demand arriving in slots where the batteries, not the platform, limit the service
+        starved:                starvation > 0
+    '''
+    interval = param["sim_interval"]
+    service = math.ceil(param["swap_time"] * 60 / interval) * interval     # seconds per swap, in full ticks
+    profile = arrival_profile(param["user_sequence_mode"], param["opening_hours"], param.get("user_area"))
+    if param["user_sequence_mode"] == "random":
+        demand = [p * param["BS_user_num"] for p in profile]
+    else:
+        demand = list(profile)
+    if param["user_preference"] == "fixed_value":
+        shares = (param["service_ratio"] / 100.0,) * 2
+    elif param["user_preference"] == "markov":
+        shares = markov_swap_share(param.get("swap_rack_temperature", 25))
+    else:
+        shares = (1.0, 1.0)
+
+    # battery stock: ready batteries and batteries the cabinets can charge
+    station_type = param["station_type"]
+    config = param["battery_config"]
+    battery_num = sum(config.values())
+    battery_type = max(config, key=config.get)
+    select_soc = param["select_soc"]
+    temperature = param.get("swap_rack_temperature", 25)
+    module = power_module(station_type)
+    modules = charged_places(station_type)
+    charged = min(battery_num, modules)
+    ready = float(battery_num) if param["init_battery_soc_in_BSS"] >= select_soc else 0.0
+    pending = battery_num - ready                                           # batteries below select_soc
+    uncharged = max(0.0, pending - charged)                                 # they sit in places without power
+    hours_swap, energy_swap, _ = charge_time(battery_type, ARRIVAL_SOC, max(ARRIVAL_SOC, select_soc), module,
+                                             temperature=temperature)
+    slot_hours = SLOT_SECONDS / 3600.0
+    if ready == 0.0:
+        # the initial stock needs its first charge, from init_battery_soc_in_BSS
+        hours_init = charge_time(battery_type, param["init_battery_soc_in_BSS"], max(param["init_battery_soc_in_BSS"], select_soc),
+                                 module, temperature=temperature)[0]
+        first_ready_slot = hours_init / slot_hours
+    else:
+        first_ready_slot = 0.0
+
+    # charge piles: module hours and energy of the charge users, they share the cabinet with the racks
+    psc_num = param["psc_num"] if station_type["station_type"] != "GEN2_530" else 0
+    if psc_num > 0:
+        _, energy_pile, module_hours_pile = charge_time(battery_type, ARRIVAL_SOC, max(ARRIVAL_SOC, param["target_soc"]),
+                                                        module, modules, PILE_CURRENT_LIMIT, temperature)
+    else:
+        energy_pile = module_hours_pile = 0.0
+    power = station_type["max_power"]
+    if param.get("power_cap") and not isinstance(param["power_cap"], bool):
+        power = min(power, param["power_cap"])
+
+    lanes = param.get("swap_lanes", 1)
+    platform = lanes * SLOT_SECONDS / service
+    # non BS users always follow the random profile (users.create_user_queue_statistical)
+    non_bs_profile = profile if param["user_sequence_mode"] == "random" else arrival_profile()
+    non_bs = [p * param["non_BS_user_num"] for p in non_bs_profile]
+    backlog = supply_rate = 0.0
+    total = waited = in_time = starved_demand = 0.0
+    peak = 0.0
+    for k, users_k in enumerate(demand):
+        share = shares[1] if backlog > 12 else shares[0]
+        lam = users_k * share
+        # modules and power left by the charge piles (non BS users and BS users that choose to charge)
+        charge_users = users_k * (1.0 - share) + non_bs[k] if psc_num > 0 else 0.0
+        pile_modules = min(psc_num * modules, charge_users * module_hours_pile / slot_hours, modules - 1)
+        pile_power = min(power, charge_users * energy_pile / slot_hours)
+        rack_modules = min(charged, modules - pile_modules)
+        per_slot_supply = min(rack_modules * slot_hours / max(hours_swap, 1e-6),
+                              max(0.0, power - pile_power) * slot_hours / max(energy_swap, 1e-6))
+        supply_rate = max(supply_rate, per_slot_supply / slot_hours)
+        # batteries becoming ready in this slot: depleted batteries (chargeable places only) and the initial stock
+        depleted = min(charged, battery_num - ready - uncharged)
+        supply = min(depleted, per_slot_supply)
+        if ready == 0.0 and pending > 0 and k + 1 >= first_ready_slot and uncharged == 0.0 and total == 0.0:
+            supply = max(supply, min(charged, pending))
+        available = ready + supply
+        capacity = min(platform, available)
+        want = backlog + lam
+        served = min(want, capacity)
+        if available < min(want, platform) - 1e-9:
+            starved_demand += lam
+        peak = max(peak, lam / platform)
+
+        # waiting time: backlog ahead (fluid) + M/D/1 of the slot
+        d_eff = SLOT_SECONDS / max(capacity, 1e-6)
+        rho = lam * d_eff / SLOT_SECONDS
+        fluid = (backlog + max(0.0, lam - capacity) / 2.0) * d_eff
+        stochastic = d_eff * math.sqrt(max(lam, 0.0)) / 2.0
+        if rho < 1.0:
+            stochastic = min(stochastic, rho * d_eff / (2.0 * (1.0 - rho)))
+        wait = fluid + stochastic
+        total += lam
+        waited += lam * wait
+        # P(wait + service <= 15 min), exponential waiting time beyond the fluid part
+        slack = 900.0 - service - fluid
+        if slack < 0:
+            p_in_time = 0.0
+        elif stochastic <= 0:
+            p_in_time = 1.0
+        else:
+            p_busy = min(1.0, rho)
+            p_in_time = 1.0 - p_busy * math.exp(-p_busy * slack / stochastic)
+        in_time += lam * p_in_time
+
+        ready = max(0.0, available - served)
+        backlog = want - served
+
+    return {
+        "utilization": total * service / DAY_SECONDS / lanes,
+        "peak_utilization": peak,
+        "swap_wait": waited / total / 60.0 if total > 0 else 0.0,
+        "swap_ratio_in_15_min": in_time / (total + backlog) if total > 0 else 0.0,
+        "overflow": backlog,
+        "battery_supply_rate": supply_rate,
+        "starvation": starved_demand / total if total > 0 else 0.0,
+        "starved": starved_demand > 0,
+    }
+
+
+def screen(param : dict, target_swap_ratio = None, max_overflow = None) -> tuple:
+    '''
+    pre-screen before a simulation: (False, estimate) if the configuration clearly misses a target,
+    otherwise (True, estimate); clearly = by more than RATIO_MARGIN / OVERFLOW_MARGIN
+    '''
+    est = estimate(param)
+    if target_swap_ratio is not None and est["swap_ratio_in_15_min"] < target_swap_ratio - RATIO_MARGIN:
+        return False, est
+    if max_overflow is not None and est["overflow"] > max_overflow + OVERFLOW_MARGIN:
+        return False, est
+    return True, est
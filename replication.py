@@ -0,0 +1,213 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import math
+
+import main
+import queueing
+
+# Independent replications of one simulation configuration.
+# A replication is one run of main.do_simulation() with its own seed. Only the key performance indicators
+# (KPIs) are sent back from worker processes, not the full result tuple, so many replications are cheap
+# to collect. Replication k of every configuration uses the seed base_seed + k: different configurations
+# are compared on the same user arrivals (common random numbers), which makes their differences much less
+# noisy than their absolute values.
+# Variance reduction on top of that:
+#   - antithetic pairs: replications 2k and 2k + 1 share the seed base_seed + k and draw their users from u and
+#     1 - u (users.set_sampling), the mean of a pair is one observation
+#   - control variate: arrivals in the CONTROL_SLOTS busiest half hours of the arrival profile, their expectation
+#     is known in random user sequence mode; the KPI is corrected by beta (arrivals - expectation)
+# replicate_until() runs batches of replications until the confidence interval of a KPI is narrow enough,
+# the interval uses the Student t quantile, a normal one is too narrow for the few replications of the first batches.
+
+# set up logger
+logger = logging.getLogger('main.replication')
+
+KPI_NAMES = ("swap_ratio_in_15_min", "average_time_swap", "BS_average_time_charge", "non_BS_average_time_charge",
+             "overflow", "swap_users", "charge_users", "swap_wait", "charge_wait", "energy", "charge_overflow")
+# first seed of the replications
+BASE_SEED = 1000
+# control variate: name in the replication KPIs and the number of busiest half hours it counts
+CONTROL = "peak_arrivals"
+CONTROL_SLOTS = 12
+# sequential stopping: replications per batch and upper limit
+BATCH = 4
+MAX_REPLICATIONS = 200
+
+
+def kpis(result, sim_interval = 10) -> dict:
+    '''
+    KPIs of a result tuple of main.do_simulation()
+    overflow, charge_overflow: swap / charge users still waiting at the end of the simulation
+    swap_wait, charge_wait: mean waiting time [min], energy: energy drawn from the grid [kWh] (without grid interaction discharge)
+    balked, reneged: users who did not join a queue or left it (user_abandonment)
+    '''
+    swap_wait, charge_wait = result[0], result[1]
+    abandonment = result[15]
+    return {
+        "swap_ratio_in_15_min": result[14],
+        "average_time_swap": result[11],
+        "BS_average_time_charge": result[12],
+        "non_BS_average_time_charge": result[13],
+        "overflow": result[2][-1] if len(result[2]) > 0 else 0,
+        "swap_users": len(result[8]),
+        "charge_users": len(result[9]) + len(result[10]),
+        "swap_wait": sum(swap_wait) / len(swap_wait) if len(swap_wait) > 0 else 0.0,
+        "charge_wait": sum(charge_wait) / len(charge_wait) if len(charge_wait) > 0 else 0.0,
+        "energy": sum(pw[1] for pw in result[6] if pw[1] > 0) * sim_interval / 3600.0,
+        "charge_overflow": result[3][-1] if len(result[3]) > 0 else 0,
+        "balked": abandonment["balked_swap"] + abandonment["balked_charge"],
+        "reneged": abandonment["reneged_swap"] + abandonment["reneged_charge"],
+    }
+
+
+def peak_slots(param : dict) -> tuple:
+    '''
+    indices of the CONTROL_SLOTS half hours with the most arrivals in the profile of param
+    '''
+    profile = queueing.arrival_profile(param["user_sequence_mode"], param["opening_hours"], param.get("user_area"))
+    return tuple(sorted(range(len(profile)), key=lambda k: -profile[k])[:CONTROL_SLOTS])
+
+
+def expected_peak_arrivals(param : dict):
+    '''
+    expected arrivals (BS and non BS) in the peak slots, None outside of random user sequence mode
+    '''
+    if param["user_sequence_mode"] != "random":
+        return None
+    profile = queueing.arrival_profile(param["user_sequence_mode"], param["opening_hours"])
+    return (param["BS_user_num"] + param["non_BS_user_num"]) * sum(profile[k] for k in peak_slots(param))
+
+
+def run_replication(param : dict, seed : int, antithetic = 0) -> dict:
+    '''
+    worker side: one seeded run, return its KPIs and the control variate CONTROL
+    antithetic: 0 plain run, +1 / -1 the two runs of an antithetic pair
+    '''
+    run_param = dict(param, seed=seed)
+    if antithetic:
+        run_param["antithetic"] = antithetic
+    result = main.do_simulation(run_param)
+    slots = set(peak_slots(param))
+    sample = kpis(result, param["sim_interval"])
+    sample[CONTROL] = sum(1 for t in result[4] if int(t) // queueing.SLOT_SECONDS in slots)
+    return sample
+
+
+def replication_seeds(first, last, base_seed = BASE_SEED):
+    '''
+    seeds of the replications first ... last-1
+    '''
+    return [base_seed + k for k in range(first, last)]
+
+
+def antithetic_seeds(first, last, base_seed = BASE_SEED):
+    '''
+    seeds and signs of the replications first ... last-1 as antithetic pairs
+    '''
+    return [base_seed + k // 2 for k in range(first, last)], [1 if k % 2 == 0 else -1 for k in range(first, last)]
+
+
+def _run(param : dict, seeds : list, signs : list, executor = None) -> list:
+    if executor is None:
+        return [run_replication(param, seed, sign) for seed, sign in zip(seeds, signs)]
+    return list(executor.map(run_replication, [param] * len(seeds), seeds, signs))
+
+
+def replicate(param : dict, n, executor = None, base_seed = BASE_SEED, antithetic = False) -> list:
+    '''
+    run n replications of param, in parallel if an executor (e.g. jobs.pool()) is given
+    antithetic: run them as antithetic pairs (n rounded up to even)
+    return the list of KPI dicts in seed order
+    '''
+    if antithetic:
+        seeds, signs = antithetic_seeds(0, n + n % 2, base_seed)
+    else:
+        seeds, signs = replication_seeds(0, n, base_seed), [0] * n
+    return _run(param, seeds, signs, executor)
+
+
+def summarize(samples : list, name) -> tuple:
+    '''
+    mean and standard error of the mean of one KPI over replications (standard error inf for a single one)
+    '''
+    values = [s[name] for s in samples]
+    n = len(values)
+    if n == 0:
+        return float("nan"), float("inf")
+    mean = sum(values) / n
+    if n == 1:
+        return mean, float("inf")
+    var = sum((v - mean) ** 2 for v in values) / (n - 1)
+    return mean, math.sqrt(var / n)
+
+
+def t_quantile(z, df) -> float:
+    '''
+    quantile of the Student t distribution with df degrees of freedom at the probability of the normal quantile z,
+    Cornish-Fisher expansion (Abramowitz and Stegun 26.7.5), within 0.1 % from df = 3 on
+    '''
+    z2 = z * z
+    g1 = (z2 + 1) * z / 4
+    g2 = ((5 * z2 + 16) * z2 + 3) * z / 96
+    g3 = (((3 * z2 + 19) * z2 + 17) * z2 - 15) * z / 384
+    g4 = ((((79 * z2 + 776) * z2 + 1482) * z2 - 1920) * z2 - 945) * z / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+def estimate(samples : list, name, antithetic = False, control = None) -> tuple:
+    '''
+    mean and standard error of one KPI with variance reduction
+    antithetic: samples are antithetic pairs in order, each pair is averaged into one observation
+    control:    expected value of the control variate CONTROL (expected_peak_arrivals), None for no control variate
+    '''
+    y = [s[name] for s in samples]
+    c = [s[CONTROL] for s in samples]
+    if antithetic:
+        m = len(y) // 2
+        y = [(y[2 * i] + y[2 * i + 1]) / 2.0 for i in range(m)]
+        c = [(c[2 * i] + c[2 * i + 1]) / 2.0 for i in range(m)]
+    n = len(y)
+    if control is None or n < 3:
+        return summarize([{name: v} for v in y], name)
+    y_mean, c_mean = sum(y) / n, sum(c) / n
+    sxx = sum((v - c_mean) ** 2 for v in c)
+    if sxx == 0:
+        return summarize([{name: v} for v in y], name)
+    beta = sum((v - y_mean) * (w - c_mean) for v, w in zip(y, c)) / sxx
+    residual = sum((v - y_mean - beta * (w - c_mean)) ** 2 for v, w in zip(y, c)) / (n - 2)
+    mean = y_mean - beta * (c_mean - control)
+    return mean, math.sqrt(residual * (1.0 / n + (c_mean - control) ** 2 / sxx))
+
+
+def replicate_until(param : dict, name, half_width, relative = False, z = 1.96, batch = BATCH, min_n = BATCH,
+                    max_n = MAX_REPLICATIONS, executor = None, base_seed = BASE_SEED, antithetic = False, control = False) -> dict:
+    '''
+    sequential stopping: run batches of replications of param until the confidence half width t * se of the KPI
+    name is at most half_width (relative: a share of the absolute mean), or max_n replications,
+    t is the Student t quantile at the probability of z for the observations so far (pairs with antithetic)
+    antithetic / control: variance reduction as in estimate(), control uses expected_peak_arrivals(param)
+    return dict with "mean", "se", "half_width", "replications", "converged" and the KPI dicts "samples"
+    '''
+    expected = expected_peak_arrivals(param) if control else None
+    if antithetic:
+        batch += batch % 2
+    samples = []
+    while True:
+        n = min(max_n, max(min_n, len(samples) + batch))
+        if antithetic:
+            seeds, signs = antithetic_seeds(len(samples), n + n % 2, base_seed)
+        else:
+            seeds, signs = replication_seeds(len(samples), n, base_seed), [0] * (n - len(samples))
+        samples.extend(_run(param, seeds, signs, executor))
+        mean, se = estimate(samples, name, antithetic, expected)
+        n_eff = len(samples) // 2 if antithetic else len(samples)
+        # the control variate costs one more degree of freedom, see estimate()
+        df = n_eff - 2 if control and n_eff >= 3 else n_eff - 1
+        t = t_quantile(z, df) if df >= 1 else float("inf")
+        target = half_width * abs(mean) if relative else half_width
+        converged = t * se <= target
+        if converged or len(samples) >= max_n:
+            break
+    logger.info('%s: %d replications, mean %.4g +- %.3g', name, len(samples), mean, t * se)
+    return {"mean": mean, "se": se, "half_width": t * se, "replications": len(samples), "converged": converged, "samples": samples}
@@ -0,0 +1,270 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+import pareto
+import replication
+import sizing
+
+# Global sensitivity analysis of the simulation over station and demand parameters.
+# Every factor (see FACTORS) is driven by a coordinate u in [0, 1): numeric factors map it linearly onto their
+# range, categorical factors onto equally wide bins of their options, apply() builds the param dict of a point.
+# Two methods:
+#   - morris(): elementary effects screening on r one-at-a-time trajectories over a p-level grid,
+#     r (k + 1) points; mu* (mean absolute effect) ranks the factors, sigma shows interactions and nonlinearity
+#   - sobol(): Saltelli design with matrices A, B and AB_i (A with column i of B), N (k + 2) points; first order
+#     indices after Saltelli 2010, total indices after Jansen
+# Confidence intervals are percentile bootstrap intervals over the trajectories / rows of the design.
+# A point is evaluated by the mean KPIs of its replications (common random numbers, see replication.py): all
+# replications of the design go to the executor in one batch, and the mean KPIs are cached per point
+# (pareto.EvaluationCache), so an interrupted or extended analysis only simulates the new points.
+
+# set up logger
+logger = logging.getLogger('main.sensitivity')
+
+# factor name -> (low, high) for numeric factors or a tuple of options for categorical ones
+FACTORS = {
+    "select_soc": (0.8, 1.0),
+    "target_soc": (0.8, 1.0),
+    "swap_time": (3.0, 10.0),
+    "psc_num": (0.0, 1.0),                      # share of the charge terminals of the station type (at least one)
+    "power_dist_option": ("BSS preferred", "BSC preferred"),
+    "battery_share": (0.0, 1.0),                # share of the first battery type in battery_config
+    "BS_user_num": (40, 200),
+    "non_BS_user_num": (0, 40),
+    "user_preference": ("markov", "full_swap", "fixed_value"),
+}
+OUTPUTS = ("swap_ratio_in_15_min", "swap_wait", "overflow", "energy")
+# swap share of "fixed_value" if the base configuration has none (GUI default)
+FIXED_SERVICE_RATIO = 70
+# default design sizes
+MORRIS_TRAJECTORIES = 20
+MORRIS_LEVELS = 4
+SOBOL_SAMPLES = 256
+REPLICATIONS = 2
+BOOTSTRAP = 500
+CONFIDENCE = 0.95
+
+
+######################################################################
+############################ factors #################################
+######################################################################
+
+def apply(base : dict, point : dict) -> dict:
+    '''
+    param dict of base with the factors of point (factor name -> coordinate in [0, 1)) applied
+    '''
+    param = dict(base)
+    for name, u in point.items():
+        spec = FACTORS[name]
+        if isinstance(spec[0], str):
+            param[name] = spec[min(len(spec) - 1, int(u * len(spec)))]
+            continue
+        value = spec[0] + (spec[1] - spec[0]) * u
+        if name == "psc_num":
+            max_psc = base["station_type"]["max_charge_terminal"]
+            param[name] = min(max_psc, 1 + int(value * max_psc)) if max_psc > 0 else 0
+        elif name == "battery_share":
+            total = sum(base["battery_config"].values())
+            types = list(base["battery_config"])
+            mix = {t: (value if i == 0 else (1.0 - value) / max(1, len(types) - 1)) for i, t in enumerate(types)}
+            param["battery_config"] = sizing.battery_config(mix, total)
+        elif name in ("BS_user_num", "non_BS_user_num"):
+            param[name] = int(round(value))
+        else:
+            param[name] = float(value)
+    if param["user_preference"] == "fixed_value" and param.get("service_ratio", -1) < 0:
+        param["service_ratio"] = FIXED_SERVICE_RATIO
+    if param["psc_num"] == 0:
+        # without charge piles every user swaps (as sizing.design_param)
+        param["user_preference"] = "full_swap"
+        param["non_BS_user_num"] = 0
+    return param
+
+
+def point_key(param : dict, replications, base_seed) -> str:
+    data = {"param": param, "replications": replications, "base_seed": base_seed}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def evaluate(params : list, replications = REPLICATIONS, executor = None, cache = None,
+             base_seed = replication.BASE_SEED, progress_callback = None) -> list:
+    '''
+    mean KPIs of every param dict, replications of uncached points run in one batch on the executor
+    return (list of KPI dicts in the order of params, number of simulations)
+    '''
+    cache = cache if cache is not None else pareto.EvaluationCache()
+    keys = [point_key(p, replications, base_seed) for p in params]
+    todo = {}
+    for key, param in zip(keys, params):
+        if cache.get(key) is None and key not in todo:
+            todo[key] = param
+    work = [(key, param, seed) for key, param in todo.items()
+            for seed in replication.replication_seeds(0, replications, base_seed)]
+    if executor is None:
+        results = (replication.run_replication(param, seed) for _, param, seed in work)
+    else:
+        chunksize = max(1, len(work) // (4 * (os.cpu_count() or 1)))
+        results = executor.map(replication.run_replication, [w[1] for w in work], [w[2] for w in work], chunksize=chunksize)
+    samples = {key: [] for key in todo}
+    for done, ((key, _, _), kpis) in enumerate(zip(work, results)):
+        samples[key].append(kpis)
+        if len(samples[key]) == replications:
+            cache.put(key, {k: replication.summarize(samples[key], k)[0] for k in replication.KPI_NAMES})
+        if progress_callback is not None:
+            progress_callback(done + 1, len(work))
+    return [cache.get(key) for key in keys], len(work)
+
+
+def _interval(values, confidence = CONFIDENCE) -> tuple:
+    values = np.asarray(values)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return float("nan"), float("nan")
+    alpha = (1.0 - confidence) / 2.0
+    return float(np.quantile(values, alpha)), float(np.quantile(values, 1.0 - alpha))
+
+
+######################################################################
+############################# Morris #################################
+######################################################################
+
+def morris_design(factors : list, trajectories = MORRIS_TRAJECTORIES, levels = MORRIS_LEVELS, seed = 0) -> tuple:
+    '''
+    r trajectories of k + 1 points on the p-level grid, step delta = p / (2 (p - 1))
+    return (points as an (r (k + 1), k) array, delta)
+    '''
+    k = len(factors)
+    rng = np.random.default_rng(seed)
+    delta = levels / (2.0 * (levels - 1))
+    start_levels = np.arange(levels // 2) / (levels - 1)            # start points from which x + delta stays in [0, 1]
+    points = []
+    for _ in range(trajectories):
+        x = rng.choice(start_levels, size=k)
+        points.append(x.copy())
+        for i in rng.permutation(k):
+            x[i] += delta
+            points.append(x.copy())
+    return np.array(points), delta
+
+
+def morris(base : dict, factors = None, outputs = OUTPUTS, trajectories = MORRIS_TRAJECTORIES, levels = MORRIS_LEVELS,
+           replications = REPLICATIONS, executor = None, cache = None, seed = 0, base_seed = replication.BASE_SEED,
+           bootstrap = BOOTSTRAP, progress_callback = None) -> dict:
+    '''
+    Morris elementary effects screening around base (a param dict as main.do_simulation takes it)
+    factors:            names of FACTORS, default all; executor / cache / progress_callback as in evaluate()
+    return dict with
+        "indices":      {output: {factor: {"mu_star", "mu_star_ci", "mu", "sigma"}}}, effects per unit coordinate
+        "simulations":  number of simulated days, "points": number of design points, "seconds": wall time
+    '''
+    start = time.time()
+    factors = list(FACTORS if factors is None else factors)
+    k = len(factors)
+    points, delta = morris_design(factors, trajectories, levels, seed)
+    params = [apply(base, dict(zip(factors, x))) for x in points]
+    results, simulations = evaluate(params, replications, executor, cache, base_seed, progress_callback)
+
+    rng = np.random.default_rng(seed + 1)
+    indices = {}
+    for output in outputs:
+        y = np.array([r[output] for r in results], dtype=np.float64).reshape(trajectories, k + 1)
+        x = points.reshape(trajectories, k + 1, k)
+        effects = np.empty((trajectories, k))
+        for t in range(trajectories):
+            for j in range(k):
+                i = int(np.argmax(x[t, j + 1] != x[t, j]))     # factor moved in step j
+                effects[t, i] = (y[t, j + 1] - y[t, j]) / delta
+        resampled = rng.integers(0, trajectories, size=(bootstrap, trajectories))
+        mu_star_boot = np.abs(effects)[resampled].mean(axis=1)
+        indices[output] = {
+            name: {
+                "mu_star": float(np.abs(effects[:, i]).mean()),
+                "mu_star_ci": _interval(mu_star_boot[:, i]),
+                "mu": float(effects[:, i].mean()),
+                "sigma": float(effects[:, i].std(ddof=1)) if trajectories > 1 else float("nan"),
+            } for i, name in enumerate(factors)
+        }
+    seconds = time.time() - start
+    logger.info('morris: %d points, %d simulations in %.1f s', len(params), simulations, seconds)
+    return {"indices": indices, "simulations": simulations, "points": len(params), "seconds": seconds}
+
+
+######################################################################
+############################## Sobol #################################
+######################################################################
+
+def sobol_design(factors : list, samples = SOBOL_SAMPLES, seed = 0) -> np.ndarray:
+    '''
+    Saltelli design: A, B and AB_1 ... AB_k stacked as an (N (k + 2), k) array, A and B Latin hypercube samples
+    '''
+    k = len(factors)
+    rng = np.random.default_rng(seed)
+
+    def hypercube():
+        return (np.argsort(rng.random((samples, k)), axis=0) + rng.random((samples, k))) / samples
+
+    a, b = hypercube(), hypercube()
+    blocks = [a, b]
+    for i in range(k):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+    return np.vstack(blocks)
+
+
+def _sobol_indices(f_a, f_b, f_ab) -> tuple:
+    '''
+    first order and total indices of all factors, f_ab: (k, N)
+    '''
+    var = np.var(np.concatenate([f_a, f_b]), ddof=1)
+    if not var > 0:
+        nan = np.full(len(f_ab), np.nan)
+        return nan, nan
+    first = np.mean(f_b * (f_ab - f_a), axis=1) / var
+    total = 0.5 * np.mean((f_a - f_ab) ** 2, axis=1) / var
+    return first, total
+
+
+def sobol(base : dict, factors = None, outputs = OUTPUTS, samples = SOBOL_SAMPLES, replications = REPLICATIONS,
+          executor = None, cache = None, seed = 0, base_seed = replication.BASE_SEED, bootstrap = BOOTSTRAP,
+          progress_callback = None) -> dict:
+    '''
+    Sobol indices around base (a param dict as main.do_simulation takes it), N (k + 2) design points
+    factors:            names of FACTORS, default all; executor / cache / progress_callback as in evaluate()
+    return dict with
+        "indices":      {output: {factor: {"S1", "S1_ci", "ST", "ST_ci"}}}
+        "simulations":  number of simulated days, "points": number of design points, "seconds": wall time
+    '''
+    start = time.time()
+    factors = list(FACTORS if factors is None else factors)
+    k = len(factors)
+    points = sobol_design(factors, samples, seed)
+    params = [apply(base, dict(zip(factors, x))) for x in points]
+    results, simulations = evaluate(params, replications, executor, cache, base_seed, progress_callback)
+
+    rng = np.random.default_rng(seed + 1)
+    resampled = rng.integers(0, samples, size=(bootstrap, samples))
+    indices = {}
+    for output in outputs:
+        y = np.array([r[output] for r in results], dtype=np.float64).reshape(k + 2, samples)
+        f_a, f_b, f_ab = y[0], y[1], y[2:]
+        first, total = _sobol_indices(f_a, f_b, f_ab)
+        boot = [_sobol_indices(f_a[rows], f_b[rows], f_ab[:, rows]) for rows in resampled]
+        first_boot = np.array([b[0] for b in boot])
+        total_boot = np.array([b[1] for b in boot])
+        indices[output] = {
+            name: {
+                "S1": float(first[i]), "S1_ci": _interval(first_boot[:, i]),
+                "ST": float(total[i]), "ST_ci": _interval(total_boot[:, i]),
+            } for i, name in enumerate(factors)
+        }
+    seconds = time.time() - start
+    logger.info('sobol: %d points, %d simulations in %.1f s', len(params), simulations, seconds)
+    return {"indices": indices, "simulations": simulations, "points": len(params), "seconds": seconds}
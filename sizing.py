@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import time
+
+import global_param as GC
+import queueing
+import replication
+
+# Simulation based sizing of a swap station.
+# For a demand (daily swap and charge users, user model) and service targets (swap ratio within 15 min,
+# swap users left waiting at the end of the day) optimize() searches the cheapest feasible design among
+# candidate_designs(): station type, number of charge piles (psc_num), number of batteries and, for user
+# defined stations, power module type and number.
+# Successive halving on replication counts: all candidates get the first few replications (common random
+# numbers, see replication.py), candidates that are clearly infeasible (confidence interval completely on
+# the wrong side of a target) are dropped, the others get twice as many replications, and so on. The confidence
+# intervals use the t quantile for the replications done, and nothing is decided on fewer than MIN_REPLICATIONS.
+# Candidates are sorted by cost: once a candidate is clearly feasible, every candidate that is not cheaper
+# is dropped as well, and the search stops as soon as the cheapest remaining candidate is clearly feasible.
+# Before the first round the analytic pre-screen (queueing.screen) removes candidates that clearly miss a target
+# without simulating them (verdict "screened out").
+# The cost model is a relative one (cost units), adapt the weights below to real prices.
+
+# set up logger
+logger = logging.getLogger('main.sizing')
+
+# relative cost weights
+STATION_COST = {"GEN2_530": 100, "GEN3_600": 120, "GEN3_1200": 160, "User_Defined": 90}
+BATTERY_COST = 8                # per battery in the racks
+PILE_COST = 6                   # per charge pile (BSC)
+POWER_COST = 0.05               # per kW installed module power
+# swap time of the station types [min], as preset in the GUI
+SWAP_TIME = {"GEN2_530": 6.5, "GEN3_600": 4.5, "GEN3_1200": 4.5, "User_Defined": 3.0}
+# cumulative replications per candidate in the successive rounds
+REPLICATION_ROUNDS = (4, 8, 16)
+# confidence of the intervals as a normal quantile, the half width is the t quantile of the same confidence
+CONFIDENCE_Z = 1.96
+# no verdict (and so no candidate dropped) on fewer replications
+MIN_REPLICATIONS = 4
+# default shares of the battery types
+BATTERY_MIX = {"100kWh": 0.75, "75kWh": 0.25}
+# default service targets
+TARGET_SWAP_RATIO = 0.9
+MAX_OVERFLOW = 0
+
+
+def base_param(demand : dict) -> dict:
+    '''
+    simulation parameters of a demand, the station part is set per design by design_param()
+    demand keys: BS_user_num, non_BS_user_num and optional user_sequence_mode, user_area, user_preference,
+                 service_ratio, opening_hours, battery_mix, init_battery_soc_in_BSS, target_soc, select_soc
+    battery_mix: shares of the battery types in the racks and the user vehicles, e.g. {"100kWh": 0.75, "75kWh": 0.25}
+                 (the user battery model takes two or three types)
+    '''
+    return {
+        "init_battery_soc_in_BSS" : demand.get("init_battery_soc_in_BSS", 0.95),
+        "target_soc" : demand.get("target_soc", 0.9),
+        "select_soc" : demand.get("select_soc", 0.95),
+        "BS_user_num" : demand["BS_user_num"],
+        "non_BS_user_num" : demand.get("non_BS_user_num", 0),
+        "sim_days" : 1,
+        "sim_interval" : 10,
+        "sim_ticks" : 8640,
+        "swap_rack_temperature" : 25,
+        "user_sequence_mode" : demand.get("user_sequence_mode", "random"),
+        "user_area" : demand.get("user_area", None),
+        "user_preference" : demand.get("user_preference", "markov"),
+        "charge_power_redist" : False,
+        "enable_me_switch" : 1,
+        "power_dist_option" : demand.get("power_dist_option", "BSS preferred"),
+        "service_ratio" : demand.get("service_ratio", -1),
+        "grid_interaction_idx" : -1,
+        "interaction_num" : 0,
+        "opening_hours" : demand.get("opening_hours", "24 hours"),
+        "battery_mix" : demand.get("battery_mix", BATTERY_MIX),
+    }
+
+
+def make_design(station_type : dict, psc_num, battery_num) -> dict:
+    '''
+    design of a station type with psc_num charge piles and battery_num batteries
+    '''
+    station_type = dict(station_type)
+    station_type["max_charge_terminal"] = psc_num
+    name = "%s, %d batteries, %d BSC" % (station_type["station_type"], battery_num, psc_num)
+    if station_type["station_type"] == "User_Defined":
+        name += ", %d x %d kW modules" % (station_type["max_charger_number"], station_type["power_module_type"]["max_power"])
+    return {"name": name, "station_type": station_type, "psc_num": psc_num, "battery_num": battery_num}
+
+
+def candidate_designs(demand : dict, battery_steps = (0.5, 0.75, 1.0), module_types = ("40kW", "60kW"), module_numbers = (10, 20)) -> list:
+    '''
+    candidate designs for a demand
+    battery_steps: battery numbers as fractions of the rack places of a station type
+    stations without charge piles are only candidates if there are no non BS users
+    '''
+    needs_bsc = demand.get("non_BS_user_num", 0) > 0
+    designs = []
+
+    def batteries(places):
+        return sorted({max(1, int(round(places * f))) for f in battery_steps})
+
+    if not needs_bsc:
+        for n in batteries(GC.GEN2_530kW["max_battery_number"]):
+            designs.append(make_design(GC.GEN2_530kW, 0, n))
+    for station_type in (GC.GEN3_600kW, GC.GEN3_1200kW):
+        max_psc = station_type["max_charge_terminal"]
+        for psc_num in ((max_psc // 2, max_psc) if needs_bsc else (0,)):
+            for n in batteries(station_type["max_battery_number"]):
+                designs.append(make_design(station_type, psc_num, n))
+    for module_type in module_types:
+        for module_number in module_numbers:
+            station_type = dict(GC.User_Defined)
+            station_type["power_module_type"] = dict(GC.power_module_catalog[module_type])
+            station_type["max_charger_number"] = module_number
+            station_type["max_battery_number"] = module_number
+            station_type["max_power"] = int(station_type["power_module_type"]["max_power"] * module_number)
+            for psc_num in ((2, 4) if needs_bsc else (0,)):
+                for n in batteries(module_number):
+                    designs.append(make_design(station_type, psc_num, n))
+    return designs
+
+
+def design_cost(design : dict) -> float:
+    station_type = design["station_type"]
+    return STATION_COST[station_type["station_type"]] + BATTERY_COST * design["battery_num"] + \
+        PILE_COST * design["psc_num"] + POWER_COST * station_type["max_power"]
+
+
+def battery_config(battery_mix : dict, battery_num) -> dict:
+    '''
+    split battery_num batteries by the shares of battery_mix (largest remainder)
+    '''
+    total = sum(battery_mix.values())
+    exact = {k: battery_num * v / total for k, v in battery_mix.items()}
+    config = {k: int(v) for k, v in exact.items()}
+    for k in sorted(exact, key=lambda k: exact[k] - config[k], reverse=True)[:battery_num - sum(config.values())]:
+        config[k] += 1
+    return config
+
+
+def design_param(base : dict, design : dict) -> dict:
+    '''
+    simulation parameters of a design for the demand base_param()
+    '''
+    param = dict(base)
+    param["station_type"] = design["station_type"]
+    param["psc_num"] = design["psc_num"]
+    param["battery_config"] = battery_config(param.pop("battery_mix"), design["battery_num"])
+    param["swap_time"] = SWAP_TIME[design["station_type"]["station_type"]]
+    if design["psc_num"] == 0:
+        param["user_preference"] = "full_swap"
+    return param
+
+
+def verdict(samples : list, target_swap_ratio, max_overflow, z = CONFIDENCE_Z) -> str:
+    '''
+    "infeasible" or "feasible" if the confidence intervals decide it, otherwise "open"
+    the intervals use the t quantile for the number of samples, below MIN_REPLICATIONS samples the verdict is "open"
+    '''
+    if len(samples) < MIN_REPLICATIONS:
+        return "open"
+    z = replication.t_quantile(z, len(samples) - 1)
+    ratio, ratio_se = replication.summarize(samples, "swap_ratio_in_15_min")
+    overflow, overflow_se = replication.summarize(samples, "overflow")
+    if ratio + z * ratio_se < target_swap_ratio or overflow - z * overflow_se > max_overflow:
+        return "infeasible"
+    if ratio - z * ratio_se >= target_swap_ratio and overflow + z * overflow_se <= max_overflow:
+        return "feasible"
+    return "open"
+
+
+def optimize(demand : dict, target_swap_ratio = TARGET_SWAP_RATIO, max_overflow = MAX_OVERFLOW, designs = None,
+             rounds = REPLICATION_ROUNDS, executor = None, base_seed = replication.BASE_SEED, progress_callback = None,
+             prescreen = True) -> dict:
+    '''
+    search the cheapest feasible design for a demand
+    executor:           optional concurrent.futures executor to run the replications in parallel (e.g. jobs.pool())
+    progress_callback:  optional callable(simulations done, round, number of rounds), may raise to cancel the search
+    prescreen:          drop candidates the analytic estimate (queueing.py) rejects before simulating them
+    return dict with
+        "design":       the recommended design (None if no candidate met the targets), with its "cost" and mean "kpis"
+        "candidates":   all candidates with cost, replications, mean KPIs and verdict, sorted by cost
+        "simulations":  number of simulated days, "screened": number of candidates screened out, "seconds": wall time
+    '''
+    start = time.time()
+    base = base_param(demand)
+    if designs is None:
+        designs = candidate_designs(demand)
+    candidates = []
+    for design in designs:
+        candidates.append(dict(design, cost=design_cost(design), samples=[], verdict="open"))
+    candidates.sort(key=lambda c: c["cost"])
+    screened = 0
+    if prescreen:
+        for c in candidates:
+            passed, c["estimate"] = queueing.screen(design_param(base, c), target_swap_ratio, max_overflow)
+            if not passed:
+                c["verdict"] = "screened out"
+                screened += 1
+        logger.info('sizing pre-screen: %d of %d candidates screened out', screened, len(candidates))
+
+    simulations = 0
+    for round_idx, n in enumerate(rounds):
+        alive = [c for c in candidates if c["verdict"] not in ("infeasible", "dropped", "screened out")]
+        work = []
+        for c in alive:
+            param = design_param(base, c)
+            for seed in replication.replication_seeds(len(c["samples"]), n, base_seed):
+                work.append((c, param, seed))
+        if executor is None:
+            results = (replication.run_replication(param, seed) for _, param, seed in work)
+        else:
+            results = executor.map(replication.run_replication, [w[1] for w in work], [w[2] for w in work])
+        try:
+            for (c, _, _), kpis in zip(work, results):
+                c["samples"].append(kpis)
+                simulations += 1
+                if progress_callback is not None:
+                    progress_callback(simulations, round_idx, len(rounds))
+        finally:
+            # if the progress_callback raises (search cancelled), the replications not started yet are dropped
+            results.close()
+
+        for c in alive:
+            c["verdict"] = verdict(c["samples"], target_swap_ratio, max_overflow)
+        # a clearly feasible candidate makes all candidates that are not cheaper useless
+        feasible = [c for c in alive if c["verdict"] == "feasible"]
+        if len(feasible) > 0:
+            for c in alive:
+                if c["cost"] >= feasible[0]["cost"] and c is not feasible[0] and c["verdict"] != "infeasible":
+                    c["verdict"] = "dropped"
+        remaining = [c for c in alive if c["verdict"] in ("open", "feasible")]
+        logger.info('sizing round %d: %d replications, %d of %d candidates remain', round_idx, n, len(remaining), len(candidates))
+        if len(remaining) == 0 or remaining[0]["verdict"] == "feasible":
+            break
+
+    # after the last round the open candidates are judged by their means
+    best = None
+    for c in candidates:
+        c["kpis"] = {name: replication.summarize(c["samples"], name)[0] for name in replication.KPI_NAMES}
+        c["replications"] = len(c["samples"])
+        if c["verdict"] == "open" and c["kpis"]["swap_ratio_in_15_min"] >= target_swap_ratio and c["kpis"]["overflow"] <= max_overflow:
+            c["verdict"] = "feasible (mean)"
+        if best is None and c["verdict"] in ("feasible", "feasible (mean)"):
+            best = c
+        del c["samples"]
+
+    seconds = time.time() - start
+    logger.info('sizing: %d simulations in %.1f s, recommendation: %s', simulations, seconds, best["name"] if best else None)
+    return {"design": best, "candidates": candidates, "simulations": simulations, "screened": screened, "seconds": seconds}
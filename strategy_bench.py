@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import time
+
+import main
+import replication
+import swap
+
+# Comparison of the power distribution strategies (swap.POWER_STRATEGIES).
+# Every strategy is run on the same seeded scenarios (common random numbers, see replication.py), so the KPI
+# differences between the strategies are not noise of the user arrivals. Next to the service KPIs of
+# replication.kpis() the cost of a strategy is measured:
+#   - strategy_us_per_tick: time spent in its distribute() per simulation tick [microseconds]
+#   - distributions:        share of the swap rack ticks in which it ran (strategies driven by events skip ticks)
+#   - run_seconds:          wall time of the whole run
+
+# set up logger
+logger = logging.getLogger('main.strategy_bench')
+
+COST_NAMES = ("strategy_us_per_tick", "distributions", "run_seconds")
+
+
+class TimedStrategy(swap.PowerStrategy):
+    '''
+    wraps a strategy, counts the calls of distribute() and the time spent in them
+    '''
+    def __init__(self, strategy : swap.PowerStrategy):
+        self.strategy = strategy
+        self.name = strategy.name
+        self.invalidated_by = strategy.invalidated_by
+        self.racks_first = strategy.racks_first
+        self.calls = 0
+        self.seconds = 0.0
+
+    def distribute(self, swap_rack):
+        start = time.perf_counter()
+        self.strategy.distribute(swap_rack)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+
+
+def run_strategy(param : dict, name, seed) -> dict:
+    '''
+    worker side: one seeded run of param with the strategy name, return its KPIs and cost (COST_NAMES)
+    '''
+    start = time.perf_counter()
+    run = main.SimulationRun(dict(param, power_dist_option=name, seed=seed))
+    timed = TimedStrategy(run.station.power_strategy)
+    run.station.power_strategy = timed
+    run.run()
+    sample = replication.kpis(run.results(), param["sim_interval"])
+    sample["strategy_us_per_tick"] = 1e6 * timed.seconds / run.sim_ticks
+    sample["distributions"] = timed.calls / (run.sim_ticks * len(run.station.swap_rack_list))
+    sample["run_seconds"] = time.perf_counter() - start
+    return sample
+
+
+def compare(param : dict, n = 4, strategies = None, executor = None, base_seed = replication.BASE_SEED) -> list:
+    '''
+    run every strategy (default: all registered) on the same n seeded scenarios of param,
+    in parallel if an executor (e.g. jobs.pool()) is given
+    return one dict per strategy: "strategy", "replications", mean and standard error (key + "_se") of every KPI
+    and cost value, and the KPI dicts "samples"
+    '''
+    names = list(strategies) if strategies is not None else list(swap.POWER_STRATEGIES)
+    seeds = replication.replication_seeds(0, n, base_seed)
+    runs = [(name, seed) for name in names for seed in seeds]
+    if executor is None:
+        samples = [run_strategy(param, name, seed) for name, seed in runs]
+    else:
+        samples = list(executor.map(run_strategy, [param] * len(runs), [r[0] for r in runs], [r[1] for r in runs]))
+    rows = []
+    for k, name in enumerate(names):
+        row = {"strategy": name, "replications": n, "samples": samples[k * n:(k + 1) * n]}
+        for key in row["samples"][0]:
+            row[key], row[key + "_se"] = replication.summarize(row["samples"], key)
+        logger.info('%s: swap wait %.2f min, %.1f us per tick', name, row["swap_wait"], row["strategy_us_per_tick"])
+        rows.append(row)
+    return rows
+
+
+def table(rows : list, names = ("swap_ratio_in_15_min", "swap_wait", "charge_wait", "energy") + COST_NAMES) -> str:
+    '''
+    text table of the mean values of compare()
+    '''
+    lines = ["%-24s" % "strategy" + "".join("%22s" % name for name in names)]
+    for row in rows:
+        lines.append("%-24s" % row["strategy"] + "".join("%22.4g" % row[name] for name in names))
+    return "\n".join(lines)
@@ -0,0 +1,284 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import math
+import os
+import pickle
+import random
+
+import numpy as np
+
+import checkpoint
+import replication
+import sizing
+
+# Surrogate model of the simulation for instant KPI estimates.
+# A Gaussian process (squared exponential kernel with one length scale per feature, NumPy only) is
+# trained on a sweep of seeded simulations around a base configuration and predicts TARGETS with a
+# standard deviation in some ten microseconds. The length scales and the noise level are shared by all
+# targets (each target standardized), so one kernel vector serves all predictions of a query.
+# A query is outside the training domain if one of its categorical settings (CONTEXT_KEYS, station type)
+# was not trained, a numeric feature leaves the trained range, or the predictive standard deviation is
+# large compared to the spread of the training data. Outside the domain estimate() falls back to a real
+# simulation.
+
+# set up logger
+logger = logging.getLogger('main.surrogate')
+
+TARGETS = ("average_time_swap", "swap_ratio_in_15_min", "overflow", "energy")
+# numeric features: name -> function(param)
+FEATURES = {
+    "BS_user_num": lambda p: p["BS_user_num"],
+    "non_BS_user_num": lambda p: p["non_BS_user_num"],
+    "psc_num": lambda p: p["psc_num"],
+    "battery_num": lambda p: sum(p["battery_config"].values()),
+    "battery_share": lambda p: list(p["battery_config"].values())[0] / max(1, sum(p["battery_config"].values())),
+    "max_power": lambda p: p["station_type"]["max_power"],
+    "swap_time": lambda p: p["swap_time"],
+    "init_battery_soc_in_BSS": lambda p: p["init_battery_soc_in_BSS"],
+    "select_soc": lambda p: p["select_soc"],
+    "target_soc": lambda p: p["target_soc"],
+}
+# settings a model is only valid for as trained
+CONTEXT_KEYS = ("user_sequence_mode", "user_area", "user_preference", "service_ratio", "opening_hours",
+                "power_dist_option", "enable_me_switch", "charge_power_redist", "grid_interaction_idx",
+                "interaction_num", "sim_ticks", "sim_interval", "warm_start", "truncate_warmup", "battery_selection",
+                "battery_match_type", "swap_lanes", "user_abandonment", "user_patience", "max_wait_number", "max_charge_time",
+                "charge_queue_discipline", "reserved_piles", "power_cap", "cabinet_power_cap")
+# predictive std / std of the training targets above which a query counts as outside the domain
+MAX_RELATIVE_STD = 0.5
+# default sweep ranges around a base configuration, (low, high); battery_num is a fraction of the rack places
+SWEEP_RANGES = {
+    "BS_user_num": (20, 200),
+    "non_BS_user_num": (0, 40),
+    "battery_num": (0.4, 1.0),
+    "swap_time": (3.0, 10.0),
+    "init_battery_soc_in_BSS": (0.3, 1.0),
+    "select_soc": (0.7, 1.0),
+}
+SWEEP_POINTS = 200
+# in a private folder of the current user, the model is unpickled on load (see checkpoint.private_dir)
+MODEL_PATH = os.environ.get("BSS_SURROGATE", os.path.join(checkpoint.CACHE_ROOT, "surrogate.pkl"))
+
+
+def context(param : dict) -> tuple:
+    '''
+    categorical settings of param: station type (with module type) and CONTEXT_KEYS
+    '''
+    station_type = param["station_type"]
+    module = station_type.get("power_module_type")
+    return (station_type["station_type"], module["max_power"] if module else None) + \
+        tuple(param.get(k) for k in CONTEXT_KEYS)
+
+
+def feature_vector(param : dict) -> np.ndarray:
+    return np.array([f(param) for f in FEATURES.values()], dtype=np.float64)
+
+
+######################################################################
+########################### sweep ####################################
+######################################################################
+
+def sweep_params(base : dict, n = SWEEP_POINTS, ranges = None, seed = 0) -> list:
+    '''
+    n parameter sets around base, Latin hypercube over the sweep ranges
+    psc_num is drawn from 0 ... max_charge_terminal of the station type
+    '''
+    ranges = dict(SWEEP_RANGES if ranges is None else ranges)
+    rng = np.random.default_rng(seed)
+    strata = {name: (rng.permutation(n) + rng.random(n)) / n for name in ranges}
+    max_psc = base["station_type"]["max_charge_terminal"]
+    places = base["station_type"]["max_battery_number"]
+    params = []
+    for i in range(n):
+        value = {name: lo + (hi - lo) * strata[name][i] for name, (lo, hi) in ranges.items()}
+        param = dict(base)
+        for name in ("BS_user_num", "non_BS_user_num"):
+            if name in value:
+                param[name] = int(round(value[name]))
+        for name in ("swap_time", "init_battery_soc_in_BSS", "select_soc", "target_soc"):
+            if name in value:
+                param[name] = float(value[name])
+        if "battery_num" in value:
+            param["battery_config"] = sizing.battery_config(base["battery_config"], max(1, int(round(places * value["battery_num"]))))
+        param["psc_num"] = int(rng.integers(0, max_psc + 1))
+        if param["psc_num"] == 0 and param["user_preference"] == "markov":
+            param["user_preference"] = "full_swap"
+            param["non_BS_user_num"] = 0
+        params.append(param)
+    return params
+
+
+def run_sweep(params : list, executor = None, base_seed = replication.BASE_SEED, progress_callback = None) -> list:
+    '''
+    simulate every parameter set once (own seed per set), return the KPI dicts
+    progress_callback: optional callable(simulations done, total), may raise to cancel the sweep
+    '''
+    seeds = [base_seed + i for i in range(len(params))]
+    if executor is None:
+        results = (replication.run_replication(p, s) for p, s in zip(params, seeds))
+    else:
+        # small chunks, so the progress is reported (and a cancel is noticed) regularly
+        chunksize = max(1, len(params) // (16 * (os.cpu_count() or 1)))
+        results = executor.map(replication.run_replication, params, seeds, chunksize=chunksize)
+    samples = []
+    try:
+        for kpis in results:
+            samples.append(kpis)
+            if progress_callback is not None:
+                progress_callback(len(samples), len(params))
+    finally:
+        # a cancelled sweep drops the simulations not started yet
+        results.close()
+    return samples
+
+
+######################################################################
+######################## Gaussian process ############################
+######################################################################
+
+class Surrogate:
+    '''
+    Gaussian process surrogate of the TARGETS, see the comment at the top of this module
+    '''
+    def __init__(self):
+        self.contexts = []          # trained contexts, one-hot encoded after the numeric features
+        self.low = None             # trained range of the numeric features
+        self.high = None
+
+    def _encode(self, params : list) -> np.ndarray:
+        x = np.array([feature_vector(p) for p in params])
+        onehot = np.zeros((len(params), len(self.contexts)))
+        for i, p in enumerate(params):
+            onehot[i, self.contexts.index(context(p))] = 1.0
+        return np.hstack([x, onehot])
+
+    @staticmethod
+    def _log_likelihood(x, y, log_scale, log_noise):
+        '''
+        sum over the targets of the log marginal likelihood, None if K is not positive definite
+        '''
+        z = x / np.exp(log_scale)
+        sq = np.sum(z * z, axis=1)
+        k = np.exp(-0.5 * np.maximum(sq[:, None] + sq[None, :] - 2.0 * z @ z.T, 0.0))
+        k[np.diag_indices_from(k)] += np.exp(log_noise)
+        try:
+            l = np.linalg.cholesky(k)
+        except np.linalg.LinAlgError:
+            return None
+        alpha = np.linalg.solve(l.T, np.linalg.solve(l, y))
+        n, m = y.shape
+        return -0.5 * np.sum(y * alpha) - m * np.sum(np.log(np.diag(l))) - 0.5 * n * m * math.log(2 * math.pi)
+
+    def fit(self, params : list, kpis : list, sweeps = 4):
+        '''
+        train on parameter sets and their KPIs, the hyperparameters are chosen by coordinate search
+        on the log marginal likelihood
+        '''
+        self.contexts = sorted(set(context(p) for p in params), key=repr)
+        x = self._encode(params)
+        y = np.array([[k[t] for t in TARGETS] for k in kpis], dtype=np.float64)
+        nf = len(FEATURES)
+        self.low, self.high = x[:, :nf].min(axis=0), x[:, :nf].max(axis=0)
+        self.x_mean, self.x_std = x.mean(axis=0), x.std(axis=0)
+        self.x_std[self.x_std == 0] = 1.0
+        self.y_mean, self.y_std = y.mean(axis=0), y.std(axis=0)
+        self.y_std[self.y_std == 0] = 1.0
+        xs = (x - self.x_mean) / self.x_std
+        ys = (y - self.y_mean) / self.y_std
+
+        log_scale = np.full(xs.shape[1], math.log(math.sqrt(xs.shape[1])))
+        log_noise = math.log(0.05)
+        best = self._log_likelihood(xs, ys, log_scale, log_noise)
+        for _ in range(sweeps):
+            for i in range(len(log_scale) + 1):
+                for step in (-0.7, 0.7, -1.4, 1.4):
+                    scale, noise = log_scale.copy(), log_noise
+                    if i < len(log_scale):
+                        scale[i] += step
+                    else:
+                        noise = min(0.0, max(math.log(1e-4), noise + step))
+                    ll = self._log_likelihood(xs, ys, scale, noise)
+                    if ll is not None and ll > best:
+                        best, log_scale, log_noise = ll, scale, noise
+        self.scale = np.exp(log_scale)
+        self.noise = math.exp(log_noise)
+
+        # precomputed for the predictions: scaled training inputs, weights and the inverse kernel matrix
+        self._z = xs / self.scale
+        self._sq = np.sum(self._z * self._z, axis=1)
+        sq = self._sq
+        k = np.exp(-0.5 * np.maximum(sq[:, None] + sq[None, :] - 2.0 * self._z @ self._z.T, 0.0))
+        k[np.diag_indices_from(k)] += self.noise
+        l = np.linalg.cholesky(k)
+        l_inv = np.linalg.solve(l, np.eye(len(k)))
+        self._k_inv = l_inv.T @ l_inv
+        self._alpha = self._k_inv @ ys
+        logger.info('surrogate trained on %d runs, log likelihood %.1f, noise %.3g', len(params), best, self.noise)
+        return self
+
+    def predict(self, param : dict) -> dict:
+        '''
+        return {target: (mean, std)} and ignore the training domain, see in_domain()
+        '''
+        mean, std = self._predict(self._encode([param])[0])
+        return {t: (mean[i], std[i]) for i, t in enumerate(TARGETS)}
+
+    def _predict(self, x):
+        z = (x - self.x_mean) / self.x_std / self.scale
+        k = np.exp(-0.5 * np.maximum(self._sq + z @ z - 2.0 * self._z @ z, 0.0))
+        var = max(0.0, 1.0 + self.noise - k @ self._k_inv @ k)
+        return self.y_mean + self.y_std * (k @ self._alpha), self.y_std * math.sqrt(var)
+
+    def in_domain(self, param : dict) -> tuple:
+        '''
+        return (True, "") or (False, reason) for a query
+        '''
+        if context(param) not in self.contexts:
+            return False, "station type or settings not trained"
+        x = feature_vector(param)
+        for i, name in enumerate(FEATURES):
+            if x[i] < self.low[i] or x[i] > self.high[i]:
+                return False, "%s = %g outside the trained range %g ... %g" % (name, x[i], self.low[i], self.high[i])
+        _, std = self._predict(self._encode([param])[0])
+        relative = float(np.max(std / self.y_std))
+        if relative > MAX_RELATIVE_STD:
+            return False, "too far from the training runs (relative std %.2f)" % relative
+        return True, ""
+
+    def save(self, path = MODEL_PATH):
+        checkpoint.private_dir(os.path.dirname(os.path.abspath(path)))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path = MODEL_PATH):
+        '''
+        load a saved model, raise OSError if its folder is not private to the current user
+        '''
+        checkpoint.private_dir(os.path.dirname(os.path.abspath(path)))
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def train(base : dict, n = SWEEP_POINTS, ranges = None, executor = None, seed = 0, progress_callback = None) -> Surrogate:
+    '''
+    sweep n configurations around base and train a surrogate on them, progress_callback as in run_sweep()
+    '''
+    params = sweep_params(base, n, ranges, seed)
+    return Surrogate().fit(params, run_sweep(params, executor, progress_callback=progress_callback))
+
+
+def estimate(model : Surrogate, param : dict, seed = None) -> dict:
+    '''
+    KPI estimate for param: from the surrogate inside its domain, otherwise from one simulation
+    return dict with "source" ("surrogate" or "simulation"), "reason" (why simulated) and
+    the TARGETS as (mean, std), std is None for simulated values
+    '''
+    ok, reason = (False, "no surrogate trained") if model is None else model.in_domain(param)
+    if ok:
+        return dict(model.predict(param), source="surrogate", reason="")
+    kpis = replication.run_replication(param, seed if seed is not None else random.randrange(1 << 30))
+    return dict({t: (kpis[t], None) for t in TARGETS}, source="simulation", reason=reason)
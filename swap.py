@@ -3,18 +3,58 @@
 
 ### External library call ###
 import numpy as np
+import heapq
 import math
 import logging
-import global_param
-
-# load global Parameters
-GC = global_param.Global_Constant()
-# GP = global_param.Global_Parameter()
+import os
+import global_param as GC                      # frozen catalog, built once per process
 
 # setup logger
 logger = logging.getLogger('main.swap')
 data_logger = logging.getLogger('data.swap')
 
+# plain Python copies of the read-only catalog tables for the per tick battery lookups,
+# indexing NumPy arrays element by element (and NumPy scalar arithmetic) is much slower
+_OCV_100 = tuple(GC.ocv_100.tolist())
+_OCV_70 = tuple(GC.ocv_70.tolist())
+_CHARGE_LIMIT_ROWS = {bt: {t: tuple(row.tolist()) for t, row in table.items()} for bt, table in GC.battery_charge_limit.items()}
+
+######################################################################
+####################### State codes ##################################
+######################################################################
+
+# integer state codes of the battery racks (Battery_Rack.state), charge piles (Charge_Pile.state), power modules,
+# swap lanes (SwapLane.state) and the swap platform (SwapStation.state). The codes of the racks and piles of a
+# swap rack are also kept in its byte arrays rack_states and pile_states, so a scan is one bytearray.find().
+# The status properties still give the names.
+FREE, IN_USE, SWITCH, LOADED, CHARGING, DISCHARGING, CONNECTED = range(7)
+STATE_NAMES = ("free", "in_use", "switch", "loaded", "charging", "discharging", "connected")
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+# allowed changes of state per kind of equipment (staying in a state is always allowed)
+TRANSITIONS = {
+    "rack": {FREE: {LOADED}, LOADED: {FREE, CHARGING, DISCHARGING}, CHARGING: {LOADED}, DISCHARGING: {LOADED}},
+    "pile": {FREE: {CONNECTED}, CONNECTED: {FREE, CHARGING}, CHARGING: {CONNECTED}},
+    "lane": {FREE: {IN_USE}, IN_USE: {FREE}},
+    "platform": {FREE: {IN_USE, SWITCH}, IN_USE: {FREE}, SWITCH: {FREE}},
+}
+# debug mode: every change of state is checked against TRANSITIONS and the battery of the rack or pile,
+# switched on with the environment variable BSS_CHECK_STATES=1 (or by setting swap.CHECK_STATES = True)
+CHECK_STATES = os.environ.get("BSS_CHECK_STATES", "0") not in ("", "0")
+
+
+class StateError(ValueError):
+    '''
+    illegal change of state or illegal state of an equipment, raised in the debug mode (CHECK_STATES)
+    '''
+
+
+def check_transition(kind, old, new, name):
+    '''
+    raise StateError if the equipment name of the given kind (key of TRANSITIONS) may not change from old to new
+    '''
+    if new != old and new not in TRANSITIONS[kind].get(old, ()):
+        raise StateError('%s: illegal change of state %s -> %s' % (name, STATE_NAMES[old], STATE_NAMES[new]))
+
 ######################################################################
 ####################### Class: Battery ###############################
 ######################################################################
@@ -36,31 +76,18 @@ class Battery:
         Note:   1-3 cannot combine with 4,5 -> not swapable
                 if No Data avaiable, by default we use data from 100kWh
         '''
-        self.charge_limit_100 = GC.charge_limit_100
-        self.charge_limit_75 = GC.charge_limit_75
-        self.charge_limit_70 = GC.charge_limit_70
-        self.ocv_100 = GC.ocv_100
-        self.ocv_70 = GC.ocv_70
-        battery_charge_limit={  
-            "70kWh": self.charge_limit_70,
-            "75kWh": self.charge_limit_75,
-            "100kWh": self.charge_limit_100,
-            "40kWh": self.charge_limit_100,
-            "60kWh": self.charge_limit_100
-                            }
-        self.battery_capacity = GC.battery_capacity                     # battery capacity [Ah]
         self.batterytype = batterytype                                  # string -> 70kWh, 100kWh, 75kWh..
         
-        if batterytype in self.battery_capacity:
-            self.capacity = self.battery_capacity[batterytype]          # Return the battery Ah number return int
-            self.charge_limit = battery_charge_limit[batterytype]       # Return charging limit dict
+        if batterytype in GC.battery_capacity:
+            self.capacity = GC.battery_capacity[batterytype]            # Return the battery Ah number return int
+            self.charge_limit = _CHARGE_LIMIT_ROWS[batterytype]         # Return charging limit dict (shared, do not modify)
         else:
             '''
             if No batteries type are found, return default setup (100kWh Batteries)
             '''
             print("No such battery type, using default type 100kWh")
-            self.capacity = self.battery_capacity["100kWh"]
-            self.charge_limit = battery_charge_limit["100kWh"]
+            self.capacity = GC.battery_capacity["100kWh"]
+            self.charge_limit = _CHARGE_LIMIT_ROWS["100kWh"]
         
         self.soc = soc
         self.set_temperature(temperature)                               # The default battery temperature is 25 degrees
@@ -140,11 +167,11 @@ class Battery:
         # set open circuit voltage under current soc value -> give it to battery_voltage
         if self.batterytype == "70kWh":
             
-            self.battery_voltage = self.ocv_70[cal_soc]
+            self.battery_voltage = _OCV_70[cal_soc]
             return
         else:
             
-            self.battery_voltage = self.ocv_100[cal_soc]
+            self.battery_voltage = _OCV_100[cal_soc]
             return
 
     def set_temperature(self, real_temperature):
@@ -211,81 +238,67 @@ class Battery:
 ######################################################################
 
 class Power_Module:
-    def __init__(self, module, id):
-        # Module parameters are entered using a dictionary, including maximum power and maximum current.
-        self.max_power = module["max_power"]
-        self.max_current = module["max_current"]
-        self.line_resistance = 0.008 # 8 mohm
+    '''
+    one power module of a Power_Cabinet: a view of entry id of the module lists of the cabinet
+    link_to: 0 disconnect, Positive integer - battery compartment in the battery swap station, negative integer - charging pile
+    '''
+    def __init__(self, cabinet, id):
+        self.cabinet = cabinet
         self.id = id
-        self.status = "free" # free & in_use
-        # Defines the state of being connected to the battery compartment of the swap station 
-        # or to an external charging pile
-        self.link_to = 0 # 0 disconnect, Positive integer - battery compartment in the battery swap station, negative integer - charging pile
-        self.power = 0
-        self.output_voltage = 0
-        self.output_current = 0
+
+    @property
+    def max_power(self):
+        return self.cabinet.max_power[self.id]
+
+    @property
+    def max_current(self):
+        return self.cabinet.max_current[self.id]
+
+    @property
+    def line_resistance(self):
+        return self.cabinet.line_resistance[self.id]
+
+    @property
+    def link_to(self):
+        return self.cabinet.link_to[self.id]
+
+    @link_to.setter
+    def link_to(self, value):
+        self.cabinet.link_to[self.id] = value
+
+    @property
+    def power(self):
+        return self.cabinet.power[self.id]
+
+    @property
+    def output_voltage(self):
+        return self.cabinet.output_voltage[self.id]
+
+    @property
+    def output_current(self):
+        return self.cabinet.output_current[self.id]
+
+    @property
+    def state(self):
+        return IN_USE if self.cabinet.in_use[self.id] else FREE # FREE & IN_USE
+
+    @property
+    def status(self):
+        return STATE_NAMES[self.state]
 
     def output_power(self, current_command, battery_voltage): 
-        #Start charging, input the command current and current battery voltage, and return the output power and current according to the module characteristics.
-        if self.link_to == 0:
-            logger.info("forget to define the module output source")
-            return
-        if current_command > self.max_current:
-            current_command = self.max_current
-        expect_voltage = battery_voltage + current_command * self.line_resistance
-        expect_power = expect_voltage * current_command / 1000.0 # return value in kW
-        if expect_power <= self.max_power:
-            self.output_current = current_command
-            self.power = expect_power
-            self.output_voltage = 1000.0 * self.power / self.output_current # return in Volt
-            self.status = "in_use"
-        else: # expect_power > max_power
-            self.output_current = -1 * battery_voltage + math.sqrt(battery_voltage **2 + 4 * self.line_resistance * self.max_power * 1000)
-            self.output_current = self.output_current / 2 / self.line_resistance
-            self.power = self.max_power  
-            self.output_voltage = 1000.0 * self.power / self.output_current
-            self.status = "in_use"
-        return
-    
-    ################################################################################
-    ################################################################################
+        #Start charging, input the command current and current battery voltage, and calculate the output power and current according to the module characteristics.
+        self.cabinet.output_power([self.id], [0], [current_command], [battery_voltage])
+
     def grid_interactive_output_power(self, current_command, battery_voltage): 
         '''
         calculate the power supply back to the grid according
-        to the grid interaction order and voltage & current
-        +1 positive power output means the bss charge the battery
-        -1 negative power output means the bss discharge battery, send strom back to grid
+        to the grid interaction order and voltage & current (negative power)
         '''
-        # power module should link to the battery in the swap rack
-        if self.link_to <= 0:
-            logger.info("Power module doesn't connect to battery in the rack. link_to = %d" %self.link_to)
-            return
-        # case: current should limited within upper limit
-        if current_command > self.max_current:
-            current_command = self.max_current
-        
-        expect_voltage = battery_voltage + current_command * self.line_resistance
-        expect_power = expect_voltage * current_command / 1000.0            # return value in kW
-        
-        if expect_power <= self.max_power:
-            self.output_current = current_command
-            self.power = -1 * expect_power                                  # negative power output means back to grid
-            self.output_voltage = 1000.0 * abs(self.power) / self.output_current # return in Volt
-            self.status = "in_use"
-        else: # expect_power > max_power
-            self.output_current = -1 * battery_voltage + math.sqrt(battery_voltage **2 + 4 * self.line_resistance * self.max_power * 1000)
-            self.output_current = self.output_current / 2 / self.line_resistance
-            self.power = -1 * self.max_power  
-            self.output_voltage = 1000.0 * abs(self.power) / self.output_current
-            self.status = "in_use"
-        return
+        self.cabinet.output_power([self.id], [0], [current_command], [battery_voltage], discharge = True)
 
     def stop_charge(self): #Stop charging
-        self.power = 0
-        self.output_current=0
-        self.link_to = 0
-        self.output_voltage = 0
-        self.status = "free"
+        self.cabinet.stop_modules([self.id])
 
 ######################################################################
 ####################### Class: Power_Cabinet #########################
@@ -297,36 +310,45 @@ class Power_Cabinet:
     Type - 1 Unmanned: 13 Power Modules with UU40kW
     Type - 2 Unmanned 600kWh: 10 Power Modules with UU60KW
     Type - 2 Unmanned 1200kWh: 20 Power Modules with UU60KW
+    The state of the modules is kept in lists indexed by module id (link_to, max_power, max_current, line_resistance,
+    output_current, output_voltage, power, in_use), so the outputs of all connected modules are set in one call
+    of output_power. module_list holds Power_Module views of the entries. The lists hold 10 - 20 modules, plain
+    Python scalars are faster than NumPy arrays of that size.
     '''
     def __init__(self, station_type, pw_module_info = None):
         self.module_list = []
         self.module_number = 0
+        module = None
 
         # For bss Type - 1
         if station_type == "GEN2_530":
             self.cabinet_type = "GEN2_CAB"
             self.module_number = 13
-            for i in range(self.module_number):
-                self.module_list.append(Power_Module(GC.UU40kW, i)) # module, id
-            self.module_power = self.module_list[0].max_power
-            self.module_current = self.module_list[0].max_current
-        
+            module = GC.UU40kW
 
         # For bss Type - 2 600 kWh, B chargeable module
         if station_type == "GEN3_1200":
             self.cabinet_type = "GEN3_CAB"
             self.module_number = 10  
-            for i in range(self.module_number):
-                self.module_list.append(Power_Module(GC.UU60kW,i))
-            self.module_power = self.module_list[0].max_power
-            self.module_current = self.module_list[0].max_current
-        
+            module = GC.UU60kW
 
         if station_type == "User_Defined":
             self.cabinet_type = "User_Defined"
             self.module_number = pw_module_info["max_charger_number"] 
-            for i in range(int(self.module_number)):
-                self.module_list.append(Power_Module(pw_module_info["power_module_type"],i))
+            module = pw_module_info["power_module_type"]
+
+        n = int(self.module_number)
+        # Module parameters are entered using a dictionary, including maximum power and maximum current.
+        self.max_power = [module["max_power"]] * n if n > 0 else []
+        self.max_current = [module["max_current"]] * n if n > 0 else []
+        self.line_resistance = [0.008] * n                  # 8 mohm
+        self.link_to = [0] * n                              # connected equipment of the modules, see Power_Module
+        self.power = [0] * n
+        self.output_voltage = [0] * n
+        self.output_current = [0] * n
+        self.in_use = [False] * n
+        self.module_list = [Power_Module(self, i) for i in range(n)]
+        if n > 0:
             self.module_power = self.module_list[0].max_power
             self.module_current = self.module_list[0].max_current
 
@@ -338,22 +360,141 @@ class Power_Cabinet:
         if len(config_map) != self.module_number:
             logger.error('config map size not matching module number')
             return
-        for i in range(len(self.module_list)):
-            self.module_list[i].link_to = config_map[i]
-            if self.module_list[i].link_to == 0:
-                self.module_list[i].stop_charge()
+        self.link_to[:] = config_map
+        self.stop_modules([i for i, link in enumerate(self.link_to) if link == 0])
         return
 
+    def stop_modules(self, modules):
+        '''
+        stop the output of the modules (list of indices)
+        '''
+        for i in modules:
+            self.power[i] = 0
+            self.output_current[i] = 0
+            self.output_voltage[i] = 0
+            self.link_to[i] = 0
+            self.in_use[i] = False
+
+    def module_output(self, modules, slot, current_command, battery_voltage, power_limit = None):
+        '''
+        output current and power of the modules for their equipment, as each module would calculate it for itself:
+        the command current is limited to the module current, and if the expected power (including the voltage drop
+        on the line) exceeds the module power, the current is solved for the maximal power
+        modules:            module indices, ascending
+        slot:               equipment index of every module, into current_command, battery_voltage and power_limit
+        current_command:    command current per module of every equipment
+        battery_voltage:    battery voltage of every equipment
+        power_limit:        optional power limit per module of every equipment [kW], below the module power
+        return the lists of current and power, the state of the cabinet is not changed
+        '''
+        currents, powers = [], []
+        line_resistance, module_power, module_current = self.line_resistance, self.max_power, self.max_current
+        for i, k in zip(modules, slot):
+            voltage = battery_voltage[k]
+            resistance = line_resistance[i]
+            max_power = module_power[i]
+            if power_limit is not None and power_limit[k] < max_power:
+                max_power = power_limit[k]
+            current = min(current_command[k], module_current[i])
+            power = (voltage + current * resistance) * current / 1000.0        # return value in kW
+            if power > max_power:
+                current = (-1 * voltage + math.sqrt(voltage ** 2 + 4 * resistance * max_power * 1000)) / 2 / resistance
+                power = max_power
+            currents.append(current)
+            powers.append(power)
+        return currents, powers
+
+    def equipment_power(self, modules, slot, current_command, battery_voltage) -> list:
+        '''
+        power the modules would output for every equipment [kW], arguments as in module_output
+        '''
+        _, powers = self.module_output(modules, slot, current_command, battery_voltage)
+        total = [0.0] * len(battery_voltage)
+        for k, power in zip(slot, powers):
+            total[k] += power
+        return total
+
+    def output_power(self, modules, slot, current_command, battery_voltage, discharge = False, power_limit = None):
+        '''
+        set the outputs of the modules for their equipment (as module_output calculates them) in one call
+        discharge:          power back to the grid (negative power), only modules linked to racks
+        modules without a (suitable) link keep their last output
+        return the summed output current of every equipment, the cabinet power is get_power_pc()
+        '''
+        # the hot path of every tick: module_output inlined, with the lists bound to locals
+        link_to, line_resistance, module_power, module_current = self.link_to, self.line_resistance, self.max_power, self.max_current
+        output_voltage, output_current, module_out, in_use = self.output_voltage, self.output_current, self.power, self.in_use
+        equipment_current = [0.0] * len(battery_voltage)
+        for i, k in zip(modules, slot):
+            link = link_to[i]
+            if link > 0 or (link < 0 and not discharge):
+                voltage = battery_voltage[k]
+                resistance = line_resistance[i]
+                max_power = module_power[i]
+                if power_limit is not None and power_limit[k] < max_power:
+                    max_power = power_limit[k]
+                current = min(current_command[k], module_current[i])
+                power = (voltage + current * resistance) * current / 1000.0        # return value in kW
+                if power > max_power:
+                    current = (-1 * voltage + math.sqrt(voltage ** 2 + 4 * resistance * max_power * 1000)) / 2 / resistance
+                    power = max_power
+                output_voltage[i] = 1000.0 * power / current if current > 0 else 0.0     # return in Volt
+                output_current[i] = current
+                module_out[i] = -1 * power if discharge else power                        # negative power output means back to grid
+                in_use[i] = True
+            else:
+                logger.info("power module without output source: %d", i)
+            equipment_current[k] += output_current[i]
+        return equipment_current
+
     def get_power_pc(self):
         '''
         get total power of current time step, used for data logging
         '''
         total_power = 0
-        for i in range(len(self.module_list)):
-            if self.module_list[i].link_to != 0:
-                total_power += self.module_list[i].power
+        for link, power in zip(self.link_to, self.power):
+            if link != 0:
+                total_power += power
         return total_power
 
+######################################################################
+####################### Power allocation #############################
+######################################################################
+
+def water_fill(demand, budget) -> np.ndarray:
+    '''
+    share budget [kW] over the demands [kW]: every demand gets min(demand, level), with the level that uses up the
+    budget (demands below the level are met in full, the others get the same share), O(M log M)
+    '''
+    demand = np.asarray(demand, dtype=np.float64)
+    if demand.sum() <= budget:
+        return demand.copy()
+    if budget <= 0:
+        return np.zeros(len(demand))
+    d = np.sort(demand)
+    below = np.cumsum(d) - d                                # met in full, the demands below d[i]
+    spent = below + d * np.arange(len(d), 0, -1)            # spent with level d[i]
+    i = int(np.argmax(spent > budget))
+    level = (budget - below[i]) / (len(d) - i)
+    return np.minimum(demand, level)
+
+
+def allocate_power(demand, priority, budget) -> np.ndarray:
+    '''
+    share budget [kW] over the demands [kW] by priority (0 first): the groups are served in priority order,
+    the group that exhausts the budget is water filled, the groups after it get nothing
+    '''
+    demand = np.asarray(demand, dtype=np.float64)
+    if demand.sum() <= budget:
+        return demand.copy()
+    priority = np.asarray(priority)
+    allocation = np.zeros(len(demand))
+    for p in sorted(set(priority.tolist())):
+        group = priority == p
+        allocation[group] = water_fill(demand[group], budget)
+        budget = max(budget - allocation[group].sum(), 0.0)
+    return allocation
+
 ######################################################################
 ####################### Class: Battery_Rack ##########################
 ######################################################################
@@ -362,16 +503,17 @@ class Battery_Rack:
     '''
     Basic parameters and operations related to single-layer battery racks are defined
     '''
-    def __init__(self, id): 
+    def __init__(self, id, swap_rack = None): 
         self.id = id # id number of battery rack (index of list), begins from 0
+        self.swap_rack = swap_rack # owning Swap_Rack, keeps the state codes (rack_states) and the bitmask of the charging racks (charging_mask)
        
-        self.status = "free" 
+        self.state = FREE 
         '''
-        Definition of status
-        free: No battery avaiable
-        loaded: battery stored in the rack
-        charging: battery in charge
-        discharging : battery in discharge back to grid
+        Definition of state
+        FREE: No battery avaiable
+        LOADED: battery stored in the rack
+        CHARGING: battery in charge
+        DISCHARGING : battery in discharge back to grid
         '''
         self.battery = None # save a Battery instance
         self.plug = 0 # 0 - electrical connector disconnected; 1 - electrical connector connected
@@ -381,13 +523,38 @@ class Battery_Rack:
         1: connected
         '''
 
+    def battery_changed(self):
+        '''
+        record the "battery" event on the swap rack, called whenever a battery is put into or taken out of the rack
+        '''
+        if self.swap_rack is not None:
+            self.swap_rack.events.add("battery")
+
+    @property
+    def status(self):
+        return STATE_NAMES[self.state]
+
+    def set_state(self, state):
+        '''
+        change the state, kept in Swap_Rack.rack_states; a change from or to CHARGING flips the bit of the rack in Swap_Rack.charging_mask
+        '''
+        if CHECK_STATES:
+            check_transition("rack", self.state, state, 'battery rack %d' % self.id)
+            if (state == FREE) != (self.battery is None):
+                raise StateError('battery rack %d: state %s with battery %s' % (self.id, STATE_NAMES[state], self.battery))
+        if self.swap_rack is not None:
+            if (state == CHARGING) != (self.state == CHARGING):
+                self.swap_rack.charging_mask ^= 1 << self.id
+            self.swap_rack.rack_states[self.id] = state
+        self.state = state
+
     def plug_in(self):
         '''
         set to "charging"
         '''
         if self.battery is not None: #If you find a battery in the battery holder
             self.plug = 1
-            self.status = "charging" #Update the battery status to accept charging. The only place where you can set the charging on status to charging is
+            self.set_state(CHARGING) #Update the battery status to accept charging. The only place where you can set the charging on status to charging is
 
     ################################################################################
     ################################################################################
@@ -397,18 +564,18 @@ class Battery_Rack:
         '''
         if self.battery is not None:
             self.plug = 1
-            self.status = "discharging"
+            self.set_state(DISCHARGING)
 
     def plug_out(self):
         '''
         charging -> loaded
         else -> free
         '''
-        if self.status == "charging" or self.status == "discharging": #If you unplug the plug while waiting for charging, exit the charging state
+        if self.state == CHARGING or self.state == DISCHARGING: #If you unplug the plug while waiting for charging, exit the charging state
             if self.battery is not None: #If there is a battery, set the battery rack status to Loaded
-                self.status = "loaded"
+                self.set_state(LOADED)
             else:
-                self.status = "free" #Otherwise set the battery rack status to Idle
+                self.set_state(FREE) #Otherwise set the battery rack status to Idle
         self.plug = 0
 
     def start_charge(self):
@@ -429,7 +596,7 @@ class Battery_Rack:
 
     def stop_charge(self):
         if self.battery is not None: #If there are batteries in the battery holder
-            self.status = "loaded"
+            self.set_state(LOADED)
         self.plug_out()
     
     def load_battery(self, battery : Battery):# If a battery is successfully loaded, the battery rack ID is returned. Otherwise, -1 is returned, indicating that there is a battery.
@@ -437,19 +604,21 @@ class Battery_Rack:
             return -1 #Returns -1 to indicate failure
         else:
             self.battery = battery
-            self.status = "loaded"
+            self.set_state(LOADED)
             self.plug_out
+            self.battery_changed()
             return self.id
 
     def remove_battery(self): # If a battery is successfully removed, the battery rack ID is returned, otherwise -1 is returned, indicating that it was originally empty.
         if self.battery is not None: #If there are batteries in the battery holder
             self.stop_charge()
             self.battery = None
-            self.status = "free"
+            self.set_state(FREE)
+            self.battery_changed()
             return self.id
         else:
             self.plug_out()
-            self.status = "free" 
+            self.set_state(FREE) 
             return -1
 
 ######################################################################
@@ -457,20 +626,38 @@ class Battery_Rack:
 ######################################################################
 
 class Charge_Pile:
-    def __init__(self, max_current, pile_id): #The charging gun head only defines the maximum charging current max current = 650
+    def __init__(self, max_current, pile_id, swap_rack = None): #The charging gun head only defines the maximum charging current max current = 650
         '''
-        Definition of status for piles
-        free: No vehicle connected
-        connected: vehicle connected but not charged
-        charging: vehicle is in charging
+        Definition of state for piles
+        FREE: No vehicle connected
+        CONNECTED: vehicle connected but not charged
+        CHARGING: vehicle is in charging
+        swap_rack: owning Swap_Rack, its pile_states and free_piles bitmask follow the pile
         '''
-        self.status = "free" #free & connected & charging
+        self.state = FREE #FREE & CONNECTED & CHARGING
         self.vehicle_battery = None # Car battery connected to charging station
         self.max_current = max_current 
         self.output_power = 0
         self.output_current = 0
         self.id = pile_id 
+        self.swap_rack = swap_rack
         return
+
+    @property
+    def status(self):
+        return STATE_NAMES[self.state]
+
+    def set_state(self, state):
+        '''
+        change the state, kept in Swap_Rack.pile_states
+        '''
+        if CHECK_STATES:
+            check_transition("pile", self.state, state, 'charge pile %d' % self.id)
+            if (state == FREE) != (self.vehicle_battery is None):
+                raise StateError('charge pile %d: state %s with vehicle battery %s' % (self.id, STATE_NAMES[state], self.vehicle_battery))
+        if self.swap_rack is not None:
+            self.swap_rack.pile_states[self.id] = state
+        self.state = state
          
     def connect_to_vehicle(self, vehicle_battery : Battery):
         '''
@@ -483,8 +670,11 @@ class Charge_Pile:
             logger.info('pile %d : already has vehicle connected',self.id)
             return -1 #Failed to connect vehicle battery
         else:
-            self.status = "connected"
             self.vehicle_battery = vehicle_battery
+            self.set_state(CONNECTED)
+            if self.swap_rack is not None:
+                self.swap_rack.free_piles &= ~(1 << self.id)
+                self.swap_rack.events.add("vehicle")
             return self.id
     
     def vehicle_leave(self): #Vehicle leaves the charging pile
@@ -492,26 +682,29 @@ class Charge_Pile:
             logger.info('pile does not have vehicle connected, pile status = %s, pile# %d',self.status,self.id)
             return -1
         self.stop_charge()
-        self.status = "free"
         self.vehicle_battery = None
+        self.set_state(FREE)
+        if self.swap_rack is not None:
+            self.swap_rack.free_piles |= 1 << self.id
+            self.swap_rack.events.add("vehicle")
         return self.id
     
     def stop_charge(self): #Charging terminal stops charging
         if self.vehicle_battery is None: #If no battery is connected to the charging terminal
             # logger.debug('temp to stop charge when there is no vehicle connected, pile status = %s, pile# %d',self.status,self.id)
-            self.status = "free"
+            self.set_state(FREE)
             return
         else:
-            self.status = "connected"
+            self.set_state(CONNECTED)
             return
 
     def start_charge(self): #Charging terminal starts charging
         if self.vehicle_battery is None: #If no battery is connected to the charging terminal
             # logger.debug('temp to start charge when there is no vehicle connected, pile status = %s',self.status)
-            self.status = "free"
+            self.set_state(FREE)
             return -1
         else:
-            self.status = "charging"
+            self.set_state(CHARGING)
             return
 
 ######################################################################
@@ -535,14 +728,22 @@ class Swap_Rack:
         self.select_soc = param["select_soc"]       # For bss upper limit
         self.set_sr_temperature()                   # The default temperature inside and outside the warehouse is 25 degrees
         self.charge_power_redist_trigger = param["charge_power_redist"] # bool
-        self.power_dist_option = param["power_dist_option"] # "bss prefered" or "bsc prefered"
+        self.power_dist_option = param["power_dist_option"] # name of the PowerStrategy, e.g. "BSS preferred"
+        self.racks_first = power_strategy(self.power_dist_option).racks_first   # connect_charge_pile: modules of the racks are not taken by piles
+        self.events = set()                         # EVENTS since the last power distribution
+        self.distributed_by = None                  # name of the strategy of the current connection_map, None after grid interaction
+        self.ready_racks = []                       # racks whose battery reached select_soc in do_charge, collected by SwapStation
+        self.rack_states = bytearray()              # state code of every battery rack (kept up to date by Battery_Rack.set_state)
+        self.pile_states = bytearray()              # state code of every charge pile (kept up to date by Charge_Pile.set_state)
+        self.charging_mask = 0                      # bit i set: battery rack i is CHARGING (kept up to date by Battery_Rack.set_state)
+        self.free_piles = 0                         # bit i set: charge pile i has no vehicle (kept up to date by Charge_Pile)
 
         # For bss Type - 1
         if station_type == "GEN2_530":
             self.power_cabinet = Power_Cabinet(station_type)
             self.max_rack_number = 13
             for i in range(self.max_rack_number):
-                self.battery_rack_list.append(Battery_Rack(i)) 
+                self.battery_rack_list.append(Battery_Rack(i, self)) 
             self.max_pile_number = 0
             self.charge_pile_list = None
             self.connection_map = [0,0,0,0,0,0,0,0,0,0,0,0,0]
@@ -574,7 +775,7 @@ class Swap_Rack:
             self.power_cabinet = None
             self.max_rack_number = 10
             for i in range(self.max_rack_number):
-                self.battery_rack_list.append(Battery_Rack(i))
+                self.battery_rack_list.append(Battery_Rack(i, self))
             self.max_pile_number = 0
             self.charge_pile_list = None
             self.connection_map = []
@@ -584,10 +785,10 @@ class Swap_Rack:
             self.power_cabinet = Power_Cabinet(station_type)
             self.max_rack_number = 10
             for i in range(self.max_rack_number):
-                self.battery_rack_list.append(Battery_Rack(i)) # i -> id
+                self.battery_rack_list.append(Battery_Rack(i, self)) # i -> id
             self.max_pile_number = int(self.psc_num)
             for i in range(self.max_pile_number):
-                self.charge_pile_list.append(Charge_Pile(650, i)) # i -> id
+                self.charge_pile_list.append(Charge_Pile(650, i, self)) # i -> id
             self.connection_map = [0,0,0,0,0,0,0,0,0,0]
 
 
@@ -598,13 +799,75 @@ class Swap_Rack:
             self.power_cabinet = Power_Cabinet(station_type, pw_module_info=param["station_type"])
             self.max_rack_number = int(param["station_type"]["max_charger_number"])
             for i in range(self.max_rack_number):
-                self.battery_rack_list.append(Battery_Rack(i)) # i -> id
+                self.battery_rack_list.append(Battery_Rack(i, self)) # i -> id
             self.max_pile_number = int(self.psc_num)
             for i in range(self.max_pile_number):
-                self.charge_pile_list.append(Charge_Pile(650, i)) # i -> id
+                self.charge_pile_list.append(Charge_Pile(650, i, self)) # i -> id
             cm = np.zeros(int(param["station_type"]["max_charger_number"]))
             self.connection_map = list([int(s) for s in cm])
 
+        self.index_pairs()
+        self.index_piles()
+
+    def index_piles(self):
+        '''
+        set up pile_states and the free_piles bitmask, also used to re-index a restored swap rack
+        '''
+        self.free_piles = 0
+        self.pile_states = bytearray(charge_pile.state for charge_pile in self.charge_pile_list or [])
+        for charge_pile in self.charge_pile_list or []:
+            charge_pile.swap_rack = self
+            if charge_pile.vehicle_battery is None:
+                self.free_piles |= 1 << charge_pile.id
+
+    def first_free_pile(self) -> int:
+        '''
+        index of the first charge pile without vehicle, -1 if there is none
+        '''
+        free = self.free_piles
+        return (free & -free).bit_length() - 1
+
+    def index_pairs(self):
+        '''
+        set up rack_states and the bitmasks used to find charging and free rack pairs, also used to re-index a restored swap rack
+        '''
+        self.even_mask = sum(1 << i for i in range(0, len(self.battery_rack_list), 2))
+        self.charging_mask = 0
+        self.rack_states = bytearray(battery_rack.state for battery_rack in self.battery_rack_list)
+        for battery_rack in self.battery_rack_list:
+            battery_rack.swap_rack = self
+            if battery_rack.state == CHARGING:
+                self.charging_mask |= 1 << battery_rack.id
+
+    def check_states(self):
+        '''
+        debug mode (CHECK_STATES): raise StateError if a rack or pile has a state that does not fit its battery,
+        or if rack_states and pile_states differ from the states of the racks and piles
+        '''
+        for battery_rack in self.battery_rack_list:
+            if (battery_rack.state == FREE) != (battery_rack.battery is None) or self.rack_states[battery_rack.id] != battery_rack.state:
+                raise StateError('swap rack %d, battery rack %d: state %s, array %s, battery %s' % (self.id, battery_rack.id,
+                    battery_rack.status, STATE_NAMES[self.rack_states[battery_rack.id]], battery_rack.battery))
+        for charge_pile in self.charge_pile_list or []:
+            if (charge_pile.state == FREE) != (charge_pile.vehicle_battery is None) or self.pile_states[charge_pile.id] != charge_pile.state:
+                raise StateError('swap rack %d, charge pile %d: state %s, array %s, vehicle battery %s' % (self.id, charge_pile.id,
+                    charge_pile.status, STATE_NAMES[self.pile_states[charge_pile.id]], charge_pile.vehicle_battery))
+
+    def full_pairs(self) -> int:
+        '''
+        bitmask of the even racks i where racks i and i + 1 are both charging
+        '''
+        mask = self.charging_mask
+        return mask & (mask >> 1) & self.even_mask
+
+    def first_free_pair(self) -> int:
+        '''
+        first even rack j where neither rack j nor rack j + 1 (if any) is charging, -1 if there is none
+        '''
+        mask = self.charging_mask
+        free = ~(mask | (mask >> 1)) & self.even_mask
+        return (free & -free).bit_length() - 1
+
 
     def set_temperature(self, real_temp):
         '''
@@ -646,13 +909,13 @@ class Swap_Rack:
         '''
         if battery is not None: #If the battery is present
             if position == -1:  #For parameters of -1, automatically find the first free position to import the battery.
-                for battery_rack in self.battery_rack_list:
-                    if battery_rack.status == "free":
-                        self.battery_num += 1
-                        return(battery_rack.load_battery(battery)) # return battery rack id or -1
+                position = self.rack_states.find(FREE)
+                if position >= 0:
+                    self.battery_num += 1
+                    return(self.battery_rack_list[position].load_battery(battery)) # return battery rack id or -1
             else:
                 if position < len(self.battery_rack_list) and position >= 0:
-                    if self.battery_rack_list[position].status == "free":
+                    if self.battery_rack_list[position].state == FREE:
                         self.battery_num += 1
                         return(self.battery_rack_list[position].load_battery(battery))
         return -1 # return failed
@@ -669,7 +932,7 @@ class Swap_Rack:
             return
         
         else:
-            if self.battery_rack_list[position].status != "free":
+            if self.battery_rack_list[position].state != FREE:
                 self.battery_rack_list[position].remove_battery()
                 self.battery_num -= 1
                 return
@@ -821,7 +1084,7 @@ class Swap_Rack:
         module_num = module_num - self.connection_map.count(-1 * pile.id  - 1) # pile id: 0 -> N; pile id in connection map: -N-1 -> -1
         
         # strategy 1: bss prefered
-        if self.power_dist_option == "BSS preferred":
+        if self.racks_first:
             for i in range(len(self.connection_map)):
                 # if current module is free and battery still allow to connect with another module
                 if self.connection_map[i] == 0 and module_num > 0:
@@ -919,9 +1182,9 @@ class Swap_Rack:
                 swap_power_req.append(-1)
         # save the pile(vehicle battery) power command
         charge_power_req = []
-        for charge_pile in self.charge_pile_list:
+        for charge_pile in self.charge_pile_list or []:
             if charge_pile.vehicle_battery is not None:
-                charge_pile.vehicle_battery.Request_Power(current_limit=charge_pile.max_current)
+                charge_pile.vehicle_battery.request_power(current_limit=charge_pile.max_current)
                 if charge_pile.vehicle_battery.soc < charge_pile.vehicle_battery.target_max_soc:
                     charge_power_req.append(charge_pile.vehicle_battery.power_command)
                 else:
@@ -966,7 +1229,7 @@ class Swap_Rack:
         # ======================================================================================
 
         #If there is already a charging module connected to the external charging pile, one module will be allocated first.
-        for j in range(len(self.charge_pile_list)): #Check the charging pile load that is currently charging
+        for j in range(len(self.charge_pile_list or [])): #Check the charging pile load that is currently charging
             r_b = self.charge_pile_list[j].vehicle_battery
             m_n = self.module_number_check(r_b, current_limit = self.charge_pile_list[j].max_current)
             pid = -1 * j - 1 # charge piles index in connection_map:  -1 -> -N - 1
@@ -976,7 +1239,7 @@ class Swap_Rack:
                         self.connection_map[i] = pid #Connect the charging module to the target charging pile
         
         #If the charging module is still free, connect it to an external charging device
-        for j in range(len(self.charge_pile_list)):
+        for j in range(len(self.charge_pile_list or [])):
             r_b = self.charge_pile_list[j].vehicle_battery
             m_n = self.module_number_check(r_b, current_limit = self.charge_pile_list[j].max_current)
             pid = -1 * j - 1
@@ -1066,7 +1329,7 @@ class Swap_Rack:
                  Press under the following conditions:
                  1. The charging pile is not connected to the vehicle battery - release the charging module, charging pile vehicle_leave
                  2. The vehicle battery SOC has reached the set value target_max_soc - release the charging module and stop_charge the charging pile
-                 3. The vehicle stops charging pile.status = "connected" - Release the charging module and the charging pile stops_charge
+                 3. The vehicle stops charging pile.state = CONNECTED - Release the charging module and the charging pile stops_charge
                 '''
                 if self.charge_pile_list is not None:
                     # recalculate the charge pile id
@@ -1074,7 +1337,7 @@ class Swap_Rack:
 
                     if isinstance(self.charge_pile_list[pile_id].vehicle_battery, Battery): #If the corresponding battery is present
                         # for case 2 and 3
-                        if self.charge_pile_list[pile_id].vehicle_battery.soc >= self.target_soc or self.charge_pile_list[pile_id].status == "connected":
+                        if self.charge_pile_list[pile_id].vehicle_battery.soc >= self.target_soc or self.charge_pile_list[pile_id].state == CONNECTED:
                             self.connection_map[i] = 0
                             self.charge_pile_list[pile_id].stop_charge()    
                     else:
@@ -1136,12 +1399,12 @@ class Swap_Rack:
                     if pile.vehicle_battery.soc >= self.target_soc: #If it has been charged to the specified SOC, the vehicle leaves
                     # if pile.vehicle_battery.soc >= pile.vehicle_battery.target_max_soc: #If it is full, the vehicle leaves
                         self.vehicle_leave(pile.id)
-                    if pile.status == "charging": #If it is still charging, optimize the charging power
+                    if pile.state == CHARGING: #If it is still charging, optimize the charging power
                         self.connect_charge_pile(pile) #There is a question of priority here. Not yet resolved
             #Allocate charging modules to external charging piles based on remaining power
             for pile in self.charge_pile_list:
                 if pile.vehicle_battery is not None: #If a battery is connected to the charging terminal
-                    if pile.status == "connected" and self.connection_map.count(-1 * pile.id - 1) == 0: #Not charging and no modules are assigned
+                    if pile.state == CONNECTED and self.connection_map.count(-1 * pile.id - 1) == 0: #Not charging and no modules are assigned
                         self.connect_charge_pile(pile) #Connect the charging terminal to the module through connect_map
         # ======================================================================================
         # ================= Part 3: Restart the power distribution and charging ================
@@ -1195,7 +1458,7 @@ class Swap_Rack:
 
                     if isinstance(self.charge_pile_list[pile_id].vehicle_battery, Battery): 
                         # for case 2 and 3
-                        if self.charge_pile_list[pile_id].vehicle_battery.soc >= self.target_soc or self.charge_pile_list[pile_id].status == "connected":
+                        if self.charge_pile_list[pile_id].vehicle_battery.soc >= self.target_soc or self.charge_pile_list[pile_id].state == CONNECTED:
                             self.connection_map[i] = 0
                             self.charge_pile_list[pile_id].stop_charge()    
                     else:
@@ -1228,9 +1491,9 @@ class Swap_Rack:
                 if isinstance(pile.vehicle_battery, Battery):
                     if pile.vehicle_battery.soc >= self.target_soc:                                     
                         self.vehicle_leave(pile.id)                                                     
-                    if pile.status == "charging":                                                      
+                    if pile.state == CHARGING:                                                      
                         self.connect_charge_pile(pile)                                                  
-                    if pile.status == "connected" and self.connection_map.count(-1 * pile.id - 1) == 0: 
+                    if pile.state == CONNECTED and self.connection_map.count(-1 * pile.id - 1) == 0: 
                         self.connect_charge_pile(pile)                                                      
 
         
@@ -1316,7 +1579,7 @@ class Swap_Rack:
                  Press under the following conditions:
                  1. The charging pile is not connected to the vehicle battery - release the charging module, charging pile vehicle_leave
                  2. The vehicle battery SOC has reached the set value target_soc - release the charging module and stop_charge the charging pile
-                 3. The vehicle stops charging pile.status = "connected" - Release the charging module and the charging pile stops_charge
+                 3. The vehicle stops charging pile.state = CONNECTED - Release the charging module and the charging pile stops_charge
                 '''
                 if self.charge_pile_list is not None:
                     # recalculate the charge pile id
@@ -1325,7 +1588,7 @@ class Swap_Rack:
                     if isinstance(self.charge_pile_list[pile_id].vehicle_battery, Battery):  # If the corresponding battery is present
                         # for case 2 and 3
                         if self.charge_pile_list[pile_id].vehicle_battery.soc >= self.target_soc or self.charge_pile_list[
-                            pile_id].status == "connected":
+                            pile_id].state == CONNECTED:
                             self.connection_map[i] = 0
                             self.charge_pile_list[pile_id].stop_charge()
                     else:
@@ -1358,9 +1621,9 @@ class Swap_Rack:
                 if isinstance(pile.vehicle_battery, Battery):
                     if pile.vehicle_battery.soc >= self.target_soc:  
                         self.vehicle_leave(pile.id)  
-                    if pile.status == "charging":  
+                    if pile.state == CHARGING:  
                         self.connect_charge_pile(pile)  
-                    if pile.status == "connected" and self.connection_map.count(-1 * pile.id - 1) == 0:  
+                    if pile.state == CONNECTED and self.connection_map.count(-1 * pile.id - 1) == 0:  
                         self.connect_charge_pile(pile)  
 
         # Allocate redundant charging modules according to the power requirements of the battery swap station.
@@ -1413,6 +1676,7 @@ class Swap_Rack:
             if(self.station_type != "GEN3_600"):
                 logger.debug('no power cabinet connected')
             return
+        self.distributed_by = None
         # process 2: rearrange the connection map
         for i in range(len(self.connection_map)):
             if self.battery_rack_list[i].battery is not None:       # the batteries may not full loaded
@@ -1426,81 +1690,334 @@ class Swap_Rack:
                 self.start_discharge(equipment_id - 1)
         return
 
-    def do_charge(self, t_timer:int, interval = 1):
+    def _connected_equipment(self, racks_only = False):
+        '''
+        modules with a connection in connection_map (racks_only: to a battery rack), the equipment ids
+        in order of their first module, the equipment index (into the ids) of every module and the module number of
+        every equipment, kept until connection_map changes (most ticks keep the connections of the tick before)
+        '''
+        key = (tuple(self.connection_map), racks_only)
+        cached = getattr(self, "_connected", None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        modules, ids, slot, module_num, index = [], [], [], [], {}
+        for j, equipment_id in enumerate(self.connection_map):
+            if equipment_id > 0 or (equipment_id < 0 and not racks_only):
+                if equipment_id not in index:
+                    index[equipment_id] = len(ids)
+                    ids.append(equipment_id)
+                    module_num.append(0)
+                modules.append(j)
+                slot.append(index[equipment_id])
+                module_num[index[equipment_id]] += 1
+        self._connected = (key, (modules, ids, slot, module_num))
+        return modules, ids, slot, module_num
+
+    def charge_plan(self, discharge = False):
+        '''
+        request the power of the connected equipment (discharge: only the batteries in the racks), the command current
+        of an equipment is shared by its modules
+        return modules, equipment ids, equipment index of every module, command current per module and battery voltage
+        of every equipment, and the batteries
+        '''
+        modules, ids, slot, module_num = self._connected_equipment(racks_only = discharge)
+        command = [0.0] * len(ids)
+        voltage = [0.0] * len(ids)
+        batteries = []
+        for k, equipment_id in enumerate(ids):
+            battery = None
+            # for battery in BSS
+            if 0 < equipment_id <= len(self.battery_rack_list):
+                battery = self.battery_rack_list[equipment_id - 1].battery
+                battery.request_power(250)
+            # for battery on charge piles
+            elif equipment_id < 0:
+                pile = self.charge_pile_list[equipment_id * -1 - 1]
+                battery = pile.vehicle_battery
+                battery.request_power(pile.max_current)
+            if battery is not None:
+                command[k] = battery.current_command / module_num[k]
+                voltage[k] = battery.battery_voltage
+            batteries.append(battery)
+        return modules, ids, slot, command, voltage, batteries
+
+    def do_charge(self, t_timer:int, interval = 1, plan = None, power_limit = None):
         '''
         excute the charging beheviours
+        the outputs of all connected modules are computed in one call of the power cabinet
+        plan:           charge_plan() if it is already requested
+        power_limit:    power limit per module of every equipment [kW] (SwapStation power cap), None for no limit
         '''
-        charge_complete=[]
-        for i in range(len(self.connection_map)):
-            equipment_id = self.connection_map[i]
-            if charge_complete.count(equipment_id) == 0: # current equipment not counted in charge complet list
-                charger_array=[]
-                for j in range(len(self.connection_map)):
-                    if equipment_id == self.connection_map[j]:
-                        charger_array.append(j) # append connecting module index
-
-                # for battery in BSS
-                if equipment_id > 0:
-                    rack_id = equipment_id - 1
-                    charge_battery = self.battery_rack_list[rack_id].battery
-                    module_num = len(charger_array)
-                    charge_battery.request_power(250)
-                    charger_current = charge_battery.current_command / module_num
-                    total_current = 0
-                    for t in charger_array:
-                        self.power_cabinet.module_list[t].output_power(charger_current, charge_battery.battery_voltage)
-                        total_current += self.power_cabinet.module_list[t].output_current
-                    charge_battery.battery_charge(total_current, t_timer, interval)
-                    charge_complete.append(equipment_id)
-
-                # for battery on charge piles
-                if equipment_id < 0:
-                    pile_id = equipment_id * -1 - 1
-                    charge_battery = self.charge_pile_list[pile_id].vehicle_battery
-                    module_num = len(charger_array)
-                    charge_battery.request_power(self.charge_pile_list[pile_id].max_current)
-                    charger_current = charge_battery.current_command / module_num
-                    total_current = 0
-                    for t in charger_array:
-                        self.power_cabinet.module_list[t].output_power(charger_current,charge_battery.battery_voltage)
-                        total_current = total_current + self.power_cabinet.module_list[t].output_current
-                    charge_battery.battery_charge(total_current,t_timer,interval)
-                    charge_complete.append(equipment_id)
+        if self.power_cabinet is None:
+            return
+        modules, ids, slot, command, voltage, batteries = plan if plan is not None else self.charge_plan()
+        total_current = self.power_cabinet.output_power(modules, slot, command, voltage, power_limit = power_limit)
+        for k, charge_battery in enumerate(batteries):
+            if ids[k] > 0:
+                was_ready = charge_battery.soc >= self.select_soc
+                charge_battery.battery_charge(total_current[k], t_timer, interval)
+                if not was_ready and charge_battery.soc >= self.select_soc:
+                    self.ready_racks.append(ids[k] - 1)
+                    self.events.add("ready")
+            else:
+                charge_battery.battery_charge(total_current[k], t_timer, interval)
+                if charge_battery.soc >= self.target_soc:
+                    self.events.add("charged")
     
     ################################################################################
 
-    def do_grid_discharge(self, t_timer:int, interval = 1):
+    def do_grid_discharge(self, t_timer:int, interval = 1, plan = None, power_limit = None):
         '''
         discharge the batteries from swap rack, send power back to grid
+        plan, power_limit: as in do_charge, plan = charge_plan(discharge = True)
         '''
-        discharge_complete=[]
-        for i in range(len(self.connection_map)):
-            equipment_id = self.connection_map[i]
-            if discharge_complete.count(equipment_id) == 0:        # current equipment not counted in charge complet list
-                discharger_array=[]
-                for j in range(len(self.connection_map)):
-                    if equipment_id == self.connection_map[j]:
-                        discharger_array.append(j)                 # append connecting module index
-        
-                if equipment_id > 0:
-                    rack_id = equipment_id - 1
-                    if rack_id < len(self.battery_rack_list):
-                        discharge_battery = self.battery_rack_list[rack_id].battery
-                    module_num = len(discharger_array)
-                    discharge_battery.request_power(250)
-                    charger_current = discharge_battery.current_command / module_num
-                    total_current = 0
-                    for t in discharger_array:
-                        self.power_cabinet.module_list[t].grid_interactive_output_power(charger_current, discharge_battery.battery_voltage)
-                        total_current += self.power_cabinet.module_list[t].output_current
-                    discharge_battery.battery_discharge(total_current, t_timer, interval)                      
-                    discharge_complete.append(equipment_id)
+        if self.power_cabinet is None:
+            return
+        modules, ids, slot, command, voltage, batteries = plan if plan is not None else self.charge_plan(discharge = True)
+        total_current = self.power_cabinet.output_power(modules, slot, command, voltage, discharge = True, power_limit = power_limit)
+        for k, discharge_battery in enumerate(batteries):
+            if discharge_battery is not None:
+                discharge_battery.battery_discharge(total_current[k], t_timer, interval)
+
+    def distribute(self, strategy):
+        '''
+        run the power distribution strategy if one of the events it is invalidated by happened since the last
+        distribution, or the connection_map is not its own
+        '''
+        if self.distributed_by != strategy.name or "tick" in strategy.invalidated_by or not self.events.isdisjoint(strategy.invalidated_by):
+            self.racks_first = strategy.racks_first
+            strategy.distribute(self)
+            self.distributed_by = strategy.name
+        self.events.clear()
 
     def get_power_sr(self):
         if self.power_cabinet is None:
             return 0
         return self.power_cabinet.get_power_pc()
 
+######################################################################
+################### Power distribution strategies ####################
+######################################################################
+# A power distribution strategy sets the connection_map of a swap rack (which power module charges which battery
+# or charge pile) and starts the charging. Strategies are registered by name, param["power_dist_option"] selects one.
+# A strategy lists the EVENTS that invalidate its connection_map, Swap_Rack.distribute only runs it again after one
+# of them ("tick": every tick). The distributions of the built-in strategies depend on the SOC of the batteries
+# (current limits), so they run on every tick.
+
+EVENTS = ("tick",           # every simulation tick
+          "battery",        # a battery was put into or taken out of a rack
+          "ready",          # a battery in a rack reached select_soc
+          "vehicle",        # a vehicle was connected to or left a charge pile
+          "charged")        # a vehicle battery reached target_soc
+
+POWER_STRATEGIES = {}
+
+
+class PowerStrategy:
+    '''
+    interface of the power distribution strategies
+    name:           key in POWER_STRATEGIES, the value of param["power_dist_option"]
+    invalidated_by: EVENTS after which distribute() has to run again
+    racks_first:    the batteries in the racks are served before the charge piles (connect_charge_pile, power caps)
+    '''
+    name = None
+    invalidated_by = ("tick",)
+    racks_first = True
+
+    def distribute(self, swap_rack):
+        '''
+        set swap_rack.connection_map, configure the power cabinet and start the charging
+        '''
+        raise NotImplementedError
+
+
+def register_strategy(strategy_class):
+    '''
+    class decorator, register an instance of a PowerStrategy class under its name
+    '''
+    POWER_STRATEGIES[strategy_class.name] = strategy_class()
+    return strategy_class
+
+
+def power_strategy(name) -> PowerStrategy:
+    '''
+    the registered strategy of a name
+    '''
+    if name not in POWER_STRATEGIES:
+        raise ValueError('unknown power distribution strategy %s' % name)
+    return POWER_STRATEGIES[name]
+
+
+@register_strategy
+class BSSPreferred(PowerStrategy):
+    '''
+    batteries in the racks first, free modules go to the charge piles (Swap_Rack.power_distribution_pss_preferred)
+    '''
+    name = "BSS preferred"
+
+    def distribute(self, swap_rack):
+        swap_rack.power_distribution_pss_preferred()
+
+
+@register_strategy
+class BSCPreferred(PowerStrategy):
+    '''
+    charge piles first, they may take the modules of the rack batteries with the lowest SOC (Swap_Rack.power_distribution_psc_preferred)
+    '''
+    name = "BSC preferred"
+    racks_first = False
+
+    def distribute(self, swap_rack):
+        swap_rack.power_distribution_psc_preferred()
+
+
+@register_strategy
+class SmartAdvicer(PowerStrategy):
+    '''
+    Swap_Rack.power_distribution_smart_advicer
+    '''
+    name = "Smart advicer"
+    racks_first = False
+
+    def distribute(self, swap_rack):
+        swap_rack.power_distribution_smart_advicer()
+
+
+@register_strategy
+class MaxPower(PowerStrategy):
+    '''
+    every requesting battery gets its module and its neighbour, remaining modules go to the charge piles
+    (Swap_Rack.power_distribution_max)
+    '''
+    name = "Max power"
+
+    def distribute(self, swap_rack):
+        swap_rack.power_distribution_max()
+
+
+@register_strategy
+class BSSPreferredOnEvents(BSSPreferred):
+    '''
+    "BSS preferred", but the connection_map is only rebuilt after a battery or vehicle event, not on every tick:
+    cheaper, the modules of a battery are not adapted to its falling current limit in between
+    '''
+    name = "BSS preferred (events)"
+    invalidated_by = ("battery", "ready", "vehicle", "charged")
+
+######################################################################
+####################### Class: SwapLane ##############################
+######################################################################
+
+class SwapLane:
+    '''
+    One swap platform of a station. The lanes of a station swap at the same time with their own timers,
+    they share the batteries in the racks (a rack selected by one lane is not offered to the others).
+    '''
+    def __init__(self, id):
+        self.id = id
+        self.state = FREE                   # FREE = no swap, IN_USE = swapping
+        self.swap_timer = 0                 # ticks of the running swap
+        self.buff_rack = None               # rack of the battery the vehicle gets
+        self.vehicle_battery = None         # battery taken out of the vehicle
+
+    @property
+    def status(self):
+        return STATE_NAMES[self.state]
+
+    def set_state(self, state):
+        if CHECK_STATES:
+            check_transition("lane", self.state, state, 'swap lane %d' % self.id)
+        self.state = state
+
+
+######################################################################
+####################### Class: ReadyIndex ############################
+######################################################################
+
+class ReadyIndex:
+    '''
+    Swap-ready batteries (soc >= threshold) of a station, one heap per battery type, so a waiting swap user
+    does not scan all racks on every tick. Heap entries are (key, sequence, swap rack index, rack index, battery).
+    Entries are checked lazily when they reach the top of their heap: an entry is dropped if its battery has left
+    the rack or fell below the threshold (grid interaction discharge), and pushed again with a fresh key if the
+    key is out of date. The station adds an entry whenever a battery reaches the threshold or is put into a rack.
+    policy:
+        "first":            first rack in station order, as the linear scan of select_battery_rack
+        "highest_soc":      battery with the highest SOC
+        "oldest_ready":     battery that reached the threshold first
+    '''
+    POLICIES = ("first", "highest_soc", "oldest_ready")
+
+    def __init__(self, threshold, policy = "first"):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown battery selection policy %s' % policy)
+        self.threshold = threshold
+        self.policy = policy
+        self.heaps = {}                     # battery type -> heap
+        self.ready_since = {}               # battery -> sequence number when it became ready
+        self.sequence = 0
+
+    def _key(self, swap_rack_index, rack_index, battery):
+        if self.policy == "first":
+            return (swap_rack_index, rack_index)
+        if self.policy == "highest_soc":
+            return -battery.soc
+        return self.ready_since[battery]
+
+    def add(self, swap_rack_index, rack_index, battery):
+        '''
+        register the battery in rack rack_index of swap rack swap_rack_index, ignored below the threshold
+        '''
+        if battery is None or battery.soc < self.threshold:
+            return
+        self.sequence += 1
+        self.ready_since.setdefault(battery, self.sequence)
+        heap = self.heaps.setdefault(battery.batterytype, [])
+        heapq.heappush(heap, (self._key(swap_rack_index, rack_index, battery), self.sequence, swap_rack_index, rack_index, battery))
+
+    def discard(self, battery):
+        '''
+        battery left the station, its heap entries are dropped when they reach the top
+        '''
+        self.ready_since.pop(battery, None)
+
+    def _top(self, heap, swap_rack_list, exclude, held):
+        while heap:
+            key, _, i, j, battery = heap[0]
+            if swap_rack_list[i].battery_rack_list[j] in exclude:
+                held.append(heapq.heappop(heap))
+                continue
+            if swap_rack_list[i].battery_rack_list[j].battery is not battery or battery.soc < self.threshold:
+                heapq.heappop(heap)
+                if battery.soc < self.threshold:
+                    self.ready_since.pop(battery, None)
+                continue
+            if key != self._key(i, j, battery):
+                heapq.heappop(heap)
+                self.add(i, j, battery)
+                continue
+            return heap[0]
+        return None
+
+    def select(self, swap_rack_list, batterytype = None, exclude = ()):
+        '''
+        best ready rack (by policy) of all types or of batterytype only, None if there is none
+        exclude: racks not to offer (selected by other swap lanes), their entries stay in the index
+        '''
+        heaps = self.heaps.values() if batterytype is None else [self.heaps.get(batterytype, [])]
+        best = None
+        for heap in heaps:
+            held = []
+            top = self._top(heap, swap_rack_list, exclude, held)
+            for entry in held:
+                heapq.heappush(heap, entry)
+            if top is not None and (best is None or top[:2] < best[:2]):
+                best = top
+        if best is None:
+            return None
+        return swap_rack_list[best[2]].battery_rack_list[best[3]]
+
+
 ######################################################################
 ####################### Class: SwapStation ###########################
 ######################################################################
@@ -1532,28 +2049,20 @@ class SwapStation:
         self.station_type = self.pss_type_dict["station_type"]                          # type of BSS (string)
         self.psc_num = param["psc_num"]                                                 # num of bsc connected with BSS
         self.power = 0                                                                  # save the real time power cosumption 
-        self.status = "free"                                                            # 换电平台状态，free = 没有换电操作，in_use = 换电中，switch = 电池执行仓位交换中
+        self.state = FREE                                                               # 换电平台状态，FREE = 没有换电操作，IN_USE = 换电中，SWITCH = 电池执行仓位交换中
+        self.lanes = [SwapLane(k) for k in range(int(param.get("swap_lanes", 1)))]     # swap platforms working in parallel, state IN_USE if one of them swaps
         self.full_battery = 0                                                           # 满电电池数量
-        self.swap_timer = 0                                                             # 用来为换电过程计时。这个乘以sim仿真周期就是换电进行多少时间
         self.residual_power = self.max_power - self.power                               # calculate the residual power
         self.swap_rack_list = []                                                        # empty list save for battery swap rack objects
-        self.buff_rack = None
         self.battery_num = 0                                                            # !!! battery_num has calculation error !!!!
         self.enable_me_switch = param["enable_me_switch"]
         self.power_history = []                                                         # 记录充电功率的历史，记录在power_history队列中，记录结构为[timer, power]
         self.target_soc = param["target_soc"]                                           # for the bsc charge pile target soc
         self.select_soc = param["select_soc"]                                           # for the BSS battery charge target upper limit, will be select to swap when reaches this soc
         self.power_dist_option = param["power_dist_option"]                             # trigger of bsc or BSS power priority
-        if param["grid_interaction_idx"] != -1:                                         # define the grid interaction start time stamp (if idx != -1)
-            self.grid_interaction_timeStamp = int(param["grid_interaction_idx"] * 3600 / param["sim_interval"])
-            self.grid_interaction_counter = 0                                           # define the how many times the grid interaction will perform
-            self.grid_interaction_time_upper_limit = int((param["grid_interaction_idx"] + 1) * 3600 / param["sim_interval"]) # define the upper limit of grid interaction time interval
-        else:
-            self.grid_interaction_timeStamp = None
-            self.grid_interaction_counter = 1
-            self.grid_interaction_time_upper_limit = None
+        self.power_strategy = power_strategy(self.power_dist_option)                    # PowerStrategy registered under this name
+        self.set_grid_interaction(param)
         self.trigger = []                                                               # trigger for grid interaction, once time for discharge, this will be 1 otherwise 0, same length as sim_ticks
-        self.interaction_num = param["interaction_num"]                                 # number of interaction will be performed
         
         # Set up the station variations
         if self.station_type == "GEN2_530":
@@ -1582,6 +2091,71 @@ class SwapStation:
             self.module_power = self.pss_type_dict["power_module_type"]["max_power"]
 
         self.set_temperature(rack_temperature = param["swap_rack_temperature"], env_temperature = param["swap_rack_temperature"]) #Default temperature 25 degrees
+        self.set_battery_selection(param)
+        self.set_power_cap(param)
+
+    def set_power_cap(self, param):
+        '''
+        set up the power caps enforced on every tick from param["power_cap"] (station limit [kW], True for max_power,
+        None: no limit) and param["cabinet_power_cap"] (limit per power cabinet [kW], None: no limit).
+        0 and False mean no limit for both caps, as in batch_engine.UNSUPPORTED.
+        Also used to re-configure a restored station.
+        '''
+        power_cap = param.get("power_cap")
+        self.power_cap = self.max_power if power_cap is True else (power_cap or None)
+        cabinet_power_cap = param.get("cabinet_power_cap")
+        if cabinet_power_cap is True:
+            raise ValueError('cabinet_power_cap needs a power in kW, got True')
+        self.cabinet_power_cap = cabinet_power_cap or None
+        for name, cap in (("power_cap", self.power_cap), ("cabinet_power_cap", self.cabinet_power_cap)):
+            if cap is not None and cap < 0:
+                raise ValueError('negative %s %s' % (name, cap))
+
+    def set_grid_interaction(self, param):
+        '''
+        set up the grid interaction service from param["grid_interaction_idx"] and param["interaction_num"].
+        Also used to re-configure a restored station, which is only valid before the grid interaction interval starts.
+        '''
+        if param["grid_interaction_idx"] != -1:                                         # define the grid interaction start time stamp (if idx != -1)
+            self.grid_interaction_timeStamp = int(param["grid_interaction_idx"] * 3600 / param["sim_interval"])
+            self.grid_interaction_counter = 0                                           # define the how many times the grid interaction will perform
+            self.grid_interaction_time_upper_limit = int((param["grid_interaction_idx"] + 1) * 3600 / param["sim_interval"]) # define the upper limit of grid interaction time interval
+        else:
+            self.grid_interaction_timeStamp = None
+            self.grid_interaction_counter = 1
+            self.grid_interaction_time_upper_limit = None
+        self.interaction_num = param["interaction_num"]                                 # number of interaction will be performed
+
+    def set_battery_selection(self, param):
+        '''
+        set up the selection of the battery for a swap from param["battery_selection"] (a ReadyIndex policy, default "first")
+        and param["battery_match_type"] (only batteries of the vehicle battery type), rebuild the index of ready batteries.
+        Also used to re-index a restored station.
+        '''
+        self.battery_selection = param.get("battery_selection", "first")
+        self.battery_match_type = bool(param.get("battery_match_type", False))
+        self.rebuild_ready_index()
+
+    def rebuild_ready_index(self):
+        '''
+        index all batteries in the racks at or above select_soc
+        '''
+        self.ready_index = ReadyIndex(self.select_soc, self.battery_selection)
+        for i, swap_rack in enumerate(self.swap_rack_list):
+            swap_rack.ready_racks = []
+            for j, battery_rack in enumerate(swap_rack.battery_rack_list):
+                self.ready_index.add(i, j, battery_rack.battery)
+
+    def add_ready_rack(self, rack : Battery_Rack):
+        '''
+        index the battery of a rack after it was put there, if it is ready
+        '''
+        if rack.battery is None or rack.battery.soc < self.ready_index.threshold:
+            return
+        for i, swap_rack in enumerate(self.swap_rack_list):
+            if rack in swap_rack.battery_rack_list:
+                self.ready_index.add(i, swap_rack.battery_rack_list.index(rack), rack.battery)
+                return
 
     def set_temperature(self, rack_temperature = 25, env_temperature = 25):
         '''
@@ -1610,6 +2184,7 @@ class SwapStation:
                 tmp = swap_rack.load_battery(battery)  
                 if tmp >= 0:
                     logger.debug("Battery Loaded into SWAP_RACK # %d, Battery Rack # %d",swap_rack.id, tmp)
+                    self.ready_index.add(swap_rack.id, tmp, battery)
                     break
             if tmp == -1:
                 print("No space to load battery")
@@ -1630,6 +2205,8 @@ class SwapStation:
         if rack_id > self.swap_rack_list[swap_rack_id].max_rack_number - 1:
             return -1
         re = self.swap_rack_list[swap_rack_id].load_battery(battery, rack_id)
+        if re >= 0:
+            self.ready_index.add(swap_rack_id, re, battery)
         self.cal_battery_num()
         return(re)
 
@@ -1681,51 +2258,61 @@ class SwapStation:
         temp_battery = self.swap_rack_list[source_swap_rack].battery_rack_list[source_rack].battery
         self.swap_rack_list[source_swap_rack].battery_rack_list[source_rack].battery = self.swap_rack_list[target_swap_rack].battery_rack_list[target_rack].battery
         self.swap_rack_list[target_swap_rack].battery_rack_list[target_rack].battery = temp_battery
+        self.swap_rack_list[source_swap_rack].battery_rack_list[source_rack].battery_changed()
+        self.swap_rack_list[target_swap_rack].battery_rack_list[target_rack].battery_changed()
         
         # self.swap_rack_list[source_swap_rack].battery_rack_list[source_rack].start_charge()
         # self.swap_rack_list[target_swap_rack].battery_rack_list[target_rack].start_charge()
         self.swap_rack_list[source_swap_rack].start_charge(source_rack)
         self.swap_rack_list[target_swap_rack].start_charge(target_rack)
-        self.status = "switch"
+        self.ready_index.add(source_swap_rack, source_rack, self.swap_rack_list[source_swap_rack].battery_rack_list[source_rack].battery)
+        self.ready_index.add(target_swap_rack, target_rack, self.swap_rack_list[target_swap_rack].battery_rack_list[target_rack].battery)
+        self.set_state(SWITCH)
         self.switch_timer = 0
         return
 
     def select_battery_rack(self, vehicle_battery : Battery, swap_target_soc):
         '''
         Automatically select battery rules:
-             1. The battery type needs to be consistent vehicle_battery.batterytype -> This restriction is temporarily lifted
+             1. The battery type needs to be consistent vehicle_battery.batterytype -> only with battery_match_type
              2. The battery in the site reaches soc > swap_target_soc
-             3. Optimize selection according to the charging and idle status of the warehouse
+             3. Among those the battery_selection policy of ReadyIndex decides, by default the first rack
          Return value: None or corresponding rack object
         '''
         if not isinstance(vehicle_battery, Battery):
             return
+        batterytype = vehicle_battery.batterytype if self.battery_match_type else None
+        reserved = [lane.buff_rack for lane in self.lanes if lane.state == IN_USE]
+        if swap_target_soc == self.ready_index.threshold:
+            return self.ready_index.select(self.swap_rack_list, batterytype, reserved)
+        # other target than select_soc: scan the racks in station order
         for swap_rack in self.swap_rack_list:
             for rack in swap_rack.battery_rack_list:
-                if isinstance(rack.battery, Battery):
-                    if rack.battery.soc >= swap_target_soc:
-                    # if (rack.battery.batterytype == vehicle_battery.batterytype) and (rack.battery.soc >= swap_target_soc):
+                if isinstance(rack.battery, Battery) and rack not in reserved:
+                    if rack.battery.soc >= swap_target_soc and (batterytype is None or rack.battery.batterytype == batterytype):
                         return rack
 
-    def start_swap(self, vehicle_battery : Battery, swap_targetsoc) -> bool:
+    def start_swap(self, vehicle_battery : Battery, swap_targetsoc, lane = 0) -> bool:
         '''
-        start swapping behaviour, detect whether suitable battery exists
+        start swapping behaviour on swap lane "lane", detect whether suitable battery exists
         Return value: True or False
         '''
-        if self.status != "free":
+        swap_lane = self.lanes[lane]
+        if self.state == SWITCH or swap_lane.state != FREE:
             return False
         
         if isinstance(vehicle_battery, Battery): #If it is a legal battery
-            self.buff_rack = self.select_battery_rack(vehicle_battery, swap_targetsoc)
-            self.vehicle_battery = vehicle_battery
-            if not isinstance(self.buff_rack, Battery_Rack):
+            swap_lane.buff_rack = self.select_battery_rack(vehicle_battery, swap_targetsoc)
+            swap_lane.vehicle_battery = vehicle_battery
+            if not isinstance(swap_lane.buff_rack, Battery_Rack):
                 # logger.debug('can not find proper battery')
                 return False
             # logger.debug("start swap timer start --- ")
 
             # init the swap timer, switch the status to "in use"
-            self.swap_timer = 0
-            self.status = "in_use"
+            swap_lane.swap_timer = 0
+            swap_lane.set_state(IN_USE)
+            self.set_state(IN_USE)
             return True
         else:
             logger.error("illegel battery")
@@ -1733,22 +2320,25 @@ class SwapStation:
     
     ################################################################################
     ################################################################################
-    def do_swap(self, current_user, t_timer, interval=1):
+    def do_swap(self, current_users : list, t_timer, interval=1) -> list:
         '''
         swapping process
         grid interaction trigger will be calculated in form of list, when the counter
         not reaches max interaction num nor extend the time interval, it will be activated
         when the swap user utilizes the BSS, otherwise will this trigger == 0, we use trigger
         to detect whether we perform the grid interaction or not
+        current_users: user served on every swap lane (or None)
         
-        return value: True or False
+        return value: list with True for every lane that completed its swap in this tick
         
         '''
+        completed = [False] * len(self.lanes)
+
         # case: Battery rack in switch operation
-        if self.status == "switch":
+        if self.state == SWITCH:
             self.switch_timer += 1
             if self.switch_timer * interval >= 30:
-                self.status = "free"
+                self.set_state(FREE)
         
         # case: detect whether the time extend the grid interaction interval, if so the counter = max performed number
         if self.grid_interaction_timeStamp != None and self.grid_interaction_time_upper_limit != None:
@@ -1756,7 +2346,7 @@ class SwapStation:
                 self.grid_interaction_counter = self.interaction_num
         
         # case: swap platform in use status
-        if self.status == "in_use":
+        if self.state == IN_USE:
 
             # establish the grid interaction trigger
             if self.grid_interaction_timeStamp != None:                         # condition1: the grid interaction activated
@@ -1770,38 +2360,45 @@ class SwapStation:
             else:
                 self.trigger.append(0)
             
-            # swap time iteration
-            self.swap_timer += 1
-
-            if self.swap_timer * interval >= self.swap_period: #换电完成时的动作，交换车上和电池仓里的电池
-                # load the vehicle battery, give the stored battery away, start charging new loaded battery
-                self.buff_rack.stop_charge()
-                temp_battery = self.vehicle_battery
-                self.vehicle_battery = self.buff_rack.battery # give buff_rack battery to user
-                self.buff_rack.battery = temp_battery         # load vehicle battery into buff_rack
-                self.buff_rack.start_charge()
-                if current_user is not None:
-                    current_user.battery = self.vehicle_battery
-                
-                # init the swap setup
-                self.vehicle_battery = None                     #Clear vehicle battery cache
-                # total_time = self.swap_timer * interval
-                self.swap_timer = 0                             #Clear the battery replacement timer
-                self.status = "free"                            #Set the battery swap station status to idle
-                # after first swap user (that after certain time stamp comes) finished service, counter up tp 1
-                # if counter > 0 then the grid service deactivated.
-                if self.grid_interaction_timeStamp != None:
-                    if t_timer >= self.grid_interaction_timeStamp:
-                        if self.grid_interaction_counter < self.interaction_num:
-                            self.grid_interaction_counter += 1
-                        else:
-                            self.grid_interaction_counter = self.interaction_num
-                
-                return True
+            for k, lane in enumerate(self.lanes):
+                if lane.state != IN_USE:
+                    continue
+                # swap time iteration
+                lane.swap_timer += 1
+
+                if lane.swap_timer * interval >= self.swap_period: #换电完成时的动作，交换车上和电池仓里的电池
+                    # load the vehicle battery, give the stored battery away, start charging new loaded battery
+                    lane.buff_rack.stop_charge()
+                    temp_battery = lane.vehicle_battery
+                    lane.vehicle_battery = lane.buff_rack.battery # give buff_rack battery to user
+                    lane.buff_rack.battery = temp_battery         # load vehicle battery into buff_rack
+                    lane.buff_rack.battery_changed()
+                    lane.buff_rack.start_charge()
+                    self.ready_index.discard(lane.vehicle_battery)
+                    self.add_ready_rack(lane.buff_rack)
+                    if current_users[k] is not None:
+                        current_users[k].battery = lane.vehicle_battery
+                    
+                    # init the swap setup
+                    lane.vehicle_battery = None                     #Clear vehicle battery cache
+                    lane.swap_timer = 0                             #Clear the battery replacement timer
+                    lane.set_state(FREE)                            #Set the swap lane status to idle
+                    # after first swap user (that after certain time stamp comes) finished service, counter up tp 1
+                    # if counter > 0 then the grid service deactivated.
+                    if self.grid_interaction_timeStamp != None:
+                        if t_timer >= self.grid_interaction_timeStamp:
+                            if self.grid_interaction_counter < self.interaction_num:
+                                self.grid_interaction_counter += 1
+                            else:
+                                self.grid_interaction_counter = self.interaction_num
+                    completed[k] = True
+
+            if all(lane.state == FREE for lane in self.lanes):
+                self.set_state(FREE)                            #Set the battery swap station status to idle
         
         else: #When there is no battery replacement, adjust the battery position in the battery compartment.
             self.trigger.append(0)
-            if self.status != "switch":
+            if self.state != SWITCH:
                 if (self.enable_me_switch > 0):
                     self.switch_in_rack()
                     if len(self.swap_rack_list) > 1 and self.enable_me_switch > 1:
@@ -1809,21 +2406,23 @@ class SwapStation:
                         # logger.error('Swap between different swap racks -- Have not implemented')
                         pass
         
-        return False
+        return completed
     
     ###################################################################################
     ###################################################################################
     def do_charge(self, timer, interval=1):
+        if self.power_cap is not None or self.cabinet_power_cap is not None:
+            self.do_capped_charge(timer, interval)
+            return
         self.power = 0
-        for swap_rack in self.swap_rack_list:
-
-            if self.power_dist_option == "BSS preferred":        
-                swap_rack.power_distribution_pss_preferred()
-            else:
-                swap_rack.power_distribution_psc_preferred()  
-             
+        for i, swap_rack in enumerate(self.swap_rack_list):
+            swap_rack.distribute(self.power_strategy)
             swap_rack.do_charge(timer, interval)
             self.power += swap_rack.get_power_sr()
+            if swap_rack.ready_racks:
+                for j in swap_rack.ready_racks:
+                    self.ready_index.add(i, j, swap_rack.battery_rack_list[j].battery)
+                swap_rack.ready_racks = []
         self.power_history.append([timer, self.power])
     
     ###################################################################################
@@ -1832,12 +2431,66 @@ class SwapStation:
         '''
         perform the grid interaction discharge behaviours while a swap service is executing.
         '''
+        if self.power_cap is not None or self.cabinet_power_cap is not None:
+            self.do_capped_charge(timer, interval, discharge = True)
+            return
         self.power = 0
         for swap_rack in self.swap_rack_list:
             swap_rack.power_distribution_grid_interaction()
             swap_rack.do_grid_discharge(timer, interval)
             self.power += swap_rack.get_power_sr()
         self.power_history.append([timer, self.power])
+
+    def do_capped_charge(self, timer, interval = 1, discharge = False):
+        '''
+        charge (discharge: grid interaction discharge) under the power caps. The distribution strategies connect the
+        modules as usual, then the requested power of all equipment is shared by allocate_power: within a cabinet
+        under cabinet_power_cap, then over the station under power_cap, the preferred side of the power strategy
+        first. The modules of an equipment that gets less than it requested are limited to its share.
+        '''
+        racks, plans, requested, demands, priorities = [], [], [], [], []
+        for swap_rack in self.swap_rack_list:
+            if discharge:
+                swap_rack.power_distribution_grid_interaction()
+            else:
+                swap_rack.distribute(self.power_strategy)
+            if swap_rack.power_cabinet is None:
+                continue
+            plan = swap_rack.charge_plan(discharge)
+            modules, ids, slot, command, voltage, _ = plan
+            demand = swap_rack.power_cabinet.equipment_power(modules, slot, command, voltage)
+            is_rack = np.array(ids) > 0
+            priority = np.where(is_rack, 0, 1) if self.power_strategy.racks_first else np.where(is_rack, 1, 0)
+            racks.append(swap_rack)
+            plans.append(plan)
+            requested.append(demand)
+            if self.cabinet_power_cap is not None:
+                demand = allocate_power(demand, priority, self.cabinet_power_cap)
+            demands.append(demand)
+            priorities.append(priority)
+
+        if len(racks) > 0:
+            demand = np.concatenate(demands)
+            budget = self.power_cap if self.power_cap is not None else float("inf")
+            allocation = np.split(allocate_power(demand, np.concatenate(priorities), budget), np.cumsum([len(d) for d in demands])[:-1])
+
+        self.power = 0
+        for k, swap_rack in enumerate(racks):
+            modules, ids, slot = plans[k][:3]
+            module_num = np.bincount(slot, minlength=len(ids))
+            limited = allocation[k] < requested[k]
+            power_limit = np.where(limited, allocation[k] / np.maximum(module_num, 1), np.inf) if limited.any() else None
+            if discharge:
+                swap_rack.do_grid_discharge(timer, interval, plans[k], power_limit)
+            else:
+                swap_rack.do_charge(timer, interval, plans[k], power_limit)
+            self.power += swap_rack.get_power_sr()
+            if swap_rack.ready_racks:
+                i = self.swap_rack_list.index(swap_rack)
+                for j in swap_rack.ready_racks:
+                    self.ready_index.add(i, j, swap_rack.battery_rack_list[j].battery)
+                swap_rack.ready_racks = []
+        self.power_history.append([timer, self.power])
     
     ###################################################################################
     ###################################################################################
@@ -1848,10 +2501,8 @@ class SwapStation:
             if swap_rack.power_cabinet is not None:
                 # logger.debug(swap_rack.power_cabinet)
                 swap_rack.start_charge_all()
-                if self.power_dist_option == "BSS preferred":        
-                    swap_rack.power_distribution_pss_preferred()
-                else:
-                    swap_rack.power_distribution_psc_preferred()    
+                swap_rack.distributed_by = None
+                swap_rack.distribute(self.power_strategy)
 
     def vehicle_charge(self, vb : Battery, pile_id = -1):
         # pile id = -1 indicates automatically connecting to an idle charging pile,
@@ -1861,15 +2512,43 @@ class SwapStation:
             logger.info('No pile defined in this type of swap station')
             return -1
         if pile_id == -1:
+            # first free pile of the first swap rack that has one, from the free pile bitmasks
             for sr in self.swap_rack_list:
-                if sr.max_pile_number > 0:
-                    for j in range(len(sr.charge_pile_list)):
-                        if sr.connect_vehicle(vb, j) == j:
-                            # logger.info('battery connected to pile number %d',j)
-                            return j
+                if sr.free_piles:
+                    return sr.connect_vehicle(vb, sr.first_free_pile())
         
             return -1
 
+    @property
+    def status(self):
+        return STATE_NAMES[self.state]
+
+    def set_state(self, state):
+        '''
+        change the state of the swap platform
+        '''
+        if CHECK_STATES:
+            check_transition("platform", self.state, state, 'swap platform')
+        self.state = state
+
+    def check_states(self):
+        '''
+        debug mode (CHECK_STATES): check the racks and piles of all swap racks (Swap_Rack.check_states) and the swap lanes
+        '''
+        for sr in self.swap_rack_list:
+            sr.check_states()
+        for lane in self.lanes:
+            if lane.state == IN_USE and not isinstance(lane.buff_rack, Battery_Rack):
+                raise StateError('swap lane %d: state %s without battery rack' % (lane.id, lane.status))
+        if self.state == IN_USE and all(lane.state == FREE for lane in self.lanes):
+            raise StateError('swap platform in use without swap lane in use')
+
+    def free_pile_count(self) -> int:
+        '''
+        number of charge piles without vehicle
+        '''
+        return sum(sr.free_piles.bit_count() for sr in self.swap_rack_list)
+
           
     def vehicle_stop_charge(self, vehicle_battery : Battery):
         if self.max_charge_terminal == 0:
@@ -1881,31 +2560,26 @@ class SwapStation:
                 for j in range(len(sr.charge_pile_list)):
                     connected_battery = sr.charge_pile_list[j].vehicle_battery
                     if connected_battery == vehicle_battery:
-                        sr.charge_pile_list[j].vehicle_leave()
+                        sr.vehicle_leave(j)
                         return j
         return -1
 
     def switch_in_rack(self):
         '''
         rearrange the position of battery in the BSS according to the power distribution
+        Every even rack i whose pair is charging gets the battery of the first pair that is not charging at all.
+        A switch only changes pair i and the target pair, so the charging pairs found at the start are visited
+        in rack order as by a scan of the racks.
         '''
-        for sr in self.swap_rack_list:                      # Traverse all battery compartments (bss Type - 2 has two battery compartments, each with 10 battery bays)
+        for s, sr in enumerate(self.swap_rack_list):        # Traverse all battery compartments (bss Type - 2 has two battery compartments, each with 10 battery bays)
             if sr.power_cabinet is not None:                # If the battery compartment is equipped with charging capabilities
-                rack_n = len(sr.battery_rack_list)
-                for i in range(rack_n):
-                    if (i % 2) == 0:                        # at even number index of batteries
-                        if sr.battery_rack_list[i].status == "charging": # battery status
-                            if i + 1 < rack_n:
-                                if sr.battery_rack_list[i + 1].status == "charging":
-                                    for j in range(rack_n):
-                                        if (j % 2) == 0 and j < rack_n - 1:
-                                            if sr.battery_rack_list[j].status != "charging" and sr.battery_rack_list[j + 1].status != "charging":
-                                                self.switch_battery(self.swap_rack_list.index(sr), i, self.swap_rack_list.index(sr), j)
-                                                break
-                                        if (j % 2) == 0 and j == rack_n - 1:
-                                            if sr.battery_rack_list[j].status != "charging":
-                                                self.switch_battery(self.swap_rack_list.index(sr), i, self.swap_rack_list.index(sr), j)
-                                                break
+                full = sr.full_pairs()
+                while full:
+                    i = (full & -full).bit_length() - 1     # lowest even rack of a charging pair
+                    full &= full - 1
+                    j = sr.first_free_pair()
+                    if j >= 0:
+                        self.switch_battery(s, i, s, j)
 
     def switch_two_racks(self):
         '''
@@ -1935,29 +2609,24 @@ class SwapStation:
                         if sr_c.battery_rack_list[j].battery is None:
                             sr_c.battery_rack_list[j].battery = sr_b.battery_rack_list[i].battery
                             sr_b.battery_rack_list[i].battery = None              
+                            sr_c.battery_rack_list[j].battery_changed()
+                            sr_b.battery_rack_list[i].battery_changed()
+                            self.ready_index.add(0, j, sr_c.battery_rack_list[j].battery)
                             break
         
         # Case 3: 1200kW station
         if self.station_type == "GEN3_1200":
-            rack_n = len(self.swap_rack_list[0].battery_rack_list)
-            for sr in self.swap_rack_list: #Traverse all battery compartments
-                for i in range(rack_n):
-                    if (i % 2) == 0: # even number of rack
-                        if sr.battery_rack_list[i].status == "charging":
-                            if i + 1 < rack_n:
-                                if sr.battery_rack_list[i+1].status == "charging":
-                                    find_flag = 0
-                                    for sr_t in self.swap_rack_list:
-                                        for j in range(rack_n):
-                                            if (j % 2) == 0 and j < rack_n - 1:
-                                                if sr_t.battery_rack_list[j].status != "charging" and sr_t.battery_rack_list[j+1].status != "charging":
-                                                    self.switch_battery(self.swap_rack_list.index(sr), i, self.swap_rack_list.index(sr_t), j)
-                                                    find_flag = 1
-                                                    break
-                                            if (j % 2) == 0 and j == rack_n - 1:
-                                                if sr_t.battery_rack_list[j].status != "charging":
-                                                    self.switch_battery(self.swap_rack_list.index(sr), i, self.swap_rack_list.index(sr_t), j)
-                                                    find_flag = 1
-                                                    break   
-                                    if find_flag == 1:
-                                        break 
+            for s, sr in enumerate(self.swap_rack_list): #Traverse all battery compartments
+                full = sr.full_pairs()
+                while full:
+                    i = (full & -full).bit_length() - 1 # even rack of a charging pair
+                    full &= full - 1
+                    # the battery goes to the first free pair of every swap rack in turn, a charging pair with a move ends the swap rack
+                    find_flag = 0
+                    for t, sr_t in enumerate(self.swap_rack_list):
+                        j = sr_t.first_free_pair()
+                        if j >= 0:
+                            self.switch_battery(s, i, t, j)
+                            find_flag = 1
+                    if find_flag == 1:
+                        break 
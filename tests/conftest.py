@@ -0,0 +1,15 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+
+import pytest
+
+# the modules are imported from the repository root, and users.py reads its data files relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+import global_param as GC
+import main
+import swap
+
+# Tests of the debug mode of the state codes (swap.CHECK_STATES, environment variable BSS_CHECK_STATES): illegal
+# changes of state raise swap.StateError while the mode is on, and a simulation run passes all checks.
+
+
+def run_param(**kw):
+    '''
+    parameters of a GEN3_1200kW run of one day
+    '''
+    station_type = dict(GC.GEN3_1200kW)
+    param = dict(station_type=station_type, psc_num=station_type["max_charge_terminal"],
+                 battery_config={"100kWh": station_type["max_battery_number"] - 4, "75kWh": 4},
+                 init_battery_soc_in_BSS=0.6, target_soc=0.9, select_soc=0.9, BS_user_num=120, non_BS_user_num=20,
+                 sim_days=1, sim_interval=10, sim_ticks=8640, swap_rack_temperature=25, user_sequence_mode="random",
+                 user_area=None, user_preference="markov", charge_power_redist=False, enable_me_switch=1,
+                 power_dist_option="BSS preferred", service_ratio=-1, grid_interaction_idx=-1, interaction_num=0,
+                 swap_time=4.5, opening_hours="24 hours", seed=1)
+    param.update(kw)
+    return param
+
+
+class CheckStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(swap, "CHECK_STATES", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rack_charging_without_battery(self):
+        rack = swap.Battery_Rack(0)
+        with self.assertRaises(swap.StateError):
+            rack.set_state(swap.CHARGING)
+        self.assertEqual(rack.state, swap.FREE)
+
+    def test_rack_loses_battery_while_loaded(self):
+        rack = swap.Battery_Rack(0)
+        rack.load_battery(swap.Battery(soc=0.5, batterytype="100kWh"))
+        rack.battery = None
+        with self.assertRaises(swap.StateError):
+            rack.set_state(swap.CHARGING)
+        self.assertEqual(rack.state, swap.LOADED)
+
+    def test_rack_free_with_battery(self):
+        rack = swap.Battery_Rack(0)
+        rack.load_battery(swap.Battery(soc=0.5, batterytype="100kWh"))
+        with self.assertRaises(swap.StateError):
+            rack.set_state(swap.FREE)
+
+    def test_rack_charge_cycle(self):
+        rack = swap.Battery_Rack(0)
+        rack.load_battery(swap.Battery(soc=0.5, batterytype="100kWh"))
+        rack.start_charge()
+        self.assertEqual(rack.state, swap.CHARGING)
+        rack.stop_charge()
+        self.assertEqual(rack.state, swap.LOADED)
+        rack.remove_battery()
+        self.assertEqual(rack.state, swap.FREE)
+
+    def test_pile_charging_without_vehicle(self):
+        pile = swap.Charge_Pile(650, 0)
+        with self.assertRaises(swap.StateError):
+            pile.set_state(swap.CHARGING)
+        self.assertEqual(pile.state, swap.FREE)
+
+    def test_lane_and_platform(self):
+        lane = swap.SwapLane(0)
+        with self.assertRaises(swap.StateError):
+            lane.set_state(swap.SWITCH)
+        station = swap.SwapStation(run_param())
+        station.set_state(swap.IN_USE)
+        with self.assertRaises(swap.StateError):
+            station.set_state(swap.SWITCH)
+
+    def test_swap_rack_arrays(self):
+        station = swap.SwapStation(run_param())
+        sr = station.swap_rack_list[0]
+        sr.check_states()
+        sr.battery_rack_list[0].battery = swap.Battery(soc=0.5, batterytype="100kWh")
+        with self.assertRaises(swap.StateError):
+            sr.check_states()
+
+    def test_simulation_passes_the_checks(self):
+        main.do_simulation(run_param())
+
+    def test_checks_off(self):
+        with mock.patch.object(swap, "CHECK_STATES", False):
+            rack = swap.Battery_Rack(0)
+            rack.set_state(swap.CHARGING)
+        self.assertEqual(rack.state, swap.CHARGING)
+
+    def test_environment_switch(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for value, expected in (("1", "True"), ("0", "False")):
+            out = subprocess.run([sys.executable, "-c", "import swap; print(swap.CHECK_STATES)"], cwd=root,
+                                 env=dict(os.environ, BSS_CHECK_STATES=value), capture_output=True, text=True, check=True)
+            self.assertEqual(out.stdout.strip(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
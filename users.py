@@ -1,21 +1,145 @@
 # -*- coding: UTF-8 -*-
 
 import logging
+import math
 import random
 import string
 import time
+from operator import itemgetter
 import numpy as np
-import pandas as pd
+from statistics import NormalDist
 import swap
 from swap import Battery
-import global_param
+import global_param as GC
 
-# set up the global param
-GC = global_param.Global_Constant()
 # set up logger
 logger = logging.getLogger('main.users')
 data_logger = logging.getLogger('data.users')
 
+# Sampling of the user draws (arrival slots and times, battery types, initial SOC, preferences):
+#   0   the original generators
+#   +1  every draw from one uniform u, the initial SOC by inverse transform of u, discrete draws
+#       (get_number_by_pro) with the most probable values first
+#   -1  as +1 with the antithetic uniform 1 - u
+# Two runs with the same seed and +1 / -1 form an antithetic pair (see replication.py)
+_sampling = 0
+
+
+def set_sampling(mode = 0):
+    global _sampling
+    _sampling = mode
+
+
+def _uniform():
+    u = random.random()
+    return 1.0 - u if _sampling < 0 else u
+
+
+# Markov preference of the BS users (User.markov_preference): one step of the chain MARKOV_TRANSITION from
+# MARKOV_PRIOR, weighted with the diagonal observation matrix of the band of the arrival. There are only 8 bands
+# (temperature outside 5 - 26 degrees, SOC below 0.4, more than 12 users waiting), so the posteriors are computed
+# once and a preference is one uniform draw against the cumulative probabilities of the band.
+MARKOV_STATES = ("swap", "charge", "leave")
+MARKOV_PRIOR = np.array([0.7, 0.25, 0.05], dtype=np.float64)
+MARKOV_TRANSITION = np.array([[0.8, 0.1, 0.1],
+                              [0.1, 0.1, 0.8],
+                              [0.0, 0.0, 1.0]], dtype=np.float64)
+# diagonal of the observation matrix per band, band = 4 * (temperature outside 5 - 26) + 2 * (soc < 0.4) + (queue > 12)
+MARKOV_OBSERVATION = ((0.5, 0.4, 0.1), (0.6, 0.3, 0.1), (0.9, 0.1, 0.0), (0.6, 0.2, 0.2),
+                      (0.7, 0.2, 0.1), (0.3, 0.3, 0.4), (0.8, 0.1, 0.1), (0.7, 0.1, 0.2))
+
+
+def markov_band(temp, soc, queue_length) -> int:
+    '''
+    index of the (temperature, SOC, queue length) band in MARKOV_OBSERVATION
+    '''
+    return 4 * (temp < 5 or temp > 26) + 2 * (soc < 0.4) + (queue_length > 12)
+
+
+def _markov_posterior(observation):
+    x = np.diag(np.array(observation, dtype=np.float64)).dot(MARKOV_TRANSITION.dot(MARKOV_PRIOR))    # one step forward procedure
+    return x / sum(x)
+
+
+# posterior probabilities of swap, charge and leave per band, and the rounded ones the preference is drawn from
+MARKOV_POSTERIOR = np.array([_markov_posterior(o) for o in MARKOV_OBSERVATION])
+MARKOV_PROBABILITIES = tuple(tuple(float(round(s, 2)) for s in x) for x in MARKOV_POSTERIOR)
+
+
+def _markov_draws(most_probable_first) -> tuple:
+    '''
+    (cumulative probabilities, states in the order of the draw) per band, the order of get_number_by_pro
+    '''
+    draws = []
+    for probabilities in MARKOV_PROBABILITIES:
+        order = sorted(range(3), key=lambda k: -probabilities[k]) if most_probable_first else list(range(3))
+        total = 0.0
+        cumulative = []
+        for k in order:
+            total += probabilities[k]
+            cumulative.append(total)
+        draws.append((tuple(cumulative), tuple(order)))
+    return tuple(draws)
+
+
+# draws by sampling mode: [0] the original order, [1] most probable first (set_sampling +1 / -1)
+_MARKOV_DRAWS = (_markov_draws(False), _markov_draws(True))
+_MARKOV_ARRAYS = tuple((np.array([c for c, _ in draws]), np.array([o for _, o in draws])) for draws in _MARKOV_DRAWS)
+
+
+def markov_draw(band, u) -> int:
+    '''
+    index in MARKOV_STATES drawn with the uniform u for an arrival in band, as get_number_by_pro (swap if u is not
+    below the sum of the rounded probabilities)
+    '''
+    cumulative, order = _MARKOV_DRAWS[_sampling != 0][band]
+    for c, k in zip(cumulative, order):
+        if u < c:
+            return k
+    return 0
+
+
+def markov_preferences(temp, soc, queue_length, u = None, sampling = None) -> np.ndarray:
+    '''
+    vectorized markov preference of a batch of arrivals: temperature, battery SOC and queue length at the arrival
+    (arrays or scalars), u the uniforms of the draws (default: one draw of np.random for the whole batch),
+    sampling the mode of set_sampling (default: the current one)
+    return the index in MARKOV_STATES of every arrival
+    '''
+    temp, soc, queue_length = np.broadcast_arrays(np.asarray(temp, dtype=np.float64), np.asarray(soc, dtype=np.float64),
+                                                  np.asarray(queue_length))
+    band = 4 * ((temp < 5) | (temp > 26)) + 2 * (soc < 0.4) + (queue_length > 12)
+    sampling = _sampling if sampling is None else sampling
+    if u is None:
+        u = np.random.random(band.shape)
+        if sampling < 0:
+            u = 1.0 - u
+    cumulative, order = _MARKOV_ARRAYS[sampling != 0]
+    hit = np.asarray(u)[..., None] < cumulative[band]
+    return np.where(hit.any(axis=-1), order[band, hit.argmax(axis=-1)], 0)
+
+
+def _gamma_inv(u, shape, scale):
+    '''
+    inverse CDF of the gamma distribution with integer shape (Erlang), by bisection
+    '''
+    def cdf(x):
+        term = total = 1.0
+        for k in range(1, shape):
+            term *= x / k
+            total += term
+        return 1.0 - math.exp(-x) * total
+    low, high = 0.0, 1.0
+    while cdf(high) < u:
+        high *= 2.0
+    for _ in range(40):
+        mid = 0.5 * (low + high)
+        if cdf(mid) < u:
+            low = mid
+        else:
+            high = mid
+    return 0.5 * (low + high) * scale
+
 
 class User():
 
@@ -27,6 +151,7 @@ class User():
         self.charge_preference = "swap"     # "swap": swap, "charge": charge, "leave": leave
         self.arrival_time = -1              #Set a counter to record the user arrival time, accurate to the number of seconds after the simulation starts, to generate a user queue, -1 means not to put it in the queue
         self.max_wait_number = 20           #Set a maximum waiting time. If the battery replacement does not start within this time, the user will leave the queue. Unit = number of people in the queue.
+        self.max_wait_time = -1             #Set the patience in the queues in seconds, -1 = unlimited. A user who is still waiting after this time leaves the queue (reneges).
         self.max_charge_time = -1           #Set a maximum charging time parameter, from the beginning of charging to the end of charging. After this time, the user will stop charging and leave.
         self.min_charge_soc = 1             #Set the minimum SOC state that the user is willing to charge to. If it exceeds it, he will leave. The default is 100 (full).
         self.power_consumption = 20         #Set the user’s power consumption per 100 kilometers
@@ -81,56 +206,19 @@ class User():
         '''
         Rearrange the user selection preference based on markov chain
         --> Modify: input temp, soc state, queue length
+        the posterior of the band is precomputed (MARKOV_PROBABILITIES), the draw is markov_draw
         '''
-        x_state = ["swap", "charge", "leave"]
-        x_prior = np.array([0.7, 0.25, 0.05],dtype=np.float64)
-        Transition_matrix = np.array([[0.8, 0.1, 0.1],
-                                      [0.1, 0.1, 0.8],
-                                      [0.0, 0.0, 1.0]], dtype=np.float64)
-        Observation_matrix = self.O_matrix_generation(self.temp, self.battery.soc, queue_length)
-        x_1 = Observation_matrix.dot(Transition_matrix.dot(x_prior))    # one step forward procedure
-        x_1 = x_1 / sum(x_1)
-        x_1 = [round(s,2) for s in x_1]                                 # estimate probability
-        ulist = [1, 2, 3]
-        numb = get_number_by_pro(number_list = ulist, pro_list = x_1)
+        numb = markov_draw(markov_band(self.temp, self.battery.soc, queue_length), _uniform())
         
-        self.charge_preference = x_state[int(numb)]                     # save as string
-        return x_state[int(numb)]
+        self.charge_preference = MARKOV_STATES[numb]                    # save as string
+        return MARKOV_STATES[numb]
     ###################################################################################
     ###################################################################################
     def O_matrix_generation(self, temp, soc_state, queue_len):
-
-        if (temp>=5 and temp<=26) and soc_state>=0.4 and queue_len<=12:
-            O_matrix = np.array([[0.5, 0.0, 0.0],[0.0, 0.4, 0.0],[0.0, 0.0, 0.1]],dtype=np.float64)
-            return O_matrix
-        
-        if (temp<5 or temp>26) and soc_state>=0.4 and queue_len<=12:
-            O_matrix = np.array([[0.7, 0.0, 0.0],[0.0, 0.2, 0.0],[0.0, 0.0, 0.1]],dtype=np.float64)
-            return O_matrix
-
-        if (temp>=5 and temp<=26) and soc_state<0.4 and queue_len<=12:
-            O_matrix = np.array([[0.9, 0.0, 0.0],[0.0, 0.1, 0.0],[0.0, 0.0, 0.0]],dtype=np.float64)
-            return O_matrix
-
-        if (temp>=5 and temp<=26) and soc_state>=0.4 and queue_len>12:
-            O_matrix = np.array([[0.6, 0.0, 0.0],[0.0, 0.3, 0.0],[0.0, 0.0, 0.1]],dtype=np.float64)
-            return O_matrix
-
-        if (temp<5 or temp>26) and soc_state<0.4 and queue_len<=12:
-            O_matrix = np.array([[0.8, 0.0, 0.0],[0.0, 0.1, 0.0],[0.0, 0.0, 0.1]],dtype=np.float64)
-            return O_matrix
-
-        if (temp<5 or temp>26) and soc_state>=0.4 and queue_len>12:
-            O_matrix = np.array([[0.3, 0.0, 0.0],[0.0, 0.3, 0.0],[0.0, 0.0, 0.4]],dtype=np.float64)
-            return O_matrix
-
-        if (temp>=5 and temp<=26) and soc_state<0.4 and queue_len>12:
-            O_matrix = np.array([[0.6, 0.0, 0.0],[0.0, 0.2, 0.0],[0.0, 0.0, 0.2]],dtype=np.float64)
-            return O_matrix
-
-        if (temp<5 or temp>26) and soc_state<0.4 and queue_len>12:
-            O_matrix = np.array([[0.7, 0.0, 0.0],[0.0, 0.1, 0.0],[0.0, 0.0, 0.2]],dtype=np.float64)
-            return O_matrix
+        '''
+        observation matrix of the band of temp, soc state and queue length (MARKOV_OBSERVATION)
+        '''
+        return np.diag(np.array(MARKOV_OBSERVATION[markov_band(temp, soc_state, queue_len)], dtype=np.float64))
     ###################################################################################
     ###################################################################################
     def full_swap_preference(self):
@@ -184,7 +272,7 @@ class User():
         if len(battery_config) ==2:
             ratio = list(battery_config.values())[0] / sum(list(battery_config.values()))
             # set up a flag value that compare with the ratio in order to confirm the battery type
-            flag = random.random()
+            flag = _uniform()
             # Here currently only allows 2 type of battery configuration -> 100 kWh and 75 kWh
             if flag <= ratio:
                 # first type of battery
@@ -195,7 +283,7 @@ class User():
         else:
             ratio1 = list(battery_config.values())[0] / sum(list(battery_config.values()))
             ratio2 = list(battery_config.values())[0] + list(battery_config.values())[1] / sum(list(battery_config.values()))
-            flag = random.random()
+            flag = _uniform()
             # Here currently only allows 2 type of battery configuration -> 100 kWh and 75 kWh
             if flag <= ratio1:
                 # first type of battery
@@ -217,7 +305,17 @@ class User():
             logger.debug('invalid battery soc limit: %.2f --> set soc to 0.0',soc_low_limit)
             soc_low_limit = 0.0
         
-        if random_soc == 0:
+        if _sampling != 0:
+            # inverse transform sampling, see set_sampling()
+            u = min(max(_uniform(), 1e-12), 1.0 - 1e-12)
+            if random_soc == 0:
+                input_soc = round(_gamma_inv(u, 3, 12.0) / 100, 2)
+            elif random_soc == 1:
+                input_soc = round(NormalDist(mu=33.13, sigma=18.71).inv_cdf(u) / 100, 2)
+            else:
+                input_soc = round(soc_low_limit + (soc_up_limit - soc_low_limit) * u, 2)
+
+        elif random_soc == 0:
             # set up the clients initial soc based on real statistic data -> Gamma distribution
             shape, scale = 3.0, 12.0
             input_soc = random.gammavariate(shape, scale)
@@ -359,22 +457,13 @@ def label_queue(BS_list:list, non_BS_list:list):
     '''
     labeling and packaging the BS and non-BS queue into dict
     '''
-    BS_user_num = len(BS_list)
-    non_BS_user_num = len(non_BS_list)
-    BS_user_label = []
-    non_BS_user_label = []
-    for i in range(BS_user_num):
-        BS_user_label.append("BS")
-    for i in range(non_BS_user_num):
-        non_BS_user_label.append("non_BS")
-    
     BS_queue_dict = {
-        "time" : BS_list,
-        "label" : BS_user_label
+        "time" : list(BS_list),
+        "label" : ["BS"] * len(BS_list)
     }
     non_BS_queue_dict = {
-        "time" : non_BS_list,
-        "label" : non_BS_user_label
+        "time" : list(non_BS_list),
+        "label" : ["non_BS"] * len(non_BS_list)
     }
     return BS_queue_dict, non_BS_queue_dict
     ###################################################################################
@@ -383,17 +472,14 @@ def label_queue(BS_list:list, non_BS_list:list):
 def sort_queue(queue1:dict, queue2:dict):
     '''
     sort the two queues dict with key name: "time", "label"
-    sort by ["time"]
+    sort by ["time"], users arriving at the same second keep queue1 before queue2
     '''
-    queue1 = pd.DataFrame(queue1)
-    queue2 = pd.DataFrame(queue2)
-    dt_total = [queue1, queue2]
-    dt_total = pd.concat(dt_total)
-    sorted_dt = dt_total.sort_values(by=["time"])
-    
+    merged = list(zip(queue1["time"], queue1["label"])) + list(zip(queue2["time"], queue2["label"]))
+    merged.sort(key=itemgetter(0))                      # stable, merges the two sorted runs in O(n)
+
     # get the sorted queue and label in format list
-    sorted_queue = list(sorted_dt["time"])
-    sorted_label = list(sorted_dt["label"])
+    sorted_queue = [t for t, _ in merged]
+    sorted_label = [l for _, l in merged]
 
     return sorted_queue, sorted_label
 
@@ -453,8 +539,12 @@ def get_number_by_pro(number_list, pro_list):
     return:按概率从数字列表中抽取的数字
     """
     # 用均匀分布中的样本值来模拟概率
-    x = random.uniform(0, 1)
+    x = _uniform()
     num = x
+    if _sampling != 0:
+        # most probable numbers first: small u fall into busy slots, their antithetic 1 - u into quiet ones
+        pairs = sorted(zip(number_list, pro_list), key=lambda p: -p[1])
+        number_list, pro_list = [p[0] for p in pairs], [p[1] for p in pairs]
     # 累积概率
     sum_pro = 0.0
      # 将可迭代对象打包成元组列表
@@ -463,6 +553,8 @@ def get_number_by_pro(number_list, pro_list):
         if x < sum_pro:
      # 从区间[number. number - 1]上随机抽取一个值
             num = np.random.uniform(number, number - 1)
+            if _sampling < 0:
+                num = 2 * number - 1 - num
      # 返回值
             return num
     return num
@@ -0,0 +1,228 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import random
+import threading
+import zlib
+
+import numpy as np
+
+import checkpoint
+import main
+import swap
+
+# Warm-up transient of the simulation.
+# Every run starts from an artificial state: all batteries at init_battery_soc_in_BSS, empty queues.
+# 1. detection: MSER-5 (Marginal Standard Error Rule on batch means of 5 ticks) on the swap queue length,
+#    the charge queue length and the mean rack SOC. With param["truncate_warmup"] the average service
+#    times and the 15 min swap ratio of SimulationRun.results() only count users arriving after the
+#    detected warm-up tick (see SimulationRun.results).
+#    Note: the user arrivals follow a daily profile, so within one day MSER finds the end of the
+#    initial bias relative to the rest of that day, not a true steady state.
+# 2. warm start: with param["warm_start"] the station does not start cold, it is taken from a library
+#    of end-of-day station states per configuration. A library entry is built once by simulating
+#    WARM_DAYS days in a row (each day with new users, starting from the station state of the day before)
+#    and is stored on disk, so only the first run of a configuration pays for it. A new entry is checked
+#    on one more day: started from it, the day must not serve clearly worse than from a cold start.
+
+# set up logger
+logger = logging.getLogger('main.warmup')
+
+# batch size of MSER-5
+MSER_BATCH = 5
+# simulated days to build a warm station state
+WARM_DAYS = 2
+# seed of the days simulated to build the library, independent of the seed of the run
+LIBRARY_SEED = 20221111
+# check of a new library entry: a warm day may serve this share of swap users less than a cold day
+WARM_CHECK_TOLERANCE = 0.05
+# parameters that do not change the warm station state
+COLD_PARAM = ("init_battery_soc_in_BSS", "seed", "sim_ticks", "sim_days", "warm_start", "truncate_warmup")
+# format of the stored stations, part of the key so entries of an older SwapStation are rebuilt
+LIBRARY_VERSION = 6
+# private folder of the current user, see checkpoint.private_dir
+LIBRARY_DIR = os.environ.get("BSS_WARM_LIBRARY", os.path.join(checkpoint.CACHE_ROOT, "warm_library"))
+
+
+######################################################################
+######################## warm-up detection ###########################
+######################################################################
+
+def mser(series, batch = MSER_BATCH) -> int:
+    '''
+    MSER truncation point of a series: the number of leading values to delete, a multiple of batch.
+    Minimizes the squared standard error of the mean of the remaining batch means,
+    only truncation points in the first half are considered.
+    '''
+    y = np.asarray(series, dtype=np.float64)
+    m = len(y) // batch
+    if m < 4:
+        return 0
+    z = y[:m * batch].reshape(m, batch).mean(axis=1)
+    # sums of the batch means z[d:] and their squares, for every truncation d
+    s1 = np.cumsum(z[::-1])[::-1]
+    s2 = np.cumsum((z * z)[::-1])[::-1]
+    k = np.arange(m, 0, -1, dtype=np.float64)          # number of remaining batches
+    ssd = np.maximum(s2 - s1 * s1 / k, 0.0)
+    stat = ssd / (k * k)
+    d = int(np.argmin(stat[:m // 2 + 1]))
+    return d * batch
+
+
+def detect_warmup(run : main.SimulationRun) -> int:
+    '''
+    warm-up tick of a run: the latest MSER-5 truncation of its queue length and mean SOC series
+    '''
+    series = [run.queue_length_swap, run.queue_length_charge]
+    if run.soc_history is not None:
+        series.append(run.soc_history)
+    return max(mser(s) for s in series)
+
+
+######################################################################
+########################### warm start ###############################
+######################################################################
+
+def configuration_key(param : dict) -> str:
+    data = {k: v for k, v in param.items() if k not in COLD_PARAM}
+    data["library_version"] = LIBRARY_VERSION
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def start_new_day(station, param : dict):
+    '''
+    detach a station state from the day it was simulated in, so a new run can start with it:
+    a running swap is completed, vehicles leave the charge piles, the rack batteries below select_soc charge again,
+    histories and grid interaction are reset
+    '''
+    for lane in station.lanes:
+        if lane.state == swap.IN_USE:
+            # complete the swap as do_swap does, the vehicle leaves with the stored battery
+            lane.buff_rack.stop_charge()
+            lane.buff_rack.battery = lane.vehicle_battery
+            lane.buff_rack.start_charge()
+            lane.vehicle_battery = None
+            lane.swap_timer = 0
+            lane.set_state(swap.FREE)
+    if station.state == swap.IN_USE:
+        station.set_state(swap.FREE)
+    for swap_rack in station.swap_rack_list:
+        swap_rack.index_pairs()
+        swap_rack.index_piles()
+        for pile_number, pile in enumerate(swap_rack.charge_pile_list or []):
+            if pile.vehicle_battery is not None:
+                swap_rack.vehicle_leave(pile_number)
+        for battery_rack in swap_rack.battery_rack_list:
+            if battery_rack.battery is not None:
+                battery_rack.battery.charge_history = []
+                battery_rack.battery.charge_start_time = -1
+        # the model restarts the charging of a rack only at a swap, and SimulationRun skips init_charge for a
+        # given station: charge every battery below select_soc again, as init_charge does for a cold start
+        if swap_rack.power_cabinet is not None:
+            for i, battery_rack in enumerate(swap_rack.battery_rack_list):
+                if battery_rack.battery is not None and battery_rack.battery.soc < station.select_soc and battery_rack.state != swap.CHARGING:
+                    swap_rack.start_charge(i)
+            swap_rack.distributed_by = None
+    station.power = 0
+    station.power_history = []
+    station.trigger = []
+    station.set_grid_interaction(param)
+    station.set_battery_selection(param)
+    station.set_power_cap(param)
+    return station
+
+
+def check_warm_day(param : dict, station, seed) -> bool:
+    '''
+    simulate the day seed from a copy of the warm station and from a cold start, return False (and log a warning)
+    if the warm day serves clearly fewer swap users or has a clearly lower 15 min swap ratio (WARM_CHECK_TOLERANCE)
+    '''
+    day_param = dict(param, seed=seed, warm_start=False, truncate_warmup=False)
+    cold = main.SimulationRun(day_param).run().results()
+    warm_station = start_new_day(pickle.loads(pickle.dumps(station, protocol=pickle.HIGHEST_PROTOCOL)), param)
+    warm = main.SimulationRun(day_param, station=warm_station).run().results()
+    # results(): [8] the served swap users, [14] the 15 min swap ratio
+    if len(warm[8]) < (1 - WARM_CHECK_TOLERANCE) * len(cold[8]) or warm[14] < cold[14] - WARM_CHECK_TOLERANCE:
+        logger.warning('warm station serves worse than a cold start: %d swaps (ratio %.2f) against %d (ratio %.2f)',
+                       len(warm[8]), warm[14], len(cold[8]), cold[14])
+        return False
+    return True
+
+
+class WarmStartLibrary:
+    '''
+    end-of-day station states per configuration, kept in memory and on disk
+    '''
+    def __init__(self, directory = LIBRARY_DIR, days = WARM_DAYS):
+        self.directory = directory
+        self.days = days
+        self._entries = {}                  # key -> compressed pickled station
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".warm")
+
+    def build(self, param : dict) -> bytes:
+        '''
+        simulate self.days days in a row and return the compressed end-of-day station state
+        the global RNG states are left untouched
+        '''
+        rng_state = random.getstate(), np.random.get_state()
+        try:
+            day_param = dict(param, seed=LIBRARY_SEED, warm_start=False, truncate_warmup=False)
+            station = None
+            for day in range(self.days):
+                run = main.SimulationRun(day_param, station=station)
+                run.run()
+                station = start_new_day(run.station, param)
+                day_param["seed"] = LIBRARY_SEED + day + 1
+            check_warm_day(param, station, day_param["seed"])
+        finally:
+            random.setstate(rng_state[0])
+            np.random.set_state(rng_state[1])
+        return zlib.compress(pickle.dumps(station, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def station(self, param : dict):
+        '''
+        return a fresh copy of the warm station of the configuration, built on first use
+        '''
+        key = configuration_key(param)
+        with self._lock:
+            data = self._entries.get(key)
+            on_disk = False
+            if data is None:
+                try:
+                    checkpoint.private_dir(self.directory)
+                    on_disk = True
+                except OSError as e:
+                    logger.warning('warm station library kept in memory only: %s', e)
+            if data is None and on_disk and os.path.exists(self._path(key)):
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            if data is None:
+                logger.info('build warm station state %s (%d days)', key, self.days)
+                data = self.build(param)
+            if on_disk and not os.path.exists(self._path(key)):
+                tmp_path = self._path(key) + ".%d.tmp" % os.getpid()
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            self._entries[key] = data
+        return start_new_day(pickle.loads(zlib.decompress(data)), param)
+
+
+_library = None
+
+
+def warm_station(param : dict):
+    '''
+    warm station for param from the default library
+    '''
+    global _library
+    if _library is None:
+        _library = WarmStartLibrary()
+    return _library.station(param)